@@ -0,0 +1,54 @@
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import click
+
+from .replica import AddressReplica, DAWA_REPLICA_PATH
+
+
+@click.group()
+@click.option(
+    "--path",
+    default=DAWA_REPLICA_PATH,
+    required=True,
+    help="Database file (Default: DAWA_REPLICA_PATH)"
+)
+@click.pass_context
+def cli(ctx, path):
+    """
+    Local replica of the DAWA addresses
+    """
+
+    ctx.obj = AddressReplica(path)
+
+
+@cli.command()
+@click.argument("area_code", default="0751")
+@click.pass_obj
+def load(replica, area_code):
+    """
+    Load all addresses within an area code (kommunekode)
+    """
+
+    for table, amount in replica.load(area_code).items():
+        click.echo("Loaded {0} {1}".format(amount, table))
+
+
+@cli.command()
+@click.pass_obj
+def refresh(replica):
+    """
+    Apply the changes since the latest load or refresh
+    """
+
+    for table, amount in replica.refresh().items():
+        click.echo("Refreshed {0} {1}".format(amount, table))
+
+
+if __name__ == "__main__":
+    cli()
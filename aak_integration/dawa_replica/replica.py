@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import os
+import re
+import json
+import sqlite3
+import itertools
+import threading
+
+import requests
+from logging import getLogger
+
+
+# DAR Service settings
+BASE_URL = "https://dawa.aws.dk"
+
+# Location of the replica (SQLite database file)
+DAWA_REPLICA_PATH = os.environ.get("DAWA_REPLICA_PATH")
+
+# Amount of rows written (or objects fetched by id) at a time
+CHUNK_SIZE = 200
+
+# Replicated entities (table name: DAWA resource)
+ENTITIES = {
+    "adresser": "adresser",
+    "adgangsadresser": "adgangsadresser",
+}
+
+# Fields which can be used for a keyed lookup
+# (DAWA query parameter: column)
+KEY_FIELDS = {
+    "id": "id",
+    "vejkode": "vejkode",
+    "postnr": "postnr",
+    "husnr": "husnr",
+    "etage": "etage",
+    "dør": "doer",
+    "vejnavn": "vejnavn",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id TEXT PRIMARY KEY,
+    adgangsadresseid TEXT,
+    vejkode TEXT,
+    vejnavn TEXT,
+    husnr TEXT,
+    etage TEXT,
+    doer TEXT,
+    postnr TEXT,
+    kommunekode TEXT,
+    status INTEGER,
+    search TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS {table}_key
+    ON {table} (vejkode, postnr, husnr, etage, doer);
+CREATE INDEX IF NOT EXISTS {table}_search
+    ON {table} (search);
+"""
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Init logging
+log = getLogger(__name__)
+
+# Replicas by path (See 'get_replica')
+_replicas = {}
+_replicas_lock = threading.Lock()
+
+
+def normalize(text):
+    """
+    Normalize an address string for lookups.
+    Case, punctuation and whitespace are ignored,
+    e.g. "Parkvej 56, 1. th, 8920 Randers NV"
+    and "parkvej 56 1 th 8920 randers nv" are equal.
+
+    :param text:    Address string
+
+    :return:        Returns normalized string
+    """
+
+    return " ".join(re.split(r"[\W_]+", str(text or "").lower())).strip()
+
+
+def key_value(field, value):
+    """
+    Normalize a single value of the lookup key.
+    Street and postal codes are compared as numbers (no leading zeros),
+    other values are compared case insensitive.
+
+    NOTE: Leading zeros are significant for floor and door
+          (e.g. "01" and "1" are different doors)
+
+    :param field:   Column name (See 'KEY_FIELDS')
+    :param value:   Value (None and empty values are equal)
+
+    :return:        Returns normalized string
+    """
+
+    value = str(value if value is not None else "").strip().lower()
+
+    if field in ("vejkode", "postnr"):
+        value = value.lstrip("0")
+
+    return value
+
+
+def search_string(data):
+    """
+    Create the (normalized) search string of an address object.
+    DAWA provides the full address as 'betegnelse'.
+
+    :param data:    DAWA address object (Flat structure)
+
+    :return:        Returns normalized string
+    """
+
+    betegnelse = data.get("betegnelse")
+
+    if not betegnelse:
+        betegnelse = "{} {}, {}. {}, {} {}".format(
+            data.get("vejnavn"),
+            data.get("husnr"),
+            data.get("etage") or "",
+            data.get("dør") or "",
+            data.get("postnr"),
+            data.get("postnrnavn")
+        )
+
+    return normalize(betegnelse)
+
+
+def to_row(data):
+    """
+    Convert a DAWA address object (Flat structure) to a table row.
+    The original object is kept as json.
+
+    :param data:    DAWA address or access address object
+
+    :return:        Returns tuple of column values
+    """
+
+    return (
+        data["id"],
+        data.get("adgangsadresseid") or data["id"],
+        key_value("vejkode", data.get("vejkode")),
+        key_value("vejnavn", data.get("vejnavn")),
+        key_value("husnr", data.get("husnr")),
+        key_value("etage", data.get("etage")),
+        key_value("doer", data.get("dør")),
+        key_value("postnr", data.get("postnr")),
+        data.get("kommunekode"),
+        data.get("status"),
+        search_string(data),
+        json.dumps(data)
+    )
+
+
+def get_request(resource, **params):
+    """
+    GET request to the DAR service (DAWA)
+
+    :param resource:    REST API resource path (e.g. adresser)
+    :param params:      Query parameters
+
+    :return:            Returns decoded response (or raises)
+    """
+
+    url = "{base_url}/{resource}".format(
+        base_url=BASE_URL,
+        resource=resource
+    )
+
+    response = requests.get(url=url, params=params)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def stream_request(resource, **params):
+    """
+    Streaming GET request (newline delimited JSON)
+
+    :param resource:    REST API resource path (e.g. adresser)
+    :param params:      Query parameters
+
+    :return:            Returns a generator (iterator) of objects
+    """
+
+    url = "{base_url}/{resource}".format(
+        base_url=BASE_URL,
+        resource=resource
+    )
+
+    params["format"] = "ndjson"
+
+    response = requests.get(url=url, params=params, stream=True)
+
+    try:
+        response.raise_for_status()
+
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line.decode("utf-8"))
+
+    finally:
+        response.close()
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of (at most) 'size'
+    """
+
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+class AddressReplica(object):
+    """
+    Local replica of the DAWA addresses and access addresses
+    within a municipality, stored in a SQLite database.
+
+    The replica is loaded from a full (bulk) download,
+    and kept up to date from the DAWA change feed (replication API).
+
+    Lookups are indexed by identifier, by the address key
+    (vejkode, postnr, husnr, etage, dør) and by a normalized search string.
+
+    Example:
+
+        replica = AddressReplica("var/dawa.db")
+        replica.load("0751")
+
+        # Periodically
+        replica.refresh()
+
+        replica.get("0a3f50c3-...")
+        replica.find("adresser", vejkode="1234", postnr="8000", husnr="1")
+
+    The replica can be shared between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            for table in ENTITIES:
+                self.connection.executescript(SCHEMA.format(table=table))
+
+            self.connection.executescript(META_SCHEMA)
+
+    # Meta data
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, str(value))
+            )
+
+    # Lookups
+
+    def query(self, table, where, params):
+        """
+        Select address objects
+
+        :param table:   Table name (See 'ENTITIES')
+        :param where:   SQL condition
+        :param params:  Parameters of the condition
+
+        :return:        Returns list of DAWA objects (Flat structure)
+        """
+
+        sql = "SELECT data FROM {table} WHERE {where}".format(
+            table=table,
+            where=where
+        )
+
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, uuid):
+        """
+        Get address by identifier
+
+        :param uuid:    Address identifier (Type: uuid)
+
+        :return:        Returns DAWA address object (or None)
+        """
+
+        found = self.query("adresser", "id = ?", (str(uuid),))
+
+        return found[0] if found else None
+
+    def get_access(self, uuid):
+        """
+        Get access address by identifier
+
+        :param uuid:    Access address identifier (Type: uuid)
+
+        :return:        Returns DAWA access address object (or None)
+        """
+
+        found = self.query("adgangsadresser", "id = ?", (str(uuid),))
+
+        return found[0] if found else None
+
+    def find(self, table, **criteria):
+        """
+        Find addresses by DAWA query parameters.
+        Only the fields of the address key (See 'KEY_FIELDS') are supported.
+
+        :param table:       Table name (See 'ENTITIES')
+        :param criteria:    Query parameters, e.g. vejkode, postnr, husnr
+
+        :return:            Returns list of DAWA objects (Flat structure)
+                            or None if the criteria are not supported
+        """
+
+        if not criteria or set(criteria) - set(KEY_FIELDS):
+            return None
+
+        columns = [KEY_FIELDS[field] for field in criteria]
+
+        where = " AND ".join(
+            "{column} = ?".format(column=column) for column in columns
+        )
+
+        params = [
+            key_value(column, value)
+            for column, value in zip(columns, criteria.values())
+        ]
+
+        if "id" in criteria:
+            params[columns.index("id")] = str(criteria["id"])
+
+        return self.query(table, where, params)
+
+    def search(self, text, table="adresser"):
+        """
+        Find addresses by search string (See 'normalize')
+
+        :param text:    Address string, e.g. "Parkvej 56, 8920 Randers NV"
+        :param table:   Table name (See 'ENTITIES')
+
+        :return:        Returns list of DAWA objects (Flat structure)
+        """
+
+        return self.query(table, "search = ?", (normalize(text),))
+
+    # Replication
+
+    def write(self, table, objects):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO {table} VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(table=table),
+                [to_row(data) for data in objects]
+            )
+
+    def delete(self, table, uuids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM {table} WHERE id = ?".format(table=table),
+                [(uuid,) for uuid in uuids]
+            )
+
+    def load(self, area_code):
+        """
+        Load all addresses and access addresses within an area code.
+        Existing objects are replaced.
+
+        The sequence number of the change feed is recorded before the
+        download begins, as such changes made during the download
+        are applied on the next refresh.
+
+        :param area_code:   4 digit area code identifier (kommunekode)
+
+        :return:            Returns amount of objects by table
+        """
+
+        sequence = get_request("replikering/senestesekvensnummer")
+
+        loaded = {}
+
+        for table, resource in ENTITIES.items():
+            objects = stream_request(
+                resource=resource,
+                kommunekode=area_code,
+                struktur="flad"
+            )
+
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "DELETE FROM {table}".format(table=table)
+                )
+
+            loaded[table] = 0
+
+            for chunk in chunks(objects, CHUNK_SIZE):
+                self.write(table, chunk)
+                loaded[table] += len(chunk)
+
+            log.info("Loaded {0} {1}".format(loaded[table], table))
+
+        self.set_meta("kommunekode", area_code)
+        self.set_meta("sekvensnummer", sequence["sekvensnummer"])
+
+        return loaded
+
+    def refresh(self):
+        """
+        Apply the changes (events) since the latest load or refresh.
+        Changed objects are fetched (Flat structure),
+        removed objects are deleted.
+
+        The change feed can not be filtered by area (the events only
+        hold the identifiers), as such the changes of the whole country
+        are read. The changed objects are fetched within the area only.
+
+        :return:    Returns amount of changed objects by table
+        """
+
+        area_code = self.get_meta("kommunekode")
+        sequence = self.get_meta("sekvensnummer")
+
+        if not sequence:
+            raise RuntimeError("The replica has not been loaded")
+
+        latest = get_request("replikering/senestesekvensnummer")
+        latest = latest["sekvensnummer"]
+
+        refreshed = {}
+
+        for table, resource in ENTITIES.items():
+            events = get_request(
+                "replikering/{resource}/haendelser".format(resource=resource),
+                sekvensnummerfra=int(sequence) + 1,
+                sekvensnummertil=latest
+            )
+
+            # Only the latest event of each object matters
+            changed = set()
+            removed = set()
+
+            for event in events:
+                uuid = event["data"]["id"]
+
+                if event["operation"] == "delete":
+                    changed.discard(uuid)
+                    removed.add(uuid)
+                else:
+                    removed.discard(uuid)
+                    changed.add(uuid)
+
+            for uuids in chunks(sorted(changed), CHUNK_SIZE):
+                # Objects outside the area are not returned
+                inside = get_request(
+                    resource,
+                    id="|".join(uuids),
+                    kommunekode=area_code,
+                    struktur="flad"
+                )
+
+                # Objects outside the area are not replicated
+                # (they may have been moved, e.g. a new municipality)
+                outside = set(uuids) - set(data["id"] for data in inside)
+
+                self.write(table, inside)
+                self.delete(table, outside)
+
+            self.delete(table, removed)
+
+            refreshed[table] = len(changed) + len(removed)
+
+            log.info("Refreshed {0} {1}".format(refreshed[table], table))
+
+        self.set_meta("sekvensnummer", latest)
+
+        return refreshed
+
+
+def get_replica(path=None):
+    """
+    Get the (shared) replica if it exists.
+    Lookups should fall back to DAWA if no replica is returned,
+    or if the address is not found in the replica.
+
+    :param path:    Location of the database file
+                    (Default: environment variable DAWA_REPLICA_PATH)
+
+    :return:        Returns AddressReplica (or None)
+    """
+
+    path = path or DAWA_REPLICA_PATH
+
+    if not path or not os.path.isfile(path):
+        return None
+
+    with _replicas_lock:
+        if path not in _replicas:
+            _replicas[path] = AddressReplica(path)
+
+        return _replicas[path]
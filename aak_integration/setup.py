@@ -15,7 +15,11 @@ setup(
     author='Heini Leander Ovason',
     author_email='heini@magenta.dk',
     license="MPL 2.0",
-    packages=['serviceplatformen_cpr', 'serviceplatformen_cvr'],
+    packages=[
+        'serviceplatformen_cpr',
+        'serviceplatformen_cvr',
+        'dawa_replica'
+    ],
     zip_safe=False,
     install_requires=[
         'aak-integration>=0.1',
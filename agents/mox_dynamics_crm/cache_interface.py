@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import rethinkdb as r
+import metrics
 
-from helper import get_config
+from helper import get_config, REFERENCE_FIELDS
 from logging import getLogger
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
-import datetime
+import atexit
+import copy
+import queue
+import threading
+import time
 
 # Temporary mapping
 mapping = {
@@ -18,6 +25,9 @@ mapping = {
     "organisationfunktion": "ava_kunderolles",
     "klasse": "ava_installations",
     "imports": "imports",
+    "exports": "exports",
+    "export_retries": "export_retries",
+    "export_queue": "export_queue",
 }
 
 # Init logger
@@ -25,11 +35,483 @@ log = getLogger(__name__)
 
 DO_WRITE = True
 
+# Number of idle connections kept open by the connection pool
+# Can be set in the 'rethinkdb' section of config.ini (db_pool_size)
+DEFAULT_POOL_SIZE = 8
+
+# Connections idle for this many seconds are pinged on checkout
+# Can be set in the 'rethinkdb' section of config.ini (db_pool_ping_after)
+DEFAULT_POOL_PING_AFTER = 30
+
+# Amount of documents fetched per round-trip when streaming a table
+DEFAULT_BATCH_SIZE = 500
+
+# Write-behind buffer (See 'WriteBuffer')
+# Can be set in the 'rethinkdb' section of config.ini
+# (db_write_buffer_size, db_write_buffer_age, db_write_durability)
+DEFAULT_WRITE_BUFFER_SIZE = 500
+DEFAULT_WRITE_BUFFER_AGE = 5
+
+# Tables which are refreshed (field: 'updated') on import
+UPDATED_TABLES = [
+    "contacts",
+    "ava_adresses",
+    "accounts",
+    "ava_aftales",
+    "ava_kunderolles",
+    "ava_installations",
+]
+
+# Secondary indexes used to find current and obsolete documents.
+# Documents where 'updated' is not a datetime (or missing)
+# are indexed separately, as they are always considered obsolete.
+UPDATED_INDEX = "updated"
+UNTIMED_INDEX = "updated_untimed"
+
+UPDATED_INDEXES = [
+    UPDATED_INDEX,
+    (
+        UNTIMED_INDEX,
+        lambda document: document["updated"].default(
+            None
+        ).type_of().ne("PTYPE<TIME>")
+    )
+]
+
+# Tables used to resume an export (See 'start_export')
+EXPORT_TABLES = [
+    "exports",
+    "export_retries",
+    "export_queue",
+]
+
+# Documents changed on import are queued for export (See 'queue_export')
+# The queue is drained in the order of this index
+EXPORT_QUEUE_INDEX = "queued"
+
+# Secondary indexes on the references between documents (table: fields)
+# Used to find the kunderolles affected by a change
+# (See 'affected_kunderolles')
+REFERENCE_INDEXES = {
+    "ava_kunderolles": ["contact_ref", "interessefaellesskab_ref"],
+    "ava_aftales": ["interessefaellesskab_ref", "klasse_ref", "dawa_ref"],
+    "ava_installations": ["dawa_ref"],
+    "contacts": ["dawa_ref"],
+    "accounts": ["dawa_ref"],
+}
+
+# Tables followed by the continuous export (See 'follow_changes')
+FOLLOWED_TABLES = [
+    "ava_kunderolles",
+    "contacts",
+    "accounts",
+    "ava_aftales",
+    "ava_installations",
+    "ava_adresses",
+    "access",
+]
+
+# Bounds for range queries on the 'updated' index
+# Using time values as bounds excludes any other value type
+BEGINNING_OF_TIME = r.epoch_time(0)
+END_OF_TIME = r.time(9999, 12, 31, "Z")
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of reusable RethinkDB connections.
+
+    A connection is checked out for the duration of a 'with' block
+    and handed back to the pool afterwards. Up to 'size' idle connections
+    are kept open, additional connections are created when the pool
+    is exhausted and closed again when they are returned.
+
+    Connections are health checked on checkout and on return,
+    closed or broken connections are discarded and replaced.
+    A connection which has been idle for 'ping_after' seconds
+    is pinged (a trivial query) on checkout, as the server
+    may have dropped it in the meantime.
+
+    Example:
+
+        with pool.connection() as connection:
+            r.table("contacts").get(uuid).run(connection)
+    """
+
+    def __init__(self, factory, size=DEFAULT_POOL_SIZE,
+                 ping_after=DEFAULT_POOL_PING_AFTER):
+        self.factory = factory
+        self.size = size
+        self.ping_after = ping_after
+
+        # Idle connections with the time they were returned
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def ping(self, connection):
+        """
+        Check that the server still answers on a connection.
+
+        :return:    Returns True if the connection is alive
+        """
+
+        try:
+            r.expr(1).run(connection)
+            return True
+        except r.ReqlDriverError:
+            return False
+
+    def _checkout(self):
+        while True:
+            try:
+                connection, returned = self.idle.get_nowait()
+            except queue.Empty:
+                return self.factory()
+
+            if not connection.is_open():
+                log.debug("Discarding closed connection from pool")
+                continue
+
+            if time.monotonic() - returned < self.ping_after:
+                return connection
+
+            if self.ping(connection):
+                return connection
+
+            log.debug("Discarding dropped connection from pool")
+            connection.close(noreply_wait=False)
+
+    def _checkin(self, connection):
+        if not connection.is_open():
+            return
+
+        try:
+            self.idle.put_nowait((connection, time.monotonic()))
+        except queue.Full:
+            connection.close(noreply_wait=False)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection from the pool.
+
+        :return:    Context manager yielding a connection object
+        """
+
+        connection = self._checkout()
+
+        try:
+            yield connection
+        except r.ReqlDriverError:
+            # The connection is in an unknown state, do not reuse it
+            connection.close(noreply_wait=False)
+            raise
+        finally:
+            self._checkin(connection)
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+
+            connection.close(noreply_wait=False)
+
+
+# Connection pool (created on first use)
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Get (or create) the shared connection pool.
+
+    :return:    ConnectionPool object
+    """
+
+    global pool
+
+    with pool_lock:
+        if not pool:
+            config = get_config("rethinkdb")
+            pool = ConnectionPool(
+                factory=connect,
+                size=config.getint("db_pool_size", fallback=DEFAULT_POOL_SIZE),
+                ping_after=config.getfloat(
+                    "db_pool_ping_after",
+                    fallback=DEFAULT_POOL_PING_AFTER
+                )
+            )
+
+    return pool
+
+
+def checkout():
+    """
+    Check out a pooled connection for the duration of a 'with' block.
+
+    :return:    Context manager yielding a connection object
+    """
+
+    return get_pool().connection()
+
+
+class WriteBuffer(object):
+    """
+    Write-behind buffer for documents.
+
+    Dirty documents are collected per table and written
+    in a single bulk insert (conflict=update) per table.
+    The buffer is flushed when it holds 'size' documents,
+    when the oldest document has waited 'age' seconds
+    (checked by a timer and whenever the buffer is used)
+    and at shutdown.
+
+    Documents being flushed are still returned by 'pending'
+    until the insert has returned. Flushes run one at a time,
+    as such a document is never overwritten by an older version.
+
+    Documents are copied when added, later changes
+    to a document require it to be added again.
+
+    Example:
+
+        write_buffer.add("contacts", contact)
+        write_buffer.flush()
+    """
+
+    def __init__(self, size=DEFAULT_WRITE_BUFFER_SIZE,
+                 age=DEFAULT_WRITE_BUFFER_AGE, durability="hard"):
+        self.size = size
+        self.age = age
+        self.durability = durability
+
+        self.lock = threading.Lock()
+        self.dirty = {}
+        self.count = 0
+        self.oldest = None
+        self.timer = None
+
+        # Held for the duration of a flush (the documents are written
+        # in the order they were taken from the buffer)
+        self.flush_lock = threading.Lock()
+
+        # Documents by table of the flush in progress (See flush_lock)
+        self.flushing = []
+
+    def is_due(self):
+        """
+        Check if the buffer should be flushed (the lock must be held)
+        """
+
+        return self.count >= self.size or (
+            self.oldest is not None and
+            time.monotonic() - self.oldest >= self.age
+        )
+
+    def flush_if_due(self):
+        """
+        Flush the buffer if it is full or the oldest document is too old.
+        """
+
+        with self.lock:
+            is_due = self.is_due()
+
+        if is_due:
+            self.flush()
+
+    def on_timer(self):
+        try:
+            self.flush_if_due()
+        except Exception as error:
+            log.exception(error)
+
+    def add(self, table, document):
+        """
+        Add (or replace) a dirty document.
+
+        :param table:       Table name
+        :param document:    Document (must contain an 'id')
+        """
+
+        with self.lock:
+            documents = self.dirty.setdefault(table, {})
+
+            if document["id"] not in documents:
+                self.count += 1
+
+            documents[document["id"]] = copy.deepcopy(document)
+
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+                # Flush the document in time if nothing else is added
+                self.timer = threading.Timer(self.age, self.on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+            is_due = self.is_due()
+
+        if is_due:
+            self.flush()
+
+    def pending(self, table, uuid):
+        """
+        Get a document which has not yet been written.
+
+        :return:    Returns a copy of the document or None
+        """
+
+        with self.lock:
+            # Newest version first
+            for dirty in [self.dirty] + self.flushing[::-1]:
+                document = dirty.get(table, {}).get(uuid)
+
+                if document is not None:
+                    break
+
+            if document is not None:
+                document = copy.deepcopy(document)
+
+            is_due = self.is_due()
+
+        if is_due:
+            self.flush()
+
+        return document
+
+    def flush(self):
+        """
+        Write all dirty documents.
+        A flush in progress (e.g. by the timer) is waited for.
+
+        :return:    Returns a list of status objects (one per table)
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, {}
+                self.count = 0
+                self.oldest = None
+
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+
+                if not dirty:
+                    return []
+
+                self.flushing.append(dirty)
+
+            try:
+                return self.write(dirty)
+            finally:
+                with self.lock:
+                    self.flushing.remove(dirty)
+
+    def write(self, dirty):
+        """
+        Write documents by table (See 'flush')
+        """
+
+        if not DO_WRITE:
+            return []
+
+        results = []
+
+        with checkout() as connection:
+            for table, documents in dirty.items():
+                with metrics.timed("cache_write", table) as status:
+                    result = r.table(table).insert(
+                        list(documents.values()),
+                        conflict="update",
+                        durability=self.durability
+                    ).run(connection)
+
+                    if result.get("errors"):
+                        status["status"] = "error"
+
+                log.debug(
+                    "Flushed {count} documents to {table}".format(
+                        count=len(documents),
+                        table=table
+                    )
+                )
+
+                if result.get("errors"):
+                    log.error(
+                        "Unable to write {errors} documents to {table}: "
+                        "{first_error}".format(table=table, **result)
+                    )
+
+                results.append(result)
+
+        return results
+
+
+# Write-behind buffer (created on first use)
+write_buffer = None
+
+
+def get_write_buffer():
+    """
+    Get (or create) the shared write-behind buffer.
+    The buffer is flushed at shutdown.
+
+    :return:    WriteBuffer object
+    """
+
+    global write_buffer
+
+    with pool_lock:
+        if not write_buffer:
+            config = get_config("rethinkdb")
+            write_buffer = WriteBuffer(
+                size=config.getint(
+                    "db_write_buffer_size",
+                    fallback=DEFAULT_WRITE_BUFFER_SIZE
+                ),
+                age=config.getfloat(
+                    "db_write_buffer_age",
+                    fallback=DEFAULT_WRITE_BUFFER_AGE
+                ),
+                durability=config.get("db_write_durability", fallback="hard")
+            )
+            atexit.register(write_buffer.flush)
+
+    return write_buffer
+
+
+def write_behind(table, document):
+    """
+    Queue a document for writing (See 'WriteBuffer')
+
+    :param table:       Table name
+    :param document:    Document
+    """
+
+    get_write_buffer().add(table, document)
+
+
+def flush_writes():
+    """
+    Write all queued documents (See 'WriteBuffer')
+    """
+
+    if write_buffer:
+        write_buffer.flush()
+
 
 def connect():
     """
     Create database connection (object).
     This is NOT a connection pool and must be closed after use.
+    (See 'checkout' for pooled connections)
 
     :return: Connection object
     """
@@ -96,9 +578,13 @@ def insert(table, payload, conflict="error"):
     if not DO_WRITE:
         return {"errors": ["dry run"], "first_error": "dry run"}
 
-    with connect() as connection:
-        query = r.table(table).insert(payload, conflict=conflict)
-        run = query.run(connection)
+    with checkout() as connection:
+        with metrics.timed("cache_write", table) as status:
+            query = r.table(table).insert(payload, conflict=conflict)
+            run = query.run(connection)
+
+            if run["errors"]:
+                status["status"] = "error"
 
         # Info
         log.info(
@@ -141,7 +627,7 @@ def update(table, document):
     if not DO_WRITE:
         return {"errors": ["dry run"], "first_error": "dry run"}
 
-    with connect() as connection:
+    with checkout() as connection:
         query = r.table(table).get(identifier)
         update = query.update(document)
         run = update.run(connection)
@@ -169,7 +655,10 @@ def update(table, document):
 def delete(table, uuid):
     """ delete an entry from cache
     """
-    with connect() as connection:
+    if not DO_WRITE:
+        return {"errors": ["dry run"], "first_error": "dry run"}
+
+    with checkout() as connection:
         query = r.table(table).get(uuid).delete()
         run = query.run(connection)
 
@@ -184,6 +673,38 @@ def delete(table, uuid):
         return run
 
 
+def delete_many(table, uuids, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Delete several documents in bulk (one query per batch of identifiers)
+
+    :param table:       Table name
+    :param uuids:       List of identifiers
+    :param batch_size:  Amount of documents deleted per query
+
+    :return:            Returns the amount of deleted documents
+    """
+
+    if not DO_WRITE:
+        return 0
+
+    deleted = 0
+
+    with checkout() as connection:
+        for index in range(0, len(uuids), batch_size):
+            keys = uuids[index:index + batch_size]
+            run = r.table(table).get_all(*keys).delete().run(connection)
+            deleted += run["deleted"]
+
+    log.info(
+        "{table}: deleted {deleted} documents".format(
+            table=table,
+            deleted=deleted
+        )
+    )
+
+    return deleted
+
+
 def get(table, uuid):
     """
     Parent function to retrieve a specific document by 'id'.
@@ -194,9 +715,16 @@ def get(table, uuid):
     :return:       Returns either a document or 'None'
     """
 
-    with connect() as connection:
-        query = r.table(table).get(uuid)
-        run = query.run(connection)
+    # Documents waiting in the write-behind buffer are more recent
+    if write_buffer:
+        document = write_buffer.pending(table, uuid)
+        if document is not None:
+            return document
+
+    with checkout() as connection:
+        with metrics.timed("cache_get", table) as status:
+            run = r.table(table).get(uuid).run(connection)
+            status["status"] = "hit" if run is not None else "miss"
 
         # Debug
         log.debug(
@@ -226,9 +754,9 @@ def filter(table, **params):
     if not params:
         return None
 
-    with connect() as connection:
+    with checkout() as connection:
         query = r.table(table).filter(params)
-        result = query.run(connection)
+        result = list(query.run(connection))
 
         # Info
         log.info(
@@ -241,47 +769,237 @@ def filter(table, **params):
         return result
 
 
-def get_latest_import_interval():
-    _import = list(r.table("imports").order_by(
+def is_full_import(_import):
+    """
+    Imports are either full or incremental (field: 'mode')
+    Imports without a mode are full imports.
+    """
+    return _import["mode"].default("full").eq("full")
+
+
+def get_latest_import(full=False):
+    """
+    Get the latest finished import (See 'import_client.run_import')
+
+    :param full:    Only consider full imports
+
+    :return:        Returns the import document or None
+    """
+
+    query = r.table("imports").order_by(
         index=r.desc("id")
-    ).limit(1).run(connect()))[0]
+    ).filter(
+        lambda _import: _import["ended"].default(None).ne(None)
+    )
+
+    if full:
+        query = query.filter(is_full_import)
+
+    with checkout() as connection:
+        imports = list(query.limit(1).run(connection))
+
+    if not imports:
+        return None
+
+    return imports[0]
+
+
+def get_latest_import_interval():
+    """
+    Interval of the latest full import.
+    Incremental imports only refresh changed documents,
+    as such they cannot be used to tell current and obsolete documents apart.
+    """
+    with checkout() as connection:
+        _import = list(r.table("imports").order_by(
+            index=r.desc("id")
+        ).filter(is_full_import).limit(1).run(connection))[0]
+
     if not _import["ended"]:
         raise ValueError("Latest import is not finished")
     else:
         return _import["started"], _import["ended"]
 
 
+def start_export(resume=False):
+    """
+    Begin (or resume) an export run (See 'export_client.export_everything')
+    The progress of a run is recorded in a table 'exports':
+
+        {
+            "id": <start time>,
+            "started": <start time>,
+            "ended": None,
+            "cursor": <id of the last exported kunderolle>,
+            "exported": <amount of exported kunderolles>
+        }
+
+    Kunderolles are exported in the order of their 'id',
+    as such all kunderolles up to and including the cursor are exported.
+
+    :param resume:  Resume the latest unfinished run (if any)
+
+    :return:        Returns the export document
+    """
+
+    with checkout() as connection:
+        if resume:
+            unfinished = list(
+                r.table("exports").order_by(
+                    index=r.desc("id")
+                ).limit(1).filter(
+                    lambda export: export["ended"].default(None).eq(None)
+                ).run(connection)
+            )
+
+            if unfinished:
+                return unfinished[0]
+
+        started = r.now().run(connection)
+
+    return {
+        "id": started.strftime("%Y%m%dT%H%M%S"),
+        "started": started,
+        "ended": None,
+        "cursor": None,
+        "exported": 0
+    }
+
+
+def save_export(export):
+    """
+    Record the progress of an export run (See 'start_export')
+    The checkpoint is written durably, once the documents
+    exported so far have been written (See 'flush_writes').
+
+    :param export:  Export document
+    """
+
+    if not DO_WRITE:
+        return
+
+    with checkout() as connection:
+        r.table("exports").insert(
+            export,
+            conflict="update",
+            durability="hard"
+        ).run(connection)
+
+
+def iter_kunderolles(after=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream all kunderolles ordered by 'id' (primary index).
+
+    :param after:       Only kunderolles after this 'id' (export cursor)
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
+    """
+
+    query = r.table("ava_kunderolles").between(
+        after if after is not None else r.minval,
+        r.maxval,
+        left_bound="open" if after is not None else "closed"
+    ).order_by(index="id")
+
+    return iter_query(query, batch_size=batch_size)
+
+
+def queue_export_retry(kunderolle_ref, failed, export_id):
+    """
+    Queue a kunderolle for a retry, as some of its entities
+    could not be created in CRM ('external_ref' is False).
+    The queue is drained at the end of each export run.
+
+    :param kunderolle_ref:  Kunderolle identifier
+    :param failed:          Identifiers of the failed entities
+    :param export_id:       Identifier of the export run
+    """
+
+    write_behind("export_retries", {
+        "id": kunderolle_ref,
+        "failed": failed,
+        "export": export_id
+    })
+
+
 def all_obsolete(table):
     """
         only return the objects that were not
         refreshed during the latest import
-        isinstance datetime because really
-        obsolete objects has updated be a string
+        'updated' is not a datetime on really
+        obsolete objects (untimed index)
+    """
+    return list(iter_obsolete(table))
+
+
+def iter_obsolete(table, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Streaming variant of 'all_obsolete'.
+
+    :param table:       Table name
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
     """
     started, ended = get_latest_import_interval()
-    return [
-        x for x in all(table)
-        if (
-            not isinstance(x["updated"], datetime.datetime)
-            or x["updated"] < started
-        )
-    ]
+
+    query = r.table(table).between(
+        BEGINNING_OF_TIME, started, index=UPDATED_INDEX
+    ).union(
+        r.table(table).get_all(True, index=UNTIMED_INDEX)
+    )
+
+    return iter_query(query, batch_size=batch_size)
 
 
 def all_current(table):
     """  only return the objects that were
          refreshed during the latest import
-         isinstance datetime because really
-         obsolete objects has updated be a string
+         (range query on the 'updated' index)
+    """
+    return list(iter_current(table))
+
+
+def iter_current(table, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Streaming variant of 'all_current'.
+
+    :param table:       Table name
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
     """
     started, ended = get_latest_import_interval()
-    return [
-        x for x in all(table)
-        if (
-            isinstance(x["updated"], datetime.datetime)
-            and x["updated"] > started
+
+    query = r.table(table).between(
+        started, END_OF_TIME, index=UPDATED_INDEX, left_bound="open"
+    )
+
+    return iter_query(query, batch_size=batch_size)
+
+
+def iter_unexported(table, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream documents which need to be exported,
+    i.e. documents not yet created in CRM or documents where the payload
+    has changed since the last export ('data_hash' != 'exported_hash').
+
+    :param table:       Table name
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
+    """
+
+    query = r.table(table).filter(
+        lambda document: document["external_ref"].default(False).not_().or_(
+            document["data_hash"].default(None).ne(
+                document["exported_hash"].default(None)
+            )
         )
-    ]
+    )
+
+    return iter_query(query, batch_size=batch_size)
 
 
 def all(table):
@@ -290,32 +1008,60 @@ def all(table):
     The underlying method returns a cursor.
 
     For compatibility reasons this function returns a full list of documents.
+    Use 'iter_all' to stream large tables.
 
     :param table:   Table name
     :return:        A list of documents (or None), e.g.
                     [<document1>, <document2>, <document3>...]
     """
 
-    with connect() as connection:
-        query = r.table(table)
-        run = query.run(connection)
+    return list(iter_all(table))
 
-        # Info
-        log.info(
-            "Retrieving all documents from {table}".format(
-                table=table
-            )
+
+def iter_all(table, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Parent function to stream all documents from a specific table.
+
+    Documents are fetched from the cursor in batches of 'batch_size',
+    as such only a single batch is held in memory at a time.
+
+    :param table:       Table name
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
+    """
+
+    # Info
+    log.info(
+        "Retrieving all documents from {table}".format(
+            table=table
         )
+    )
 
-        # Temporary result list
-        result = []
+    return iter_query(r.table(table), batch_size=batch_size)
 
-        # Temporarily returning a full list for compatibility
-        # TODO: Must be reworked
-        for item in run:
-            result.append(item)
 
-        return result
+def iter_query(query, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run a query and stream the resulting documents.
+
+    Please note that a pooled connection is checked out
+    until the generator is exhausted or closed.
+
+    :param query:       RethinkDB query (returning a sequence)
+    :param batch_size:  Amount of documents fetched per round-trip
+
+    :return:            Returns a generator (iterator) of documents
+    """
+
+    with checkout() as connection:
+        cursor = query.run(connection, max_batch_rows=batch_size)
+
+        try:
+            for item in cursor:
+                yield item
+        finally:
+            cursor.close()
 
 
 def find_address(uuid):
@@ -343,12 +1089,295 @@ def find_indsats(uuid):
     :param uuid:    Document identifier (Type: uuid)
     :return:        Returns either empty list or list of documents
     """
-    documents = r.table("ava_aftales").get_all(
-        uuid, index="interessefaellesskab_ref"
-        ).run(connect())
+    with checkout() as connection:
+        documents = r.table("ava_aftales").get_all(
+            uuid, index="interessefaellesskab_ref"
+            ).limit(1).run(connection)
+
+        for d in documents:
+            return d
+
+
+def get_many(table, uuids, index=None):
+    """
+    Parent function to retrieve several documents in a single query.
+
+    :param table:   Table name (required)
+    :param uuids:   List of identifiers
+    :param index:   Optionally look up by secondary index instead of 'id'
+
+    :return:        Returns a list of documents
+                    (Identifiers which are not found are left out)
+    """
+
+    # Remove empty references and duplicates
+    keys = list(set(uuid for uuid in uuids if uuid))
+
+    if not keys:
+        return []
+
+    with checkout() as connection:
+        if index:
+            query = r.table(table).get_all(*keys, index=index)
+        else:
+            query = r.table(table).get_all(*keys)
+
+        with metrics.timed("cache_get_many", table):
+            return list(query.run(connection))
+
+
+def prefetch_export_graph(kunderolles):
+    """
+    Resolve a batch of kunderolles and all related documents,
+    using a few bulk queries rather than one query per document.
+
+    The graph is used by the export client as an in-memory lookup
+    (See export_client.process).
+
+    :param kunderolles: List of kunderolle documents
+
+    :return:            Returns a dictionary of documents by table and id.
+                        Aftales are also mapped by interessefaellesskab_ref
+                        under the key 'indsats'.
+                        Example:
+                        {
+                            "contacts": {<id>: <document>},
+                            "accounts": {<id>: <document>},
+                            ...
+                            "indsats": {<interessefaellesskab_ref>: <aftale>}
+                        }
+    """
+
+    graph = {}
+
+    def add(table, documents, key="id"):
+        graph.setdefault(table, {})
+        for document in documents:
+            # Only the first match is used (See 'find_indsats')
+            graph[table].setdefault(document[key], document)
+
+    contact_refs = [k.get("contact_ref") for k in kunderolles]
+    account_refs = [k.get("interessefaellesskab_ref") for k in kunderolles]
+
+    add("contacts", get_many("contacts", contact_refs))
+    add("accounts", get_many("accounts", account_refs))
+    add(
+        "indsats",
+        get_many(
+            "ava_aftales", account_refs, index="interessefaellesskab_ref"
+        ),
+        key="interessefaellesskab_ref"
+    )
+
+    contacts = graph["contacts"].values()
+    accounts = graph["accounts"].values()
+    aftales = graph["indsats"].values()
+
+    add(
+        "ava_installations",
+        get_many("ava_installations", [a.get("klasse_ref") for a in aftales])
+    )
+
+    installations = graph["ava_installations"].values()
+
+    address_refs = (
+        [c.get("dawa_ref") for c in contacts] +
+        [a.get("dawa_ref") for a in accounts] +
+        [a.get("dawa_ref") for a in aftales]
+    )
+
+    access_refs = (
+        [a.get("dawa_ref") for a in accounts] +
+        [i.get("dawa_ref") for i in installations]
+    )
+
+    add("ava_adresses", get_many("ava_adresses", address_refs))
+    add("access", get_many("access", access_refs))
+
+    return graph
+
+
+def queue_export(table, uuids):
+    """
+    Queue documents which have changed on import for export.
+    Each document is queued once (the latest time is kept).
+
+    The time is taken when the document is queued (client clock),
+    not when the write buffer is flushed.
+
+    :param table:   Table name
+    :param uuids:   List of identifiers
+    """
+
+    for uuid in uuids:
+        write_behind("export_queue", {
+            "id": "{table}:{uuid}".format(table=table, uuid=uuid),
+            "table": table,
+            "ref": uuid,
+            EXPORT_QUEUE_INDEX: datetime.now(timezone.utc)
+        })
+
+
+def iter_export_queue(until, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream the export queue (See 'queue_export')
+
+    :param until:       Only entries queued before this time
+    :param batch_size:  Amount of entries fetched per round-trip
+
+    :return:            Returns a generator (iterator) of entries
+    """
+
+    query = r.table("export_queue").between(
+        r.minval, until, index=EXPORT_QUEUE_INDEX
+    ).order_by(index=EXPORT_QUEUE_INDEX)
+
+    return iter_query(query, batch_size=batch_size)
+
+
+def clear_export_queue(until):
+    """
+    Remove the entries which have been exported from the export queue.
+    Entries queued again since (e.g. by a concurrent import) are kept.
+
+    :param until:   Remove entries queued before this time
+    """
+
+    if not DO_WRITE:
+        return
+
+    with checkout() as connection:
+        result = r.table("export_queue").between(
+            r.minval, until, index=EXPORT_QUEUE_INDEX
+        ).delete(durability="soft").run(connection)
+
+    log.info("Export queue cleared: {deleted} entries".format(**result))
+
+
+def affected_kunderolles(changed):
+    """
+    Resolve the kunderolles which depend on a set of changed documents,
+    using the reverse reference indexes (See 'REFERENCE_INDEXES').
+
+    :param changed: Dictionary of changed identifiers by table, e.g.
+                    {
+                        "contacts": {<id>, <id>},
+                        "ava_adresses": {<id>}
+                    }
+
+    :return:        Returns list of kunderolle documents (ordered by 'id')
+    """
+
+    def refs(documents, key="id"):
+        return set(document.get(key) for document in documents)
+
+    kunderolle_refs = set(changed.get("ava_kunderolles", ()))
+    contact_refs = set(changed.get("contacts", ()))
+    account_refs = set(changed.get("accounts", ()))
+    installation_refs = set(changed.get("ava_installations", ()))
+    address_refs = (
+        set(changed.get("ava_adresses", ())) | set(changed.get("access", ()))
+    )
+
+    aftales = get_many("ava_aftales", changed.get("ava_aftales", ()))
+
+    # Addresses are referenced by contacts, accounts, aftales
+    # and (access addresses) installations
+    if address_refs:
+        contact_refs |= refs(
+            get_many("contacts", address_refs, index="dawa_ref")
+        )
+        account_refs |= refs(
+            get_many("accounts", address_refs, index="dawa_ref")
+        )
+        installation_refs |= refs(
+            get_many("ava_installations", address_refs, index="dawa_ref")
+        )
+        aftales += get_many("ava_aftales", address_refs, index="dawa_ref")
+
+    # Installations are referenced by aftales
+    if installation_refs:
+        aftales += get_many(
+            "ava_aftales", installation_refs, index="klasse_ref"
+        )
+
+    # Aftales are linked to kunderolles through the account
+    account_refs |= refs(aftales, "interessefaellesskab_ref")
+
+    kunderolles = (
+        get_many("ava_kunderolles", kunderolle_refs) +
+        get_many("ava_kunderolles", contact_refs, index="contact_ref") +
+        get_many(
+            "ava_kunderolles", account_refs, index="interessefaellesskab_ref"
+        )
+    )
+
+    unique = {kunderolle["id"]: kunderolle for kunderolle in kunderolles}
+
+    return [unique[uuid] for uuid in sorted(unique)]
+
+
+def is_pending_export(change):
+    """
+    Check if a change (changefeed) may need to be exported.
+
+    Changes made by the export itself (e.g. the CRM reference
+    and the hashes) leave the document in sync with CRM,
+    i.e. the payload matches the payload last exported.
+    Documents which could not be created in CRM ('external_ref' is False)
+    are retried by the export (See 'queue_export_retry').
+    Deletions are handled by the purge.
+
+    :param change:  Change object {"old_val": ..., "new_val": ...}
+
+    :return:        Returns True if the change should be exported
+    """
+
+    old = change.get("old_val") or {}
+    new = change.get("new_val")
+
+    if not new or new.get("external_ref") is False:
+        return False
+
+    if not new.get("external_ref"):
+        return True
+
+    if new.get("data_hash") != new.get("exported_hash"):
+        return True
+
+    # References to other documents have changed
+    return any(old.get(key) != new.get(key) for key in REFERENCE_FIELDS)
+
+
+def follow_changes(tables=FOLLOWED_TABLES):
+    """
+    Subscribe to the changefeeds of a list of tables.
+    A dedicated connection (not pooled) is held by the changefeed.
+
+    Please note that iterating the changefeed blocks until changes arrive
+    and that the changefeed never ends (unless the connection is lost).
+
+    :param tables:  List of table names
+
+    :return:        Returns a generator (iterator) of (table, change)
+    """
+
+    def feed(table):
+        return r.table(table).changes().map(
+            lambda change: change.merge({"table": table})
+        )
+
+    feeds = [feed(table) for table in tables]
+
+    query = feeds[0].union(*feeds[1:])
+
+    connection = connect()
 
-    for d in documents:
-        return d
+    try:
+        for change in query.run(connection):
+            yield change.pop("table"), change
+    finally:
+        connection.close()
 
 
 def store(resource, payload):
@@ -2,13 +2,21 @@
 
 import os
 import time
+import email.utils
+import collections
 import json
 import adal
 import requests
 import re
+import threading
+import metrics
 
+from uuid import uuid4
 from logging import getLogger
-from helper import get_config
+from helper import get_config, pipeline
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlsplit
+from requests.packages.urllib3.util.retry import Retry
 
 # If this is set to True, the agent will not write anything to CRM.
 DO_WRITE = False
@@ -45,9 +53,12 @@ CRM_REST_API_PATH = config["crm_rest_api_path"]
 log = getLogger(__name__)
 
 # Request timeout workaround
-# Setting retry attempts to 15
+# Setting retry attempts to 15 (connection errors, with backoff)
+# Throttled responses are handled by the rate limiter (See 'RateLimiter')
 session = requests.Session()
-adapter = requests.adapters.HTTPAdapter(max_retries=15)
+adapter = requests.adapters.HTTPAdapter(
+    max_retries=Retry(total=15, backoff_factor=0.5)
+)
 session.mount('http://', adapter)
 session.mount('https://', adapter)
 requests = session
@@ -58,15 +69,47 @@ base_endpoint = "{resource}/{path}".format(
     path=CRM_REST_API_PATH
 )
 
-# Temporary file containing token
-# It may be better to store the token in a global variable
+# Maximum number of operations in a single $batch request
+# (Limit enforced by the Dynamics 365 Web API)
+BATCH_MAX_SIZE = 1000
+
+# Service protection limits
+# Requests per second (the limiter adapts between the min and max rate)
+CRM_MAX_RATE = config.getfloat("crm_max_rate", fallback=20)
+CRM_MIN_RATE = config.getfloat("crm_min_rate", fallback=1)
+
+# Concurrent requests
+CRM_MAX_CONCURRENCY = config.getint("crm_max_concurrency", fallback=50)
+
+# Throttled requests are retried after the Retry-After period
+THROTTLED = (429, 503)
+THROTTLED_RETRIES = config.getint("crm_throttled_retries", fallback=5)
+RETRY_AFTER_DEFAULT = 5
+
+# Entities per page when enumerating an entity set (See 'iter_entities')
+CRM_PAGE_SIZE = config.getint("crm_page_size", fallback=5000)
+
+# Primary key (identifier) by entity set
+ENTITY_IDENTIFIERS = {
+    "contacts": "contactid",
+    "accounts": "accountid",
+    "ava_adresses": "ava_adresseid",
+    "ava_aftales": "ava_aftaleid",
+    "ava_kunderolles": "ava_kunderolleid",
+    "ava_installations": "ava_installationid",
+}
+
+# File containing the current token (shared between processes)
 filename = "access_token.tmp"
 
+# Refresh the token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = config.getint("crm_token_refresh_margin", fallback=300)
+
 
 # Request header information
 # These are the default values
-# An authorization header must be added on each request
-headers = {
+# An authorization header is added on each request
+default_headers = {
     "OData-MaxVersion": "4.0",
     "OData-Version": "4.0",
     "Accept": "application/json",
@@ -88,182 +131,497 @@ class DummyRequest:
         return {self.json_field: str(uuid4())}
 
 
-def get_token():
+class RateLimiter(object):
+    """
+    Request limiter shared by all threads (token bucket).
+
+    Dynamics CRM enforces service protection limits
+    (requests per time window and concurrent requests per user).
+    When a limit is hit the service responds with 429 (or 503)
+    and a Retry-After header.
+
+    The request rate is adapted (AIMD):
+    It is increased slowly while requests succeed
+    and halved whenever a request is throttled.
+    A throttled response also pauses all requests
+    for the period given by Retry-After.
     """
-    Get generated token from file.
 
-    The token is stored in a temporary file
-    which can be accessed globally.
+    def __init__(
+            self,
+            max_rate=CRM_MAX_RATE,
+            min_rate=CRM_MIN_RATE,
+            max_concurrency=CRM_MAX_CONCURRENCY,
+            window=60
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.window = window
+
+        # Concurrent requests
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+
+        # Token bucket (holds at most a second worth of requests)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+        # Metrics
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.sent = collections.deque()
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+
+        self.slots.acquire()
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                self.tokens = min(
+                    max(self.rate, 1.0),
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                wait = self.paused_until - now
+
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.max_in_flight = max(
+                        self.max_in_flight,
+                        self.in_flight
+                    )
+                    self.requests += 1
+                    self.sent.append(now)
+                    return
+
+                if wait <= 0:
+                    wait = (1 - self.tokens) / self.rate
+
+                self.waited += wait
+
+            time.sleep(wait)
+
+    def release(self, response=None):
+        """
+        Adapt the request rate to the response
+
+        :param response:    Response or None (if the request failed)
+        """
+
+        with self.lock:
+            self.in_flight -= 1
+
+            if response is not None and response.status_code in THROTTLED:
+                delay = retry_after(response)
+
+                self.throttled += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = 0
+                self.paused_until = max(
+                    self.paused_until,
+                    time.monotonic() + delay
+                )
+
+                log.warning(
+                    "Throttled by CRM ({status}), pausing {delay} seconds, "
+                    "rate lowered to {rate:.1f} requests per second".format(
+                        status=response.status_code,
+                        delay=delay,
+                        rate=self.rate
+                    )
+                )
+
+            elif response is not None:
+                # Increase by 1 request per second
+                # for each second of successful requests
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+        self.slots.release()
+
+    def metrics(self):
+        """
+        :return:    Returns the current limiter state (dictionary)
+        """
+
+        with self.lock:
+            now = time.monotonic()
+
+            while self.sent and self.sent[0] < now - self.window:
+                self.sent.popleft()
+
+            return {
+                "rate_limit": self.rate,
+                "request_rate": len(self.sent) / self.window,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "waited": self.waited,
+            }
+
+    def summary(self):
+        """
+        :return:    Returns a summary of the metrics (string)
+        """
+
+        return (
+            "CRM requests: {requests} ({throttled} throttled), "
+            "{request_rate:.1f} per second (limit {rate_limit:.1f}), "
+            "max {max_in_flight} concurrent, "
+            "waited {waited:.1f} seconds".format(**self.metrics())
+        )
 
-    This is a temporary solution
-    to reduce the amount of requests for tokens.
 
-    :return:    Returns access token
+def retry_after(response):
     """
+    Get the Retry-After period of a throttled response.
 
-    # If the file does not exist, generate it
-    if not os.path.isfile(filename):
-        request_token()
+    :param response:    Response object
 
-    # Read the file and return the token
-    with open(filename, "r") as token:
-        return token.read()
+    :return:            Returns number of seconds to wait
+    """
 
+    value = response.headers.get("Retry-After")
 
-def request_token():
+    if not value:
+        return RETRY_AFTER_DEFAULT
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    # Retry-After may also be a HTTP date
+    try:
+        until = email.utils.parsedate_to_datetime(value)
+        return max(until.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return RETRY_AFTER_DEFAULT
+
+
+limiter = RateLimiter()
+
+
+class TokenManager(object):
     """
-    If no valid token exists,
-    A new token can be requested from the OAUTH REST Service.
+    Keeps the OAUTH access token (and its expiry) in memory.
+
+    The token is refreshed shortly before it expires.
+    Concurrent threads share the same token,
+    a lock ensures that only one of them requests a new token.
+
+    The token is also written to a file,
+    so that other processes (e.g. the cli token command)
+    can reuse it rather than requesting a new one.
+    """
+
+    def __init__(self, filename, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.filename = filename
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+
+        self.access_token = None
+        self.expires = 0
+
+    def is_valid(self):
+        return (
+            self.access_token and
+            time.time() < self.expires - self.refresh_margin
+        )
+
+    def get(self):
+        """
+        :return:    Returns a valid access token
+        """
+
+        if self.is_valid():
+            return self.access_token
+
+        with self.lock:
+            # Another thread may have refreshed the token meanwhile
+            if self.is_valid():
+                return self.access_token
+
+            if not self.load():
+                self.request()
+
+            return self.access_token
+
+    def refresh(self, rejected=None):
+        """
+        Request a new token, e.g. after the service has rejected it (401)
+
+        :param rejected:    The rejected token, if another thread has
+                            already replaced it, no new token is requested
+
+        :return:            Returns a valid access token
+        """
+
+        with self.lock:
+            if rejected is None or self.access_token == rejected:
+                self.request()
+
+            return self.access_token
+
+    def load(self):
+        """
+        Read a token stored by another process
+
+        :return:    Returns True if a valid token was found
+        """
+
+        try:
+            with open(self.filename, "r") as file:
+                stored = json.load(file)
+
+            self.access_token = stored["accessToken"]
+            self.expires = float(stored["expires"])
+
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+
+        return bool(self.is_valid())
+
+    def request(self):
+        """
+        Request a new token from the OAUTH REST Service.
+
+        The service provider must add the correct privileges
+        in order to to grant read/write access.
 
-    The service provider must add the correct privileges
-    in order to to grant read/write access.
+        E.g.
+        In previous scenarios a token was granted, however with no privileges,
+        we were unable to retrieve any information from the REST API.
 
-    E.g.
-    In previous scenarios a token was granted, however with no privileges,
-    we were unable to retrieve any information from the REST API.
+        :return:    Returns newly generated token or False
+        """
 
-    :return:    Returns newly generated token or False
+        # Combine OUATH endpoint and tenant id for full endpoint URL
+        authority_url = "{url}/{tenant}".format(
+            url=CRM_ENDPOINT,
+            tenant=CRM_TENANT
+        )
+
+        # Connect and authenticate using the ADAL library
+        context = adal.AuthenticationContext(
+            authority_url,
+            validate_authority=CRM_TENANT != "adfs",
+            api_version=None
+        )
+
+        requested = time.time()
+
+        token = context.acquire_token_with_client_credentials(
+            CRM_RESOURCE,
+            CRM_CLIENT_ID,
+            CRM_CLIENT_SECRET
+        )
+
+        if not token:
+            return False
+
+        self.access_token = token.get("accessToken")
+        self.expires = requested + int(token.get("expiresIn", 0))
+
+        log.info("Generated a new token (expires in {0} seconds)".format(
+            token.get("expiresIn")
+        ))
+
+        # Share token with other processes
+        # (Written to a temporary file first, the rename is atomic)
+        temporary = "{0}.{1}".format(self.filename, os.getpid())
+
+        with open(temporary, "w") as file:
+            json.dump(
+                {"accessToken": self.access_token, "expires": self.expires},
+                file
+            )
+
+        os.replace(temporary, self.filename)
+
+        return token
+
+
+token_manager = TokenManager(filename)
+
+
+def get_token():
     """
+    Get the current access token (See 'TokenManager')
 
-    # Combine OUATH endpoint and tenant id for full endpoint URL
-    authority_url = "{url}/{tenant}".format(
-        url=CRM_ENDPOINT,
-        tenant=CRM_TENANT
-    )
+    :return:    Returns access token
+    """
 
-    # Connect and authenticate using the ADAL library
-    context = adal.AuthenticationContext(
-        authority_url,
-        validate_authority=CRM_TENANT != "adfs",
-        api_version=None
-    )
+    return token_manager.get()
 
-    token = context.acquire_token_with_client_credentials(
-        CRM_RESOURCE,
-        CRM_CLIENT_ID,
-        CRM_CLIENT_SECRET
-    )
 
-    if not token:
-        return False
+def request_token():
+    """
+    Request a new access token (See 'TokenManager')
 
-    # Write token to temporary file
-    with open(filename, "w") as file:
-        file.write(token.get("accessToken"))
+    :return:    Returns access token
+    """
 
-    return token
+    return token_manager.refresh()
 
 
-def get_request(resource, **params):
+def send(method, resource, headers=None, **kwargs):
     """
-    Generic GET request.
+    Generic request.
 
-    (Primiarily used by child/wrapper functions)
+    (Primiarily used by the request functions below)
 
     If the token header is invalid or the token is expired,
     a new token is requested and the original request is performed once more.
 
+    :param method:      HTTP method (GET, POST, PATCH, DELETE)
+
     :param resource:    Resource (resource path),
                         e.g. 'contacts', 'ava_adresses' etc.
+                        or an absolute url (e.g. '@odata.nextLink')
 
-    :param params:      Query parameters
+    :param headers:     Optional headers (added to the default headers)
+
+    :param kwargs:      Passed to the request (e.g. params, json, data)
 
     :return:            Returns full response object
     """
 
-    headers["Authorization"] = get_token()
+    request_headers = dict(default_headers)
+    request_headers.update(headers or {})
 
-    service_url = "{base}/{resource}".format(
-        base=base_endpoint,
-        resource=resource
-    )
+    if resource.startswith(("https://", "http://")):
+        service_url = resource
+    else:
+        service_url = "{base}/{resource}".format(
+            base=base_endpoint,
+            resource=resource
+        )
 
-    response = requests.get(
-        url=service_url,
-        headers=headers,
-        params=params
-    )
+    token = get_token()
+    request_headers["Authorization"] = token
+
+    started = time.monotonic()
+
+    response = limited_request(method, service_url, request_headers, **kwargs)
 
     if response.status_code == 401:
         log.warning("HTTP Response: {0}".format(response.status_code))
 
-        # Generate a new token
+        # Generate a new token (unless another thread already has)
         log.info("Generating a new token")
-        request_token()
-
-        # Sleep 10 seconds
-        time.sleep(10)
-
-        # Set generated token into the auth header
-        headers["Authorization"] = get_token()
+        request_headers["Authorization"] = token_manager.refresh(token)
 
         # Perform the request again
-        response = requests.get(
-            url=service_url,
-            headers=headers,
-            params=params
+        response = limited_request(
+            method,
+            service_url,
+            request_headers,
+            **kwargs
         )
 
+    metrics.observe(
+        stage="crm_{0}".format(method.lower()),
+        entity=resource_entity(resource),
+        status=response.status_code,
+        seconds=time.monotonic() - started
+    )
+
     # TODO: implement method to stop the application,
     # if 401 has not been resolved.
-    log.debug("GET Request: ")
+    log.debug("{0} Request: ".format(method))
     log.debug(response.text)
     return response
 
 
-def post_request(resource, payload):
+def resource_entity(resource):
     """
-    Generic POST request
+    Get the entity set of a resource (metrics label)
 
-    (Primiarily used by child/wrapper functions)
+    :param resource:    Resource path or absolute url,
+                        e.g. 'contacts(<guid>)/ava_aktoerens_aftaler/$ref'
 
-    If the token header is invalid or the token is expired,
-    a new token is requested and the original request is performed once more.
+    :return:            Returns entity set, e.g. 'contacts'
+    """
 
-    :param resource:    Resource (resource path),
-                        e.g. 'contacts', 'ava_adresses' etc
+    if resource.startswith(("https://", "http://")):
+        path = urlsplit(resource).path
+        resource = path.rsplit("/", 1)[-1]
 
-    :param payload:     Payload (dictionary)
+    return re.split(r"[(/?]", resource, 1)[0]
 
-    :return:            Returns full response object
+
+def limited_request(method, url, headers, **kwargs):
     """
+    Perform a request through the rate limiter.
 
-    headers["Authorization"] = get_token()
+    Throttled requests (429/503) are retried
+    once the Retry-After period has passed (See 'RateLimiter').
 
-    service_url = "{base}/{resource}".format(
-        base=base_endpoint,
-        resource=resource
-    )
+    :return:    Returns full response object
+    """
 
-    response = requests.post(
-        url=service_url,
-        headers=headers,
-        json=payload
-    )
+    for attempt in range(THROTTLED_RETRIES + 1):
+        limiter.acquire()
 
-    if response.status_code == 401:
-        log.warning("HTTP Response: {0}".format(response.status_code))
+        response = None
 
-        # Generate a new token
-        log.info("Generating a new token")
-        request_token()
+        try:
+            response = requests.request(
+                method,
+                url=url,
+                headers=headers,
+                **kwargs
+            )
+        finally:
+            limiter.release(response)
 
-        # Sleep 10 seconds
-        time.sleep(10)
+        if response.status_code not in THROTTLED:
+            break
 
-        # Set new token into the auth header
-        headers["Authorization"] = get_token()
+    return response
 
-        # Perform the request again
-        response = requests.post(
-            url=service_url,
-            headers=headers,
-            json=payload
-        )
 
-    log.debug("POST Request: ")
-    log.debug(response.text)
-    return response
+def get_request(resource, **params):
+    """
+    Generic GET request.
+
+    :param resource:    Resource (resource path),
+                        e.g. 'contacts', 'ava_adresses' etc.
+
+    :param params:      Query parameters
+
+    :return:            Returns full response object
+    """
+
+    return send("GET", resource, params=params)
+
+
+def post_request(resource, payload):
+    """
+    Generic POST request
+
+    :param resource:    Resource (resource path),
+                        e.g. 'contacts', 'ava_adresses' etc
+
+    :param payload:     Payload (dictionary)
+
+    :return:            Returns full response object
+    """
+
+    return send("POST", resource, json=payload)
 
 
 def patch_request(resource, payload):
@@ -273,8 +631,6 @@ def patch_request(resource, payload):
     A patch request can be used to update existing objects,
     or alternatively import new objects (with a predefined identifier).
 
-    (Primiarily used by child/wrapper functions)
-
     Please note that the identifier
      should be passed in as part of the resource.
 
@@ -288,43 +644,7 @@ def patch_request(resource, payload):
     :return:            Returns full response object
     """
 
-    # Set token into authorization header
-    headers["Authorization"] = get_token()
-
-    service_url = "{base}/{resource}".format(
-        base=base_endpoint,
-        resource=resource
-    )
-
-    response = requests.patch(
-        url=service_url,
-        headers=headers,
-        json=payload
-    )
-
-    if response.status_code == 401:
-        log.warning("HTTP Response: {0}".format(response.status_code))
-
-        # Generate a new token
-        log.info("Generating a new token")
-        request_token()
-
-        # Sleep 10 seconds
-        time.sleep(10)
-
-        # Set new token into the auth header
-        headers["Authorization"] = get_token()
-
-        # Perform the request again
-        response = requests.patch(
-            url=service_url,
-            headers=headers,
-            json=payload
-        )
-
-    log.debug("PATCH Request: ")
-    log.debug(response.text)
-    return response
+    return send("PATCH", resource, json=payload)
 
 
 def delete_request(resource, identifier):
@@ -341,8 +661,6 @@ def delete_request(resource, identifier):
 
     Delete is development purposes only (e.g. to 'reset' the database)
 
-    (Primiarily used by child/wrapper functions)
-
     :param resource:    Resource (resource path)
 
     :param identifier:  MS Dynamics CRM object GUID
@@ -352,41 +670,554 @@ def delete_request(resource, identifier):
                         (Status code 204 on deletion)
     """
 
-    # Set token into authorization header
-    headers["Authorization"] = get_token()
+    return send(
+        "DELETE",
+        "{resource}({identifier})".format(
+            resource=resource,
+            identifier=identifier
+        )
+    )
 
-    service_url = "{base}/{resource}({identifier})".format(
-        base=base_endpoint,
-        resource=resource,
-        identifier=identifier
+
+def batch_request(body, boundary):
+    """
+    Generic $batch request (multipart/mixed)
+
+    (Primiarily used by the Batch class)
+
+    :param body:        Multipart request body (string)
+    :param boundary:    Batch boundary used in the body
+
+    :return:            Returns full response object
+    """
+
+    content_type = "multipart/mixed;boundary={0}".format(boundary)
+
+    return send(
+        "POST",
+        "$batch",
+        headers={"Content-Type": content_type},
+        data=body.encode("utf-8")
     )
 
-    response = requests.delete(
-        url=service_url,
-        headers=headers
+
+def iter_entities(resource, select, filter=None, page_size=CRM_PAGE_SIZE):
+    """
+    Enumerate all entities of an entity set (See 'iter_pages')
+
+    :return:            Returns a generator (iterator) of entities.
+    """
+
+    for page in iter_pages(resource, select, filter, page_size):
+        for entity in page:
+            yield entity
+
+
+def iter_pages(resource, select, filter=None, page_size=CRM_PAGE_SIZE):
+    """
+    Enumerate all entities of an entity set, page by page.
+    Only the selected fields are retrieved.
+
+    Pages are requested with the 'odata.maxpagesize' preference
+    and followed through '@odata.nextLink' until the last page.
+
+    :param resource:    Resource (entity set), e.g. 'contacts'
+    :param select:      List of fields, e.g. ['contactid']
+    :param filter:      Optional OData filter expression
+    :param page_size:   Maximum amount of entities per page
+
+    :return:            Returns a generator (iterator) of pages
+                        (lists of entities).
+                        Raises HTTPError if a page can not be retrieved,
+                        as such the enumeration is never silently incomplete.
+    """
+
+    params = {"$select": ",".join(select)}
+
+    if filter:
+        params["$filter"] = filter
+
+    headers = {
+        "Prefer": "odata.maxpagesize={0}".format(page_size)
+    }
+
+    url = resource
+
+    while url:
+        response = send("GET", url, headers=headers, params=params)
+        response.raise_for_status()
+
+        content = response.json()
+
+        yield content["value"]
+
+        # The next link contains the query parameters
+        url = content.get("@odata.nextLink")
+        params = None
+
+
+def id_ranges(identifier, partitions=16):
+    """
+    Split the identifiers (GUID) of an entity set
+    into a number of ranges (OData filter expressions).
+
+    The ranges are split on the last group of the GUID,
+    as it is the most significant group when GUIDs are compared
+    (SQL Server uniqueidentifier).
+
+    :param identifier:  Name of the identifier, e.g. 'contactid'
+    :param partitions:  Amount of ranges (at most 4096)
+
+    :return:            Returns list of filter expressions
+    """
+
+    bounds = [
+        "00000000-0000-0000-0000-{0:03x}000000000".format(
+            index * 4096 // partitions
+        )
+        for index in range(1, partitions)
+    ]
+
+    ranges = []
+
+    for index in range(partitions):
+        conditions = []
+
+        if index > 0:
+            conditions.append(
+                "{0} ge {1}".format(identifier, bounds[index - 1])
+            )
+
+        if index < len(bounds):
+            conditions.append(
+                "{0} lt {1}".format(identifier, bounds[index])
+            )
+
+        ranges.append(" and ".join(conditions))
+
+    return ranges
+
+
+def iter_entities_parallel(resource, select, filter=None, partitions=16,
+                           workers=4, page_size=CRM_PAGE_SIZE):
+    """
+    Enumerate all entities of an entity set (See 'iter_entities'),
+    scanning a number of identifier ranges concurrently.
+
+    The entities are yielded page by page as the ranges are scanned
+    (unordered). If a range can not be scanned, the enumeration raises.
+
+    :param resource:    Resource (entity set), e.g. 'contacts'
+    :param select:      List of fields (must include the identifier)
+    :param filter:      Optional OData filter expression
+    :param partitions:  Amount of identifier ranges (See 'id_ranges')
+    :param workers:     Amount of ranges scanned concurrently
+    :param page_size:   Maximum amount of entities per page
+
+    :return:            Returns a generator (iterator) of entities
+    """
+
+    identifier = ENTITY_IDENTIFIERS[resource]
+
+    def scan(id_range):
+        expression = id_range
+
+        if filter:
+            expression = "({0}) and {1}".format(filter, id_range)
+
+        return iter_pages(resource, select, expression, page_size)
+
+    # Errors are raised by the pipeline (See 'pipeline')
+    ranges = id_ranges(identifier, partitions)
+    pages = pipeline(ranges, [(scan, workers)], depth=workers)
+
+    for page in pages:
+        for entity in page:
+            yield entity
+
+
+def is_batch_reference(value):
+    """
+    Check if a value is a Content-ID reference, e.g. '$1'
+    (A reference to an entity created earlier in the same changeset)
+    """
+
+    return isinstance(value, str) and bool(re.match(r"^\$\d+$", value))
+
+
+def bind(resource, external_ref):
+    """
+    Create a lookup reference for '@odata.bind' fields.
+
+    :param resource:        Resource (entity set), e.g. 'contacts'
+    :param external_ref:    CRM object GUID or Content-ID reference
+
+    :return:                Returns lookup reference,
+                            e.g. '/contacts(<guid>)' or '$1'
+    """
+
+    if is_batch_reference(external_ref):
+        return external_ref
+
+    return "/{resource}({external_ref})".format(
+        resource=resource,
+        external_ref=external_ref
     )
 
-    if response.status_code == 401:
-        log.debug('Requesting token and retrying DELETE request')
 
-        # Generate a new token
-        request_token()
+class BatchResponse:
+    """Response to a single operation in a $batch request."""
 
-        # Sleep 10 seconds
-        time.sleep(10)
+    def __init__(self, status_code, headers=None, text=""):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.text = text
 
-        # Set new token into the auth header
-        headers["Authorization"] = get_token()
+    def __bool__(self):
+        return 200 <= self.status_code < 300
 
-        # Perform the request again
-        response = requests.delete(
-            url=service_url,
-            headers=headers
+    def json(self):
+        return json.loads(self.text) if self.text else {}
+
+    def entity_id(self):
+        """
+        :return:    Returns the GUID of a created entity or None
+        """
+
+        match = re.search(
+            r"\(([^)]+)\)$",
+            self.headers.get("OData-EntityId", "")
         )
 
-    log.debug("Delete Request: ")
-    log.debug(response.text)
-    return response
+        if not match:
+            return None
+
+        return match.group(1)
+
+
+def parse_batch_response(content_type, body):
+    """
+    Parse a multipart/mixed $batch response (including changesets).
+
+    :param content_type:    Content-Type header (containing the boundary)
+    :param body:            Response body (string)
+
+    :return:                Returns a dictionary of BatchResponse objects
+                            by Content-ID reference, e.g. {'$1': <response>}
+    """
+
+    responses = {}
+
+    boundary = re.search(r"boundary=([^;\s]+)", content_type).group(1)
+
+    for part in body.split("--{0}".format(boundary))[1:]:
+
+        # Closing boundary
+        if part.startswith("--"):
+            break
+
+        head, _, content = part.lstrip("\r\n").partition("\r\n\r\n")
+        part_headers = parse_headers(head)
+
+        # Changeset response
+        if "multipart/mixed" in part_headers.get("Content-Type", ""):
+            responses.update(
+                parse_batch_response(part_headers["Content-Type"], content)
+            )
+            continue
+
+        status_line, _, http_response = content.partition("\r\n")
+        http_head, _, text = http_response.partition("\r\n\r\n")
+        http_headers = parse_headers(http_head)
+
+        content_id = (
+            part_headers.get("Content-ID") or
+            http_headers.get("Content-ID")
+        )
+
+        if not content_id:
+            continue
+
+        responses["${0}".format(content_id)] = BatchResponse(
+            status_code=int(status_line.split()[1]),
+            headers=http_headers,
+            text=text.strip()
+        )
+
+    return responses
+
+
+def parse_headers(head):
+    """Parse header lines into a (case insensitive) dictionary."""
+
+    parsed = CaseInsensitiveDict()
+
+    for line in head.splitlines():
+        name, separator, value = line.partition(":")
+        if separator:
+            parsed[name.strip()] = value.strip()
+
+    return parsed
+
+
+class Batch:
+    """
+    Builder for OData $batch requests.
+
+    Operations are queued in changesets and sent in as few requests
+    as possible when the batch is flushed. A changeset is atomic,
+    either all or none of its operations are applied.
+
+    'add' returns a Content-ID reference (e.g. '$1') which may be used
+    by later operations in the same changeset, either as the resource
+    (e.g. '$1/ava_aktoerens_aftaler/$ref') or in bindings
+    (e.g. {"ava_adresse@odata.bind": "$1"}).
+
+    Example:
+
+        batch = Batch()
+        address = batch.add("POST", "ava_adresses", address_data)
+        contact_data["ava_adresse@odata.bind"] = address
+        batch.add("POST", "contacts", contact_data)
+        responses = batch.flush()
+    """
+
+    def __init__(self, max_size=BATCH_MAX_SIZE):
+        self.max_size = max_size
+        self.changesets = []
+        self.counter = 0
+
+        # Lookup references of created entities by Content-ID reference
+        self.resolved = {}
+
+    def __len__(self):
+        return sum(len(changeset) for changeset in self.changesets)
+
+    def changeset(self):
+        """
+        Start a new changeset.
+        Content-ID references can only be used within the same changeset.
+        """
+
+        self.changesets.append([])
+
+    def add(self, method, resource, payload=None, on_response=None):
+        """
+        Queue an operation in the current changeset.
+
+        :param method:      HTTP method (POST, PATCH, DELETE)
+        :param resource:    Resource path or Content-ID reference path
+        :param payload:     Payload (dictionary)
+        :param on_response: Optional callback,
+                            called with the BatchResponse after flush
+
+        :return:            Returns Content-ID reference, e.g. '$1'
+        """
+
+        if not self.changesets:
+            self.changeset()
+
+        if len(self.changesets[-1]) >= self.max_size:
+            raise ValueError(
+                "Changeset exceeds {0} operations".format(self.max_size)
+            )
+
+        self.counter += 1
+
+        reference = "${0}".format(self.counter)
+
+        self.changesets[-1].append({
+            "content_id": self.counter,
+            "reference": reference,
+            "method": method,
+            "resource": resource,
+            "payload": payload,
+            "on_response": on_response
+        })
+
+        return reference
+
+    def resolve(self, value):
+        """
+        Replace a Content-ID reference with the lookup reference
+        of the created entity (after flush).
+
+        :return:    Returns lookup reference, or the value if not resolved
+        """
+
+        if is_batch_reference(value):
+            return self.resolved.get(value, value)
+
+        return value
+
+    def flush(self):
+        """
+        Send all queued operations.
+
+        Changesets are split into several requests
+        if the amount of operations exceeds the service limit.
+        Changesets themselves are never split.
+
+        Callbacks are invoked in the order the operations were added.
+
+        :return:    Returns a dictionary of BatchResponse objects
+                    by Content-ID reference
+        """
+
+        changesets, self.changesets = self.changesets, []
+        responses = {}
+
+        request = []
+
+        for changeset in changesets:
+            if not changeset:
+                continue
+
+            if sum(map(len, request)) + len(changeset) > self.max_size:
+                responses.update(self.send(request))
+                request = []
+
+            request.append(changeset)
+
+        if request:
+            responses.update(self.send(request))
+
+        for changeset in changesets:
+            for operation in changeset:
+                reference = operation["reference"]
+
+                response = responses.setdefault(
+                    reference,
+                    # Operations without a response were rolled back
+                    BatchResponse(424, text="Changeset failed")
+                )
+
+                is_entity_set = re.match(r"^\w+$", operation["resource"])
+
+                if operation["method"] == "POST" and is_entity_set:
+                    if response and response.entity_id():
+                        self.resolved[reference] = bind(
+                            operation["resource"],
+                            response.entity_id()
+                        )
+
+                if not response:
+                    log.error(
+                        "Batch operation {method} {resource} failed".format(
+                            **operation
+                        )
+                    )
+                    log.error(response.text)
+
+                if operation["on_response"]:
+                    operation["on_response"](response)
+
+        return responses
+
+    def send(self, changesets):
+        """
+        Send changesets in a single $batch request.
+
+        :param changesets:  List of changesets (lists of operations)
+
+        :return:            Returns a dictionary of BatchResponse objects
+                            by Content-ID reference
+        """
+
+        operations = [o for changeset in changesets for o in changeset]
+
+        log.info("Sending batch of {0} operations".format(len(operations)))
+
+        if not DO_WRITE:
+            return {
+                o["reference"]: BatchResponse(
+                    204,
+                    {
+                        "OData-EntityId": "{base}/{resource}({guid})".format(
+                            base=base_endpoint,
+                            resource=o["resource"],
+                            guid=uuid4()
+                        )
+                    }
+                ) for o in operations
+            }
+
+        boundary = "batch_{0}".format(uuid4())
+        body = compose_batch(boundary, changesets)
+
+        response = batch_request(body, boundary)
+
+        content_type = response.headers.get("Content-Type", "")
+
+        if "multipart/mixed" not in content_type:
+            log.error("Batch request failed")
+            log.error(response.text)
+
+            return {
+                o["reference"]: BatchResponse(
+                    response.status_code,
+                    text=response.text
+                ) for o in operations
+            }
+
+        return parse_batch_response(content_type, response.text)
+
+
+def compose_batch(boundary, changesets):
+    """
+    Compose a multipart/mixed $batch request body.
+
+    :param boundary:    Batch boundary
+    :param changesets:  List of changesets (lists of operations)
+
+    :return:            Returns request body (string)
+    """
+
+    lines = []
+
+    for changeset in changesets:
+        changeset_boundary = "changeset_{0}".format(uuid4())
+
+        lines += [
+            "--{0}".format(boundary),
+            "Content-Type: multipart/mixed;boundary={0}".format(
+                changeset_boundary
+            ),
+            ""
+        ]
+
+        for operation in changeset:
+            resource = operation["resource"]
+
+            if resource.startswith("$"):
+                url = resource
+            else:
+                url = "{base}/{resource}".format(
+                    base=base_endpoint,
+                    resource=resource
+                )
+
+            lines += [
+                "--{0}".format(changeset_boundary),
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "Content-ID: {0}".format(operation["content_id"]),
+                "",
+                "{method} {url} HTTP/1.1".format(
+                    method=operation["method"],
+                    url=url
+                ),
+                "Content-Type: application/json;type=entry",
+                "",
+                json.dumps(operation["payload"] or {})
+                if operation["method"] != "DELETE" else ""
+            ]
+
+        lines += ["--{0}--".format(changeset_boundary)]
+
+    lines += ["--{0}--".format(boundary), ""]
+
+    return "\r\n".join(lines)
 
 
 def store_address(payload):
@@ -1,13 +1,30 @@
 # -*- coding: utf-8 -*-
 
 import re
+import json
+import time
 import requests
+import metrics
 from logging import getLogger
 import cache_interface as cache
+from helper import get_config, hash_document, is_changed, chunks
+
+try:
+    from dawa_replica import get_replica
+except ImportError:
+    def get_replica(path=None):
+        return None
 
 # DAR Service settings
 BASE_URL = "https://dawa.aws.dk"
 
+# Local replica of the DAWA addresses (See aak_integration/dawa_replica)
+# Addresses which are not found in the replica are retrieved from DAWA
+DAWA_REPLICA = get_config().get("dawa_replica", fallback=None)
+
+# Amount of addresses converted and stored at a time
+DEFAULT_CHUNK_SIZE = 200
+
 # Init logging
 log = getLogger(__name__)
 
@@ -38,11 +55,20 @@ def get_request(resource, **params):
         )
     )
 
+    started = time.monotonic()
+
     response = requests.get(
         url=url,
         params=params
     )
 
+    metrics.observe(
+        stage="dawa_lookup",
+        entity=resource.split("/", 1)[0],
+        status=response.status_code,
+        seconds=time.monotonic() - started
+    )
+
     if not response.status_code == 200:
         # Log error
         log.error(response.text)
@@ -61,11 +87,26 @@ def get_access_address(uuid):
     Access address points towards such an entry point.
     For more information, see service documentation (http://dawa.aws.dk)
 
+    The local replica is used if available (See 'DAWA_REPLICA').
+
     :param uuid:    Address object identifier
 
     :return:        Returns access_adapter (document)
     """
 
+    replica = get_replica(DAWA_REPLICA)
+
+    data = None
+
+    # Lookups are only recorded if the replica is configured
+    if replica:
+        with metrics.timed("dawa_replica", "adgangsadresser") as status:
+            data = replica.get_access(uuid)
+            status["status"] = "hit" if data else "miss"
+
+    if data:
+        return access_adapter(data)
+
     resource = "adgangsadresser/{identifier}".format(
         identifier=uuid
     )
@@ -158,12 +199,26 @@ def access_adapter(data):
 def get_address(uuid):
     """
     Helper function for retrieving addresses.
+    The local replica is used if available (See 'DAWA_REPLICA').
 
     :param uuid:    Address object identifier
 
     :return:        Returns adapter (document)
     """
 
+    replica = get_replica(DAWA_REPLICA)
+
+    data = None
+
+    # Lookups are only recorded if the replica is configured
+    if replica:
+        with metrics.timed("dawa_replica", "adresser") as status:
+            data = replica.get(uuid)
+            status["status"] = "hit" if data else "miss"
+
+    if data:
+        return adapter(data)
+
     resource = "adresser/{identifier}".format(
         identifier=uuid
     )
@@ -272,51 +327,133 @@ def adapter(data, old_adapted={}):
     return document
 
 
-def get_all(area_code):
+def stream_request(resource, **params):
     """
-    Helper function for retrieving all addresses within an area code.
+    Streaming GET request (newline delimited JSON)
+    The objects are parsed as they are received.
+
+    :param resource:    REST API resource path (e.g. /adresser)
+    :param params:      Query parameters
+
+    :return:            Returns a generator (iterator) of objects
+    """
+
+    # Generate url
+    url = "{base_url}/{resource_path}".format(
+        base_url=BASE_URL,
+        resource_path=resource
+    )
+
+    # INFO
+    log.info(
+        "GET request (stream): {url} (Params: {params})".format(
+            url=url,
+            params=params
+        )
+    )
+
+    params["format"] = "ndjson"
+
+    started = time.monotonic()
+
+    response = requests.get(
+        url=url,
+        params=params,
+        stream=True
+    )
+
+    # Time to the first byte (the body is read as it is consumed)
+    metrics.observe(
+        stage="dawa_stream",
+        entity=resource.split("/", 1)[0],
+        status=response.status_code,
+        seconds=time.monotonic() - started
+    )
+
+    try:
+        if not response.status_code == 200:
+            # Log error
+            log.error(response.text)
+            return
+
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line.decode("utf-8"))
+
+    finally:
+        response.close()
+
+
+def iter_all(area_code, size=DEFAULT_CHUNK_SIZE):
+    """
+    Helper function for streaming all addresses within an area code.
+
+    Addresses are converted (and compared with the cached documents)
+    in chunks as they are received, as such memory usage is bounded.
+    The caller queues the new or changed addresses for export
+    once the chunk has been written (See 'cache.queue_export').
 
     :param area_code:   4 digit area code identifier
+    :param size:        Amount of addresses per chunk
 
-    :return:            Returns list of converted documents
+    :return:            Returns a generator (iterator) of tuples:
+                        (list of converted documents,
+                        identifiers of the new or changed documents)
     """
 
     resource = "adresser"
     table = cache.mapping.get("dawa")
 
-    addresses = get_request(
+    addresses = stream_request(
         resource=resource,
         kommunekode=area_code,
         struktur="flad"
     )
 
-    if not addresses:
-        return
+    batch_timestamp = cache.r.now()
 
-    # cache all previous addresses in memory dict
-    existing_adapted = {
-        d["id"]: d
-        for d in cache.r.table(
-            table
-            ).get_all(*[a["id"] for a in addresses]).run(cache.connect())
-    }
+    for chunk in chunks(addresses, size):
+
+        # Previous versions of the addresses in this chunk
+        existing_adapted = {
+            d["id"]: d
+            for d in cache.get_many(table, [a["id"] for a in chunk])
+        }
 
-    # Create empty payload:
-    list_of_documents = []
+        # Create empty payload:
+        list_of_documents = []
 
-    batch_timestamp = cache.r.now()
+        # New or changed addresses (queued for export by the caller)
+        changed = []
+
+        # Iterate and append converted documents to the list
+        for address in chunk:
+            previous = existing_adapted.get(address["id"], {})
+            converted = hash_document(adapter(address, previous), previous)
+
+            # set update time
+            converted["updated"] = batch_timestamp
+
+            list_of_documents.append(converted)
+
+            if is_changed(converted, previous):
+                changed.append(converted["id"])
 
-    # Iterate and append converted documents to the list
-    for address in addresses:
-        converted = adapter(address, existing_adapted.get(address["id"], {}))
-        old_data = existing_adapted.get(address["id"], {}).get("data")
-        if converted["data"] != old_data:
-            # change this back after export
-            converted["import_changed"] = True
+        yield list_of_documents, changed
 
-        # set update time
-        converted["updated"] = batch_timestamp
 
-        list_of_documents.append(converted)
+def get_all(area_code):
+    """
+    Helper function for retrieving all addresses within an area code.
+    (See 'iter_all' for streaming)
+
+    :param area_code:   4 digit area code identifier
+
+    :return:            Returns list of converted documents
+    """
 
-    return list_of_documents
+    return [
+        document
+        for chunk, _ in iter_all(area_code)
+        for document in chunk
+    ]
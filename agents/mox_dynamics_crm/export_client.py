@@ -9,9 +9,17 @@ if not os.environ.get("SPHINXBUILDING"):
     import crm_interface as crm
     import cache_interface as cache
     import dawa_interface as dawa
+    import metrics
 
-    from helper import get_config
+    from helper import get_config, chunks, content_hash
     from logging import getLogger
+    from contextlib import contextmanager
+    from multiprocessing.dummy import Pool
+    from collections import Counter
+    from datetime import datetime, timezone
+    import threading
+    import queue
+    import time
     import copy
 
 
@@ -21,27 +29,844 @@ if not os.environ.get("SPHINXBUILDING"):
     # Get config
     config = get_config()
 
+    # Amount of kunderolles resolved (prefetched) per batch
+    EXPORT_BATCH_SIZE = config.getint("export_batch_size", fallback=200)
 
-def export_everything():
+    # Entities shared between kunderolles are guarded by a fixed set of locks
+    # (lock striping), an entity always maps to the same lock.
+    ENTITY_LOCK_STRIPES = 1024
+    entity_locks = [threading.Lock() for _ in range(ENTITY_LOCK_STRIPES)]
+
+    # Continuous export (See 'follow')
+    # Changes are collected for this amount of seconds before exporting
+    FOLLOW_WINDOW = config.getfloat("follow_window", fallback=5)
+
+    # Seconds to wait before subscribing again if the changefeed is lost
+    FOLLOW_RECONNECT_DELAY = 10
+
+
+class ExportProgress(object):
+    """
+    Thread safe progress counter for the export.
+    Counts processed kunderolles per worker (thread).
     """
-    Export everything (in sequence) from the cache layer to CRM.
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.processed = Counter()
+
+    def done(self):
+        with self.lock:
+            self.processed[threading.current_thread().name] += 1
+
+    def report(self):
+        with self.lock:
+            for worker, count in sorted(self.processed.items()):
+                log.info(
+                    "Export progress {worker}: {count} kunderolles".format(
+                        worker=worker,
+                        count=count
+                    )
+                )
+
+        log.info(crm.limiter.summary())
+
+    def summary(self):
+        """
+        :return:    Returns a summary of the throughput (string)
+        """
+
+        elapsed = time.time() - self.started
+        total = sum(self.processed.values())
+
+        return (
+            "Exported {total} kunderolles in {elapsed:.1f} seconds "
+            "({rate:.2f} per second, {workers} worker(s))".format(
+                total=total,
+                elapsed=elapsed,
+                rate=total / elapsed if elapsed else 0,
+                workers=len(self.processed)
+            )
+        )
+
+
+def export_everything(workers=1, use_batch=False, resume=False):
+    """
+    Export everything from the cache layer to CRM.
     During this process all the relations between the entities are created.
     Relations are stored in the cache layer as references.
 
+    Kunderolles are processed in batches (ordered by 'id'),
+    the related documents of each batch are prefetched in a few bulk queries.
+
+    If more than one worker is requested, the kunderolles of a batch
+    are processed concurrently. Work on documents shared between
+    kunderolles (e.g. an address used by several contacts)
+    is serialized (See 'export_kunderolle').
+
+    A checkpoint is recorded after each batch (See 'cache.start_export'),
+    an interrupted export can be resumed from the latest checkpoint.
+
+    Kunderolles with entities which could not be created in CRM
+    are queued and retried once the run is complete (See 'retry_failed').
+
+    :param workers:     Number of concurrent workers (threads)
+    :param use_batch:   Send the CRM operations of each kunderolle
+                        in a single $batch request (See 'process')
+    :param resume:      Resume the latest unfinished export (if any)
+
+    :return:        Returns the progress object (ExportProgress)
+    """
+
+    progress = ExportProgress()
+
+    export = cache.start_export(resume)
+
+    if export["cursor"] is not None:
+        log.info(
+            "Resuming export {id} after kunderolle {cursor} "
+            "({exported} exported)".format(**export)
+        )
+
+    all_kunderolle = cache.iter_kunderolles(after=export["cursor"])
+
+    if workers > 1:
+        pool = Pool(workers)
+    else:
+        pool = None
+
+    try:
+        for batch in export_batches(
+            all_kunderolle, pool, progress, use_batch, export["id"]
+        ):
+            # The batch has been written to the cache layer
+            export["cursor"] = batch[-1]["id"]
+            export["exported"] += len(batch)
+            cache.save_export(export)
+
+        retry_failed(use_batch, progress, export["id"])
+
+        with cache.checkout() as connection:
+            export["ended"] = cache.r.now().run(connection)
+
+        cache.save_export(export)
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+        cache.flush_writes()
+
+    log.info(progress.summary())
+
+    return progress
+
+
+def export_queued(workers=1, use_batch=False):
+    """
+    Export the documents changed on import (See 'cache.queue_export')
+    rather than every kunderolle.
+
+    The kunderolles affected by the queued documents are resolved
+    through the reverse reference indexes (See 'cache.affected_kunderolles')
+    and exported. Once exported, the queue is cleared.
+
+    :param workers:     Number of concurrent workers (threads)
+    :param use_batch:   Use $batch requests (See 'process')
+
+    :return:            Returns the progress object (ExportProgress)
+    """
+
+    progress = ExportProgress()
+
+    # Entries queued from now on are left for the next export
+    # (Same clock as 'cache.queue_export')
+    drain_start = datetime.now(timezone.utc)
+
+    if workers > 1:
+        pool = Pool(workers)
+    else:
+        pool = None
+
+    try:
+        queued = cache.iter_export_queue(drain_start)
+
+        for entries in chunks(queued, EXPORT_BATCH_SIZE * 10):
+            changed = {}
+
+            for entry in entries:
+                changed.setdefault(entry["table"], set()).add(entry["ref"])
+
+            kunderolles = cache.affected_kunderolles(changed)
+
+            log.info(
+                "{changes} queued documents affect "
+                "{amount} kunderolles".format(
+                    changes=len(entries),
+                    amount=len(kunderolles)
+                )
+            )
+
+            for _ in export_batches(
+                kunderolles, pool, progress, use_batch, "queue"
+            ):
+                pass
+
+        retry_failed(use_batch, progress, "queue")
+
+        cache.clear_export_queue(drain_start)
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+        cache.flush_writes()
+
+    log.info(progress.summary())
+
+    return progress
+
+
+def export_batches(kunderolles, pool=None, progress=None, use_batch=False,
+                   export_id=None):
+    """
+    Export kunderolles in batches (See 'export_everything')
+    The related documents of each batch are prefetched.
+
+    :param kunderolles: Iterable of kunderolle documents
+    :param pool:        Optional pool of workers (threads)
+    :param progress:    Progress object (ExportProgress)
+    :param use_batch:   Use $batch requests (See 'process')
+    :param export_id:   Identifier of the export run (See 'export_kunderolle')
+
+    :return:            Returns a generator (iterator) of batches,
+                        each batch is yielded once it has been exported
+                        and written to the cache layer
+    """
+
+    for batch in chunks(kunderolles, EXPORT_BATCH_SIZE):
+        graph = cache.prefetch_export_graph(batch)
+
+        def export_one(kunderolle):
+            export_kunderolle(
+                kunderolle, graph, progress, use_batch, export_id
+            )
+
+        if pool:
+            pool.map(export_one, batch)
+        else:
+            for kunderolle in batch:
+                export_one(kunderolle)
+
+        progress.report()
+
+        # The next batch is prefetched from the cache layer
+        cache.flush_writes()
+
+        yield batch
+
+
+def follow(workers=1, use_batch=False):
+    """
+    Continuous export.
+    Follow the changes of the cache layer (RethinkDB changefeeds)
+    and export the kunderolles affected by the changes.
+
+    Changes are collected for FOLLOW_WINDOW seconds after the first change,
+    as such a kunderolle is exported once even if several
+    of its documents are changed (e.g. by an import).
+
+    Please note that changes made while the changefeed is lost
+    are not exported until the next (full) export.
+
+    The metrics are written after each window (See 'metrics.phase')
+    and served over HTTP if a 'metrics_port' is configured.
+
+    This function runs until it is interrupted.
+
+    :param workers:     Number of concurrent workers (threads)
+    :param use_batch:   Use $batch requests (See 'process')
+    """
+
+    progress = ExportProgress()
+    changes = queue.Queue()
+
+    def subscribe():
+        while True:
+            try:
+                for table, change in cache.follow_changes():
+                    if cache.is_pending_export(change):
+                        changes.put((table, change["new_val"]["id"]))
+
+            except Exception as error:
+                log.error("Changefeed lost: {0}".format(error))
+
+            time.sleep(FOLLOW_RECONNECT_DELAY)
+
+    threading.Thread(target=subscribe, daemon=True).start()
+
+    metrics.serve()
+
+    if workers > 1:
+        pool = Pool(workers)
+    else:
+        pool = None
+
+    log.info("Following changes (window: {0} seconds)".format(FOLLOW_WINDOW))
+
+    try:
+        while True:
+            table, uuid = changes.get()
+            changed = {table: {uuid}}
+
+            # Coalesce the changes within the window
+            deadline = time.monotonic() + FOLLOW_WINDOW
+
+            while True:
+                timeout = deadline - time.monotonic()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    table, uuid = changes.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                changed.setdefault(table, set()).add(uuid)
+
+            kunderolles = cache.affected_kunderolles(changed)
+
+            log.info(
+                "{changes} changed documents affect "
+                "{amount} kunderolles".format(
+                    changes=sum(len(uuids) for uuids in changed.values()),
+                    amount=len(kunderolles)
+                )
+            )
+
+            with metrics.phase("follow"):
+                for _ in export_batches(
+                    kunderolles, pool, progress, use_batch, "follow"
+                ):
+                    pass
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+        cache.flush_writes()
+
+        log.info(progress.summary())
+
+
+def retry_failed(use_batch=False, progress=None, export_id=None):
+    """
+    Retry the kunderolles queued by previous exports (table: export_retries)
+    Kunderolles which are exported successfully are removed from the queue.
+
+    :param use_batch:   Use $batch requests (See 'process')
+    :param progress:    Optional progress object (ExportProgress)
+    :param export_id:   Identifier of the export run
+
+    :return:            Returns the amount of kunderolles still failing
+    """
+
+    # Queued retries must be visible to the query
+    cache.flush_writes()
+
+    retries = list(cache.iter_all("export_retries"))
+
+    if not retries:
+        return 0
+
+    log.info("Retrying {0} failed kunderolles".format(len(retries)))
+
+    kunderolles = cache.get_many(
+        "ava_kunderolles",
+        [retry["id"] for retry in retries]
+    )
+
+    still_failing = 0
+
+    for batch in chunks(kunderolles, EXPORT_BATCH_SIZE):
+        graph = cache.prefetch_export_graph(batch)
+
+        for kunderolle in batch:
+            if export_kunderolle(
+                kunderolle, graph, progress, use_batch, export_id
+            ):
+                still_failing += 1
+            else:
+                cache.delete("export_retries", kunderolle["id"])
+
+        cache.flush_writes()
+
+    # Kunderolles which no longer exist are not retried
+    found = set(kunderolle["id"] for kunderolle in kunderolles)
+
+    for retry in retries:
+        if retry["id"] not in found:
+            cache.delete("export_retries", retry["id"])
+
+    log.info("{0} kunderolles are still failing".format(still_failing))
+
+    return still_failing
+
+
+def failed_entities(kunderolle, graph=None):
+    """
+    Identifiers of the entities of a kunderolle
+    which could not be created in CRM ('external_ref' is False)
+
+    :param kunderolle:  Kunderolle document
+    :param graph:       Optional prefetched documents
+
+    :return:            Returns a list of identifiers
+    """
+
+    interessefaellesskab_ref = kunderolle.get("interessefaellesskab_ref")
+
+    aftale = lookup_indsats(graph, interessefaellesskab_ref)
+
+    documents = [
+        kunderolle,
+        lookup(graph, "contacts", kunderolle.get("contact_ref")),
+        lookup(graph, "accounts", interessefaellesskab_ref),
+        aftale,
+        aftale and lookup(graph, "ava_installations", aftale.get("klasse_ref"))
+    ]
+
+    return [
+        document["id"] for document in documents
+        if document and document.get("external_ref") is False
+    ]
+
+
+def entity_refs(kunderolle, graph=None):
+    """
+    Identifiers of all documents that 'process' may read or write
+    for this kunderolle.
+
+    :param kunderolle:  Kunderolle document
+    :param graph:       Optional prefetched documents
+
+    :return:            Returns a set of identifiers
+    """
+
+    contact_ref = kunderolle.get("contact_ref")
+    interessefaellesskab_ref = kunderolle.get("interessefaellesskab_ref")
+
+    refs = {kunderolle["id"], contact_ref, interessefaellesskab_ref}
+
+    contact = lookup(graph, "contacts", contact_ref)
+    account = lookup(graph, "accounts", interessefaellesskab_ref)
+    aftale = lookup_indsats(graph, interessefaellesskab_ref)
+
+    for document in (contact, account):
+        if document:
+            refs.add(document.get("dawa_ref"))
+
+    if aftale:
+        refs.update([
+            aftale["id"],
+            aftale.get("dawa_ref"),
+            aftale.get("klasse_ref")
+        ])
+
+        produkt = lookup(graph, "ava_installations", aftale.get("klasse_ref"))
+
+        if produkt:
+            refs.add(produkt.get("dawa_ref"))
+
+    refs.discard(None)
+
+    return refs
+
+
+@contextmanager
+def locked(refs):
+    """
+    Hold the entity locks for a set of identifiers.
+    Locks are always acquired in the same order to avoid deadlocks.
+
+    :param refs:    Set of document identifiers
+    """
+
+    stripes = sorted(set(hash(ref) % ENTITY_LOCK_STRIPES for ref in refs))
+
+    for stripe in stripes:
+        entity_locks[stripe].acquire()
+
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            entity_locks[stripe].release()
+
+
+def export_kunderolle(kunderolle, graph=None, progress=None, use_batch=False,
+                      export_id=None):
+    """
+    Process a kunderolle while holding the locks
+    of all the documents it depends on.
+    This ensures that no shared entity is created twice in CRM.
+
+    :param kunderolle:  Kunderolle document
+    :param graph:       Optional prefetched documents
+    :param progress:    Optional progress object (ExportProgress)
+    :param use_batch:   Use $batch requests (See 'process')
+    :param export_id:   Identifier of the export run.
+                        If set, the kunderolle is queued for a retry
+                        if any of its entities failed (See 'retry_failed')
+
+    :return:            Returns list of failed entities (identifiers)
+    """
+
+    with locked(entity_refs(kunderolle, graph)):
+        process(kunderolle, graph, use_batch)
+
+        failed = failed_entities(kunderolle, graph)
+
+    if failed and export_id:
+        cache.queue_export_retry(kunderolle["id"], failed, export_id)
+
+    if progress:
+        progress.done()
+
+    return failed
+
+
+def lookup(graph, table, uuid):
+    """
+    Get document from the prefetched graph,
+    fall back to the cache layer if it is not there.
+
+    :param graph:   Graph returned by 'cache.prefetch_export_graph' or None
+    :param table:   Table name
+    :param uuid:    Document identifier
+
+    :return:        Returns either a document or 'None'
     """
 
-    all_kunderolle = cache.all("ava_kunderolles")
+    if graph and uuid in graph.get(table, {}):
+        return graph[table][uuid]
 
-    for kunderolle in all_kunderolle:
-        process(kunderolle)
+    return cache.get(table=table, uuid=uuid)
 
 
-def process(kunderolle):
+def lookup_indsats(graph, interessefaellesskab_ref):
+    """
+    Get aftale by 'interessefaellesskab_ref' from the prefetched graph,
+    fall back to the cache layer if it is not there.
+    (See 'lookup')
+    """
+
+    if graph and interessefaellesskab_ref in graph.get("indsats", {}):
+        return graph["indsats"][interessefaellesskab_ref]
+
+    return cache.find_indsats(interessefaellesskab_ref)
+
+
+class ExportBatch(object):
+    """
+    Collects the CRM operations for a kunderolle and its dependencies
+    in a single $batch changeset (See 'crm.Batch').
+
+    Cache writes are deferred until the batch has been sent,
+    when the CRM references of the created entities are known.
+
+    Each entity is sent once per changeset,
+    even if several documents of the kunderolle refer to it.
+    """
+
+    def __init__(self):
+        self.batch = crm.Batch()
+        self.batch.changeset()
+
+        # Deferred cache writes and contact/aftale links
+        self.documents = []
+        self.links = []
+
+        # Entities (resource, id) already exported in this changeset
+        self.exported = set()
+
+    def add(self, method, resource, payload=None, on_response=None):
+        return self.batch.add(method, resource, payload, on_response)
+
+    def first_export(self, resource, document):
+        """
+        Check if a document is exported for the first time in this batch
+
+        :return:    Returns False if the document has already been exported
+        """
+
+        key = (resource, document["id"])
+
+        if key in self.exported:
+            return False
+
+        self.exported.add(key)
+
+        return True
+
+    def save(self, table, document, name):
+        for _, deferred, _ in self.documents:
+            if deferred is document:
+                return
+
+        self.documents.append((table, document, name))
+
+    def link(self, contact, aftale, skip_if_no_changes, progress_log):
+        self.links.append((contact, aftale, skip_if_no_changes, progress_log))
+
+    def flush(self):
+        """
+        Send the batch, create the contact/aftale links
+        and write the deferred documents to the cache layer.
+        """
+
+        self.batch.flush()
+
+        for contact, aftale, skip_if_no_changes, progress_log in self.links:
+
+            if not contact["external_ref"] or not aftale["external_ref"]:
+                continue
+
+            links = len(aftale.get("contact_refs") or [])
+
+            if crm.mend_contact_and_aftale_link(
+                contact, aftale, skip_if_no_changes
+            ):
+                progress_log["contact_ref"] = contact["external_ref"]
+                log_transfer(progress_log)
+
+            # The link is cached in the aftale
+            if links != len(aftale.get("contact_refs") or []):
+                self.save("ava_aftales", aftale, "indsats")
+
+        for table, document, name in self.documents:
+
+            # Replace Content-ID references with the CRM references
+            data = document.get("data") or {}
+            exported = (
+                document.get("exported_hash") == document.get("data_hash")
+            )
+
+            for key, value in data.items():
+                if key.endswith("@odata.bind") and crm.is_batch_reference(
+                    value
+                ):
+                    data[key] = self.batch.resolve(value)
+                    if crm.is_batch_reference(data[key]):
+                        data[key] = None
+
+            # The payload has been exported with the references resolved
+            document["data_hash"] = content_hash(data)
+            if exported:
+                document["exported_hash"] = document["data_hash"]
+
+            save(table, document, name)
+
+
+# Create and update functions by resource (entity set)
+crm_functions = {
+    "ava_adresses": ("store_address", "update_address"),
+    "contacts": ("store_contact", "update_contact"),
+    "accounts": ("store_account", "update_account"),
+    "ava_kunderolles": ("store_kunderolle", "update_kunderolle"),
+    "ava_aftales": ("store_aftale", "update_aftale"),
+    "ava_installations": ("store_produkt", "update_produkt"),
+}
+
+
+def export_document(resource, document, name, batch=None, force=False):
+    """
+    Create or update a document in CRM.
+
+    Skip the update if the payload has not changed since the last export,
+    i.e. the hash of the payload ('data_hash') matches
+    the hash of the payload which was last exported ('exported_hash').
+    Failed exports are retried on the next run, as the hashes differ.
+
+    :param resource:    Resource (entity set), e.g. 'contacts'
+    :param document:    Document retrieved from the cache layer
+    :param name:        Entity name (for logging purposes)
+    :param batch:       Optional ExportBatch
+    :param force:       Update the document even if it has not changed
+
+    The 'external_ref', 'data_hash' and 'exported_hash' fields
+    of the document are updated (in batch mode once the batch has been sent).
+
+    :return:            Returns True if the document has changed
+                        and should be written to the cache layer
+    """
+
+    if batch and not batch.first_export(resource, document):
+        return False
+
+    store, update = [getattr(crm, f) for f in crm_functions[resource]]
+
+    # The payload may have been changed during the export (e.g. bindings)
+    payload_hash = content_hash(document["data"])
+    changed = document.get("data_hash") != payload_hash
+    document["data_hash"] = payload_hash
+
+    def exported(response):
+        if response:
+            document["exported_hash"] = payload_hash
+
+    if not document.get("external_ref"):
+        if not batch:
+            document["external_ref"] = store(document["data"])
+            if document["external_ref"]:
+                document["exported_hash"] = payload_hash
+            return True
+
+        def created(response):
+            exported(response)
+            if response:
+                document["external_ref"] = response.entity_id() or False
+            else:
+                document["external_ref"] = False
+
+        log.info("Creating {name} in CRM (batch)".format(name=name))
+        document["external_ref"] = batch.add(
+            "POST", resource, document["data"], created
+        )
+        return True
+
+    if force or payload_hash != document.get("exported_hash"):
+        if not batch:
+            exported(update(
+                identifier=document["external_ref"],
+                payload=document["data"]
+            ))
+            return True
+
+        log.info("Updating {name} in CRM (batch)".format(name=name))
+        batch.add(
+            "PATCH",
+            crm.bind(resource, document["external_ref"]).lstrip("/"),
+            document["data"],
+            exported
+        )
+        return True
+
+    log.debug("skipping NOP {name} update for {id}".format(
+        name=name,
+        **document)
+    )
+
+    return changed
+
+
+def save(table, document, name, batch=None):
+    """
+    Write document to the cache layer
+    The write is buffered (See 'cache.write_behind')
+    and in batch mode deferred until the batch has been sent.
+
+    :param table:       Table name
+    :param document:    Document
+    :param name:        Entity name (for logging purposes)
+    :param batch:       Optional ExportBatch
+    """
+
+    if batch:
+        batch.save(table, document, name)
+        return
+
+    log.info("Updating cache for {name}".format(name=name))
+    cache.write_behind(table, document)
+
+
+def log_transfer(progress_log):
+    """
+    Log a transferred contact/aftale
+    """
+
+    if False:
+        log.info(
+            "Overført {type}: {firstname} {lastname},"
+            " {adresse}, mobil:{mobil}, email:{email}"
+            " crm:{contact_ref}, lora:{lora_ref}".format(
+                **progress_log
+            )
+        )
+    else:
+        log.info(
+            "Overført {type}: xxxx,"
+            " {adresse}, mobil:xxxx, email:xxxx"
+            " crm:{contact_ref}, lora:{lora_ref}".format(
+                **progress_log
+            )
+        )
+
+
+def process(kunderolle, graph=None, use_batch=False):
     """
     Process sequence of related documents (by 'ava_kunderolles')
 
     :param kunderolle:  Kunderolle document retrieved from the cache layer.
 
+    :param graph:       Optional prefetched documents
+                        (See 'cache.prefetch_export_graph')
+                        Documents not found in the graph
+                        are retrieved from the cache layer.
+
+    :param use_batch:   Send the CRM operations in a single $batch request
+                        (one changeset per kunderolle)
+
+    In batch mode the documents are exported from a copy,
+    which replaces the documents once the batch has been sent.
+    If the batch fails, the copy is discarded,
+    as such no Content-ID references ($N) are left in the documents.
+
+    """
+
+    if not use_batch:
+        return export_sequence(kunderolle, graph)
+
+    refs = entity_refs(kunderolle, graph)
+
+    copied_kunderolle = copy.deepcopy(kunderolle)
+    copied_graph = graph and {
+        table: {
+            key: copy.deepcopy(document)
+            for key, document in documents.items()
+            if document["id"] in refs
+        }
+        for table, documents in graph.items()
+    }
+
+    batch = ExportBatch()
+
+    try:
+        return export_sequence(copied_kunderolle, copied_graph, batch)
+    finally:
+        batch.flush()
+
+        # The batch has been sent (the documents hold the CRM references)
+        kunderolle.clear()
+        kunderolle.update(copied_kunderolle)
+
+        for table, documents in (copied_graph or {}).items():
+            for key, document in documents.items():
+                graph[table][key].clear()
+                graph[table][key].update(document)
+
+
+def export_sequence(kunderolle, graph=None, batch=None):
+    """
+    Export a kunderolle and the documents it depends on
+    (See 'process')
+
+    :param batch:       Optional ExportBatch
     """
 
     # calls to store an entity in crm may fail and thus cause the value False
@@ -58,22 +883,11 @@ def process(kunderolle):
     lookup_address = None
     lookup_billing_address = None
 
-    # skip-if-no-changes references
-    # DO NOT USE for other purpose than indicators of change
+    # skip-if-no-changes
+    # Documents are only exported if the content hash of the payload
+    # differs from the hash of the payload last exported (See 'export_document')
     kunderolle_ref = kunderolle["id"]
     SINC = config.getboolean("skip-if-no-changes", fallback=True)
-    if SINC:
-        kunderolle_cached = copy.deepcopy(kunderolle)
-    else:
-        kunderolle_cached = {}
-
-    contact_cached = {}
-    aftale_cached = {}
-    billing_address_cached = {}
-    utility_address_cached = {}
-    contact_address_cached = {}
-    kundeforhold_cached = {}
-    produkt_cached = {}
 
     # progress - which was transferred
     progress_log = {}
@@ -93,7 +907,8 @@ def process(kunderolle):
     interessefaellesskab_ref = kunderolle["interessefaellesskab_ref"]
 
     # Kundeforhold - moved here for logging purposes
-    kundeforhold = cache.get(
+    kundeforhold = lookup(
+        graph,
         table="accounts",
         uuid=interessefaellesskab_ref
     )
@@ -108,7 +923,7 @@ def process(kunderolle):
 
     # Customer/Contact
     if contact_ref:
-        contact = cache.get(table="contacts", uuid=contact_ref)
+        contact = lookup(graph, table="contacts", uuid=contact_ref)
     else:
         contact = None
 
@@ -125,9 +940,6 @@ def process(kunderolle):
         )
         return False
 
-    # skip-if-no-changes reference
-    contact_cached = copy.deepcopy(contact)
-
     # Set KMDEE email address as primary if primary is null
     secondary_email = contact["data"]["ava_emailkmdee"]
 
@@ -150,7 +962,7 @@ def process(kunderolle):
         )
         return False
 
-    address = cache.get(table="ava_adresses", uuid=address_ref)
+    address = lookup(graph, table="ava_adresses", uuid=address_ref)
 
     if not address:
 
@@ -176,71 +988,34 @@ def process(kunderolle):
         )
         return False
 
-    # this doesn't do that much but look like the others
-    # skip-if-no-changes reference
-    if SINC:
-        contact_address_cached = copy.deepcopy(address)
 
     # Export address
     # Depends on: None
-    if not address["external_ref"]:
-        address["external_ref"] = crm.store_address(address["data"])
-        address["import_changed"] = False
-    elif address != contact_address_cached or address.get("import_changed"):
-        if crm.update_address(
-            identifier=address["external_ref"],
-            payload=address["data"]
-        ):
-            address["import_changed"] = False
-
-    else:
-        log.debug("skipping NOP address update for {id}".format(**address))
-        log.debug("{a} == {b}".format(
-            a=address,
-            b=contact_address_cached)
-        )
-
-    if address != contact_address_cached:
-        update_cache = cache.update(
-            table="ava_adresses",
-            document=address
-        )
-        log.info("Updating cache for contact address")
-        log.info(update_cache)
+    if export_document(
+        "ava_adresses",
+        address,
+        "address",
+        batch,
+        force=not SINC
+    ):
+        save("ava_adresses", address, "contact address", batch)
 
-    lookup_address = "/ava_adresses({external_ref})".format(
-        external_ref=address["external_ref"]
-    )
+    lookup_address = crm.bind("ava_adresses", address["external_ref"])
     contact["data"]["ava_adresse@odata.bind"] = lookup_address
 
     # Export contact
     # Depends on: address
-    if not contact["external_ref"]:
-        contact["external_ref"] = crm.store_contact(contact["data"])
-        contact["import_changed"] = False
-    elif contact != contact_cached or contact.get("import_changed"):
-        if crm.update_contact(
-            identifier=contact["external_ref"],
-            payload=contact["data"]
-        ):
-            contact["import_changed"] = False
-
-    else:
-        log.debug("skipping NOP contact update for {id}".format(**contact))
-        log.debug("{a} == {b}".format(a=contact, b=contact_cached))
-
-    if contact != contact_cached:
-        update_cache = cache.update(
-            table="contacts",
-            document=contact
-        )
-        log.info("Updating cache for contact")
-        log.info(update_cache)
+    if export_document(
+        "contacts",
+        contact,
+        "contact",
+        batch,
+        force=not SINC
+    ):
+        save("contacts", contact, "contact", batch)
 
     # Update contact lookup
-    lookup_contact = "/contacts({external_ref})".format(
-        external_ref=contact["external_ref"]
-    )
+    lookup_contact = crm.bind("contacts", contact["external_ref"])
 
     progress_log.update({
         "type": "cvr" if contact["data"].get("ava_cvr_nummer") else "cpr",
@@ -262,14 +1037,16 @@ def process(kunderolle):
 
     if utility_address_ref: #  try both places before giving up and fetching
 
-        utility_address = cache.get(
+        utility_address = lookup(
+            graph,
             table="ava_adresses",
             uuid=utility_address_ref
         )
         utility_address_table = "ava_adresses"
 
         if not utility_address:
-            utility_address = cache.get(
+            utility_address = lookup(
+                graph,
                 table="access",
                 uuid=utility_address_ref
             )
@@ -320,89 +1097,40 @@ def process(kunderolle):
 
     if utility_address:
 
-        if SINC:
-            utility_address_cached = copy.deepcopy(utility_address)
 
-        if not utility_address["external_ref"]:
-            utility_address["external_ref"] = crm.store_address(
-                utility_address["data"]
-            )
-            utility_address["import_changed"] = False
-        elif (
-                utility_address != utility_address_cached
-                or utility_address.get("import_changed")
-               ):
-            if crm.update_address(
-                identifier=utility_address["external_ref"],
-                payload=utility_address["data"]
-            ):
-                utility_address["import_changed"] = False
-        else:
-            log.debug("skipping NOP utility_address update for {id}".format(
-                **utility_address)
-            )
-            log.debug("{a} == {b}".format(
-                a=utility_address,
-                b=utility_address_cached)
-            )
-
-        if utility_address != utility_address_cached:
-            update_cache = cache.update(
-                table=utility_address_table,
-                document=utility_address
-            )
-            log.info("Updating cache for utility_address")
-            log.info(update_cache)
+        if export_document(
+            "ava_adresses",
+            utility_address,
+            "utility_address",
+            batch,
+            force=not SINC
+        ):
+            save(utility_address_table, utility_address, "utility_address", batch)
 
-        lookup_utility_address = "/ava_adresses({external_ref})".format(
-            external_ref=utility_address["external_ref"]
+        lookup_utility_address = crm.bind(
+            "ava_adresses",
+            utility_address["external_ref"]
         )
 
     kundeforhold_data = kundeforhold["data"]
 
-    # skip-if-no-changes reference
-    if SINC:
-        kundeforhold_cached = copy.deepcopy(kundeforhold)
 
     if lookup_utility_address:
         kundeforhold_data[
             "ava_adresse@odata.bind"
         ] = lookup_utility_address
 
-    if not kundeforhold["external_ref"]:
-        kundeforhold["external_ref"] = crm.store_account(kundeforhold_data)
-        kundeforhold["import_changed"] = False
-    elif (
-            kundeforhold != kundeforhold_cached
-            or kundeforhold.get("import_changed")
-            ):
-        if crm.update_account(
-            identifier=kundeforhold["external_ref"],
-            payload=kundeforhold["data"]
-        ):
-            kundeforhold["import_changed"] = False
-
-    else:
-        log.debug("skipping NOP kundeforhold update for {id}".format(
-            **kundeforhold)
-        )
-        log.debug("{a} == {b}".format(
-            a=kundeforhold,
-            b=kundeforhold_cached)
-        )
-
-    if kundeforhold != kundeforhold_cached:
-        update_cache = cache.update(
-            table="accounts",
-            document=kundeforhold
-        )
-        log.info("Updating cache for kundeforhold")
-        log.info(update_cache)
+    if export_document(
+        "accounts",
+        kundeforhold,
+        "kundeforhold",
+        batch,
+        force=not SINC
+    ):
+        save("accounts", kundeforhold, "kundeforhold", batch)
 
     # Update account lookup
-    lookup_account = "/accounts({external_ref})".format(
-        external_ref=kundeforhold["external_ref"]
-    )
+    lookup_account = crm.bind("accounts", kundeforhold["external_ref"])
 
     # Kunderolle
     # Depends on: Contact, Account
@@ -416,34 +1144,14 @@ def process(kunderolle):
     if lookup_account:
         kunderolle_data["ava_kundeforhold@odata.bind"] = lookup_account
 
-    if not kunderolle["external_ref"]:
-        log.info("Kunderolle does not exist in CRM")
-        kunderolle["external_ref"] = crm.store_kunderolle(
-            kunderolle_data
-        )
-        kunderolle["import_changed"] = False
-    elif kunderolle != kunderolle_cached or kunderolle.get("import_changed"):
-        if crm.update_kunderolle(
-            identifier=kunderolle["external_ref"],
-            payload=kunderolle["data"]
-        ):
-            kunderolle["import_changed"] = False
-    else:
-        log.debug("skipping NOP kunderolle update for {id}".format(
-            **kunderolle)
-        )
-        log.debug("{a} == {b}".format(
-            a=kunderolle["data"],
-            b=kunderolle_cached)
-        )
-
-    if kunderolle != kunderolle_cached:
-        update_cache = cache.update(
-            table="ava_kunderolles",
-            document=kunderolle
-        )
-        log.info("Updating cache for organisationfunktion")
-        log.info(update_cache)
+    if export_document(
+        "ava_kunderolles",
+        kunderolle,
+        "kunderolle",
+        batch,
+        force=not SINC
+    ):
+        save("ava_kunderolles", kunderolle, "organisationfunktion", batch)
 
     # why update account-lookup, when reference is to a kunderolle?
     # old error?
@@ -454,7 +1162,7 @@ def process(kunderolle):
     #     )
 
     # Aftale
-    aftale = cache.find_indsats(interessefaellesskab_ref)
+    aftale = lookup_indsats(graph, interessefaellesskab_ref)
 
     if not aftale:
         log.warning("Aftale does not exist")
@@ -468,9 +1176,6 @@ def process(kunderolle):
         )
         return
 
-    # skip-if-no-changes reference
-    if SINC:
-        aftale_cached = copy.deepcopy(aftale)
 
     # Billing address
     billing_address_ref = aftale.get("dawa_ref")
@@ -479,7 +1184,8 @@ def process(kunderolle):
     billing_address = None
 
     if billing_address_ref:
-        billing_address = cache.get(
+        billing_address = lookup(
+            graph,
             table="ava_adresses",
             uuid=billing_address_ref
         )
@@ -509,44 +1215,19 @@ def process(kunderolle):
 
     if billing_address:
 
-        # this doesn't do that much but look like the others
-        # skip-if-no-changes reference
-        if SINC:
-            billing_address_cached = copy.deepcopy(billing_address)
 
-        if not billing_address["external_ref"]:
-            billing_address["external_ref"] = crm.store_address(
-                billing_address["data"]
-            )
-            billing_address["import_changed"] = False
-        elif (
-                billing_address != billing_address_cached
-                or billing_address.get("import_changed")
-                ):
-            if crm.update_address(
-                identifier=billing_address["external_ref"],
-                payload=billing_address["data"]
-            ):
-                billing_address["import_changed"] = False
-        else:
-            log.debug("skipping NOP billing_address update for {id}".format(
-                **billing_address)
-            )
-            log.debug("{a} == {b}".format(
-                a=billing_address,
-                b=billing_address_cached)
-            )
-
-        if billing_address != billing_address_cached:
-            update_cache = cache.update(
-                table="ava_adresses",
-                document=billing_address
-            )
-            log.info("Updating cache for billing_address")
-            log.info(update_cache)
+        if export_document(
+            "ava_adresses",
+            billing_address,
+            "billing_address",
+            batch,
+            force=not SINC
+        ):
+            save("ava_adresses", billing_address, "billing_address", batch)
 
-        lookup_billing_address = "/ava_adresses({external_ref})".format(
-            external_ref=billing_address["external_ref"]
+        lookup_billing_address = crm.bind(
+            "ava_adresses",
+            billing_address["external_ref"]
         )
 
     aftale_data = aftale["data"]
@@ -562,57 +1243,36 @@ def process(kunderolle):
     log.debug("AFTALE DATA CHECK:")
     log.debug(aftale_data)
 
-    if not aftale.get("external_ref"):
-        aftale["external_ref"] = crm.store_aftale(aftale_data)
-        aftale["import_changed"] = False
-    elif aftale != aftale_cached or aftale.get("import_changed"):
-        if crm.update_aftale(
-            identifier=aftale["external_ref"],
-            payload=aftale["data"]
-        ):
-            aftale["import_changed"] = False
-    else:
-        log.debug("skipping NOP aftale update for {id}".format(**aftale))
-        log.debug("{a} == {b}".format(a=aftale, b=aftale_cached))
+    aftale_changed = export_document(
+        "ava_aftales",
+        aftale,
+        "aftale",
+        batch,
+        force=not SINC
+    )
+    aftale_links = len(aftale.get("contact_refs") or [])
 
     # Create / replace link between aftale and contact
     # This one should probably copy the procedure which we
     # have below with the customer_number -
     # only have the latest updated
-    if crm.mend_contact_and_aftale_link(contact, aftale, SINC):
-
+    # (In batch mode the link is created once the batch has been sent)
+    if batch:
+        batch.link(contact, aftale, SINC, progress_log)
+    elif crm.mend_contact_and_aftale_link(contact, aftale, SINC):
         # only progress log if successfull
-        if False:
-            log.info(
-                "Overført {type}: {firstname} {lastname},"
-                " {adresse}, mobil:{mobil}, email:{email}"
-                " crm:{contact_ref}, lora:{lora_ref}".format(
-                    **progress_log
-                )
-            )
-        else:
-            log.info(
-                "Overført {type}: xxxx,"
-                " {adresse}, mobil:xxxx, email:xxxx"
-                " crm:{contact_ref}, lora:{lora_ref}".format(
-                    **progress_log
-                )
-            )
+        log_transfer(progress_log)
 
-    if aftale != aftale_cached:
-        update_cache = cache.update(
-            table="ava_aftales",
-            document=aftale
-        )
-        log.info("Updating cache for indsats")
-        log.info(update_cache)
+    # (The link is cached in the aftale, see 'contact_refs')
+    if aftale_changed or aftale_links != len(
+        aftale.get("contact_refs") or []
+    ):
+        save("ava_aftales", aftale, "indsats", batch)
 
     # Update aftale lookup
     aftale_external_ref = aftale["external_ref"]
 
-    lookup_aftale = "/ava_aftales({external_ref})".format(
-        external_ref=aftale["external_ref"]
-    )
+    lookup_aftale = crm.bind("ava_aftales", aftale["external_ref"])
 
     # Installation
     klasse_ref = aftale["klasse_ref"]
@@ -632,7 +1292,7 @@ def process(kunderolle):
         )
         return
 
-    produkt = cache.get(table="ava_installations", uuid=klasse_ref)
+    produkt = lookup(graph, table="ava_installations", uuid=klasse_ref)
 
     if not produkt:
         log.warning("Produkt does not exist")
@@ -646,9 +1306,6 @@ def process(kunderolle):
         )
         return
 
-    # skip-if-no-changes reference
-    if SINC:
-        produkt_cached = copy.deepcopy(produkt)
 
     # TODO: utility address must be added here
     # Utility address fallback
@@ -666,7 +1323,8 @@ def process(kunderolle):
         )
 
         # Get address external ref
-        utility_address = cache.get(
+        utility_address = lookup(
+            graph,
             table="access",
             uuid=utility_ref
         )
@@ -698,45 +1356,21 @@ def process(kunderolle):
 
     if utility_address:
 
-        # this doesn't do that much but look like the others
-        # skip-if-no-changes reference
-        if SINC:
-            utility_address_cached = copy.deepcopy(utility_address)
-
-        if not utility_address["external_ref"]:
-            utility_address["external_ref"] = crm.store_address(
-                utility_address["data"]
-            )
-            utility_address["import_changed"] = False
-        elif (
-                utility_address != utility_address_cached
-                or utility_address.get("import_changed")
-                ):
-            if crm.update_address(
-                identifier=utility_address["external_ref"],
-                payload=utility_address["data"]
-            ):
-                utility_address["import_changed"] = False
-
-        else:
-            log.debug("skipping NOP utility address update for {id}".format(
-                **utility_address)
-            )
-            log.debug("{a} == {b}".format(
-                a=utility_address,
-                b=utility_address_cached)
-            )
 
-        if utility_address != utility_address_cached:
+        if export_document(
+            "ava_adresses",
+            utility_address,
+            "utility address",
+            batch,
+            force=not SINC
+        ):
             # Store in cache
-            cache.store(
-                resource="dawa_access",
-                payload=utility_address
-            )
+            save("access", utility_address, "utility address", batch)
 
         # Update utility address lookup
-        lookup_utility_address = "/ava_adresses({reference})".format(
-            reference=utility_address["external_ref"]
+        lookup_utility_address = crm.bind(
+            "ava_adresses",
+            utility_address["external_ref"]
         )
 
 
@@ -766,26 +1400,14 @@ def process(kunderolle):
 
     # end of controversial change
 
-    if not produkt["external_ref"]:
-        produkt["external_ref"] = crm.store_produkt(produkt["data"])
-        produkt["import_changed"] = False
-    elif produkt != produkt_cached or produkt.get("import_changed"):
-        if crm.update_produkt(
-            identifier=produkt["external_ref"],
-            payload=produkt["data"]
-        ):
-            produkt["import_changed"] = False
-    else:
-        log.debug("skipping NOP produkt update for {id}".format(**produkt))
-        log.debug("{a} == {b}".format(a=produkt, b=produkt_cached))
-
-    if produkt != produkt_cached:
-        update_cache = cache.update(
-            table="ava_installations",
-            document=produkt
-        )
-        log.info("Updating cache for produkt")
-        log.info(update_cache)
+    if export_document(
+        "ava_installations",
+        produkt,
+        "produkt",
+        batch,
+        force=not SINC
+    ):
+        save("ava_installations", produkt, "produkt", batch)
 
 
 def update_all_installations():
@@ -794,17 +1416,12 @@ def update_all_installations():
     The Lora entity is "klasse"
     """
 
-    all_installations = []
-
-    for installation in cache.all("ava_installations"):
+    for installation in cache.iter_all("ava_installations"):
 
+        # Only objects that contain an alternative address
         if not installation["dawa_ref"]:
             continue
 
-        # Append all objects that contain an alternative address
-        all_installations.append(installation)
-
-    for installation in all_installations:
         update_alternative_address(installation)
 
 
@@ -1,24 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import string
 import random
+import itertools
+import hashlib
+import json
+import queue
+import threading
+from collections.abc import Iterator
 from configparser import ConfigParser
+from logging import getLogger
 
 config = ConfigParser()
 
+# Fields referencing other documents in the cache layer
+REFERENCE_FIELDS = (
+    "contact_ref",
+    "interessefaellesskab_ref",
+    "dawa_ref",
+    "klasse_ref",
+)
+
+# Init logger
+log = getLogger(__name__)
+
 
 def get_config(section="DEFAULT"):
     """
     Helper function to get a configuration section from config.ini
-    This file is required
+    This file is required, another location may be given
+    by the environment variable MOX_DYNAMICS_CRM_CONFIG (e.g. for tests)
 
     :param section: Name of the configuration section
                     (If empty, revert to default)
     :return:        Dictionary containing the config parameters
     """
 
-    config_file = "config.ini"
+    config_file = os.environ.get("MOX_DYNAMICS_CRM_CONFIG", "config.ini")
 
     # Read "config.ini"
     read_config = config.read(config_file)
@@ -58,3 +78,230 @@ def generate_password(length: int):
         password += random.choice(chars)
 
     return password
+
+
+def chunks(iterable, size):
+    """
+    Helper function to split an iterable into lists of (at most) 'size'.
+    The iterable is consumed lazily, as such it may be a generator.
+
+    :param iterable:    Any iterable, e.g. a list or a cursor
+    :param size:        Size of each chunk (integer)
+
+    :return:            Returns a generator (iterator) of lists
+    """
+
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def content_hash(data):
+    """
+    Helper function to generate a stable hash of a payload.
+    Keys are sorted, as such equal payloads yield equal hashes.
+
+    :param data:    Payload (json serializable, e.g. a dictionary)
+
+    :return:        Returns hex digest (string)
+    """
+
+    encoded = json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def hash_document(document, previous=None):
+    """
+    Helper function to add the hash of the payload ('data')
+    to a document on import (See 'content_hash').
+
+    Documents exported before the hashes were introduced
+    carry no 'exported_hash'. If such a document was exported
+    with no pending changes, the hash of its payload is marked as exported.
+
+    :param document:    Adapted document
+    :param previous:    Previous version of the document (or None)
+
+    :return:            Returns the document
+    """
+
+    document["data_hash"] = content_hash(document.get("data"))
+
+    previous = previous or {}
+
+    if (
+        "exported_hash" not in previous and
+        previous.get("external_ref") and
+        not previous.get("import_changed")
+    ):
+        document["exported_hash"] = content_hash(previous.get("data"))
+
+    return document
+
+
+def is_changed(document, previous=None):
+    """
+    Helper function to check if a document has changed on import,
+    i.e. the payload (See 'hash_document') or the references have changed.
+
+    :param document:    Adapted document
+    :param previous:    Previous version of the document (or None)
+
+    :return:            Returns True if the document is new or changed
+    """
+
+    if not previous:
+        return True
+
+    if document.get("data_hash") != previous.get("data_hash"):
+        return True
+
+    return any(
+        document.get(key) != previous.get(key) for key in REFERENCE_FIELDS
+    )
+
+
+def pipeline(items, stages, depth=4):
+    """
+    Helper function to process items in a pipeline of concurrent stages.
+
+    Each stage runs in its own pool of threads and passes its results
+    to the next stage through a bounded queue. When a queue is full
+    the previous stage waits (backpressure).
+
+    Results are yielded as they leave the last stage (unordered).
+    If a stage function returns None, the item is dropped.
+    If a stage function returns an iterator (e.g. a generator), each value
+    is passed on as it is produced (e.g. the pages of a paged request).
+    If a stage function (or the items iterator) raises, the pipeline is
+    stopped and the exception is raised to the consumer.
+
+    Example:
+
+        stages = [(fetch, 4), (convert, 2)]
+        for result in pipeline(chunks(uuids, 90), stages):
+            store(result)
+
+    :param items:   Iterable of items for the first stage
+    :param stages:  List of (function, number of threads)
+    :param depth:   Maximum amount of items waiting between stages
+
+    :return:        Returns a generator (iterator)
+    """
+
+    done = object()
+    stop = threading.Event()
+
+    # The first exception raised by a thread (re-raised to the consumer)
+    errors = []
+
+    def fail(error):
+        log.exception(error)
+        errors.append(error)
+        stop.set()
+
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+
+    def put(outbox, item):
+        while not stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def get(inbox):
+        while not stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return done
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except Exception as error:
+            fail(error)
+            return
+
+        for _ in range(stages[0][1]):
+            put(queues[0], done)
+
+    def work(index, function, remaining):
+        inbox, outbox = queues[index], queues[index + 1]
+
+        while True:
+            item = get(inbox)
+
+            if item is done:
+                break
+
+            try:
+                result = function(item)
+
+                if not isinstance(result, Iterator):
+                    result = [result]
+
+                for value in result:
+                    if value is not None and not put(outbox, value):
+                        return
+
+            except Exception as error:
+                fail(error)
+                return
+
+        # The last thread of a stage signals the next stage
+        with remaining["lock"]:
+            remaining["threads"] -= 1
+            is_last = not remaining["threads"]
+
+        if is_last:
+            next_threads = (
+                stages[index + 1][1] if index + 1 < len(stages) else 1
+            )
+            for _ in range(next_threads):
+                put(outbox, done)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+
+    for index, (function, workers) in enumerate(stages):
+        remaining = {"lock": threading.Lock(), "threads": workers}
+        threads += [
+            threading.Thread(
+                target=work,
+                args=(index, function, remaining),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            result = get(queues[-1])
+
+            if errors:
+                raise errors[0]
+
+            if result is done:
+                return
+
+            yield result
+
+    finally:
+        stop.set()
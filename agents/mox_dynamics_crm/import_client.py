@@ -14,12 +14,35 @@ if not os.environ.get("SPHINXBUILDING"):
     import dawa_interface as dawa
     import cache_interface as cache
 
+    from helper import get_config
     from logging import getLogger
+    from datetime import timedelta
 
 
     # Init logging
     log = getLogger(__name__)
 
+    # Get config
+    config = get_config()
+
+    # Incremental imports fall back to a full import (reconciliation)
+    # if the latest full import is older than this (days)
+    FULL_IMPORT_INTERVAL = config.getint("full_import_interval", fallback=7)
+
+    # High-water marks are moved back by this margin
+    # to allow for clock differences between LoRa and the cache layer
+    HIGH_WATER_MARK_MARGIN = timedelta(minutes=5)
+
+    # Lora entities (in order of import)
+    LORA_RESOURCES = [
+        "bruger",
+        "organisation",
+        "organisationfunktion",
+        "indsats",
+        "interessefaellesskab",
+        "klasse",
+    ]
+
 
 def import_all_addresses():
     """
@@ -38,22 +61,12 @@ def import_all_addresses():
         "Import all addresses from area code: {0}".format(AREA_CODE)
     )
 
-    # Get list of all address within "AREA_CODE"
+    # Stream all address within "AREA_CODE"
     # See settings to get the area code
-    addresses = dawa.get_all(AREA_CODE)
-
-    if not addresses:
-        log.warning(
-            "No addresses found in area code: {0}".format(AREA_CODE)
-        )
-        return False
+    imported = 0
 
-    # Batch operation
-    size = 200
-
-    while len(addresses) > 0:
-        batch_of_addresses = addresses[:size]
-        addresses = addresses[size:]
+    for batch_of_addresses, changed in dawa.iter_all(AREA_CODE):
+        imported += len(batch_of_addresses)
 
         try:
             cache.store(
@@ -61,15 +74,24 @@ def import_all_addresses():
                 payload=batch_of_addresses
             )
 
+            # Queued once the addresses have been written
+            cache.queue_export(cache.mapping.get("dawa"), changed)
+
         except Exception as error:
             log.error(batch_of_addresses)
             log.error(error)
 
+    if not imported:
+        log.warning(
+            "No addresses found in area code: {0}".format(AREA_CODE)
+        )
+        return False
+
     # Finished procedure
-    log.info("Finished processing all addresses")
+    log.info("Finished processing all addresses ({0})".format(imported))
 
 
-def import_to_cache(resource):
+def import_to_cache(resource, registered_since=None):
     """
     Retrieve all database objects (by entity)
     and store converted (ava_adapter) document into the cache layer.
@@ -77,16 +99,22 @@ def import_to_cache(resource):
     Data objects are just stored,
     no relations between documents at this point.
 
-    :param resource:    Name of the entity to import
+    :param resource:            Name of the entity to import
+
+    :param registered_since:    Optional datetime (incremental import)
+                                Only objects registered since are imported
 
     """
 
     # Get all uuids
-    list_of_uuids = oio.get_all(resource)
+    list_of_uuids = oio.get_all(resource, registered_since)
+
+    if not list_of_uuids:
+        return
 
     # Batch generate fetches n amount of entities
     # Returns iterator
-    for batch in oio.batch_generator(resource, list_of_uuids):
+    for batch, changed in oio.batch_generator(resource, list_of_uuids):
 
         # Info
         log.info(
@@ -104,6 +132,10 @@ def import_to_cache(resource):
         # Log database status object
         log.info(store)
 
+        # Queued once the documents have been written,
+        # as such the export never reads the previous version
+        cache.queue_export(cache.mapping.get(resource), changed)
+
 
 def import_sanity_check():
     """
@@ -113,8 +145,8 @@ def import_sanity_check():
 
     """
 
-    # Retrieve all address from cache
-    addresses = cache.all("ava_adresses")
+    # Stream all address from cache
+    addresses = cache.iter_all("ava_adresses")
 
     for address in addresses:
         identifier = address.get("id")
@@ -124,37 +156,108 @@ def import_sanity_check():
         print(identifier)
 
 
-def run_import():
+def get_high_water_marks(import_start):
+    """
+    Get the high-water marks for an incremental import.
+
+    An incremental import is only possible if a full import
+    has finished within the last FULL_IMPORT_INTERVAL days.
+
+    :param import_start:    Start time of the new import
+
+    :return:                Returns dictionary of datetimes by resource
+                            or None if a full import is due
+                            (or the previous import has no marks)
+    """
+
+    latest_full = cache.get_latest_import(full=True)
+
+    if not latest_full:
+        log.info("No full import found")
+        return None
+
+    age = import_start - latest_full["started"]
+
+    if age > timedelta(days=FULL_IMPORT_INTERVAL):
+        log.info(
+            "Latest full import is {days} days old".format(days=age.days)
+        )
+        return None
+
+    latest = cache.get_latest_import()
+    high_water_marks = latest.get("high_water_marks") or {}
+
+    missing = [
+        resource for resource in LORA_RESOURCES
+        if not high_water_marks.get(resource)
+    ]
+
+    if missing:
+        log.info(
+            "No high-water marks for: {resources}".format(
+                resources=", ".join(missing)
+            )
+        )
+        return None
+
+    return high_water_marks
+
+
+def run_import(incremental=False):
     """
     Wrapper to run full import.
 
     records start and finish in a table 'imports'
+
+    :param incremental: Only import objects registered since the
+                        previous import (per resource high-water mark).
+                        Addresses are only imported on full imports.
+                        A full import (reconciliation) is performed instead
+                        if the latest full import is too old.
     """
 
-    import_start = cache.r.now().run(cache.connect())
+    with cache.checkout() as connection:
+        import_start = cache.r.now().run(connection)
+
+    high_water_marks = None
+
+    if incremental:
+        high_water_marks = get_high_water_marks(import_start)
+
+    mode = "incremental" if high_water_marks is not None else "full"
+
     new_import = {
         "id": import_start.strftime("%Y%m%dT%H%M%S"),
+        "mode": mode,
         "started": import_start,
-        "ended": None
+        "ended": None,
+        "high_water_marks": {
+            resource: import_start - HIGH_WATER_MARK_MARGIN
+            for resource in LORA_RESOURCES
+        }
     }
 
     # Begin
-    log.info("Begin import (all) procedure")
+    log.info("Begin import ({mode}) procedure".format(mode=mode))
 
     # Import addresses
-    import_all_addresses()
+    if mode == "full":
+        import_all_addresses()
 
     # Import Lora objects
-    import_to_cache("bruger")
-    import_to_cache("organisation")
-    import_to_cache("organisationfunktion")
-    import_to_cache("indsats")
-    import_to_cache("interessefaellesskab")
-    import_to_cache("klasse")
+    for resource in LORA_RESOURCES:
+        import_to_cache(
+            resource,
+            high_water_marks and high_water_marks[resource]
+        )
+
+    # Write the export queue (See 'cache.queue_export')
+    cache.flush_writes()
 
     # Done
     log.info("Import procedure completed - Exiting")
 
-    new_import["ended"] = cache.r.now().run(cache.connect())
-    query = cache.r.table("imports").insert(new_import, conflict="update")
-    query.run(cache.connect())
+    with cache.checkout() as connection:
+        new_import["ended"] = cache.r.now().run(connection)
+        query = cache.r.table("imports").insert(new_import, conflict="update")
+        query.run(connection)
@@ -141,7 +141,8 @@ def generate_section_rethinkdb():
         "db_name": "cache_layer",
         "db_user": "cache_user",
         "db_pass":  generate_password(24),
-        "db_admin_pass": generate_password(24)
+        "db_admin_pass": generate_password(24),
+        "db_pool_size": "8"
     }
 
 
@@ -235,7 +236,9 @@ def auto_setup_cache():
         "ava_aftales",
         "ava_installations",
         "ava_kunderolles",
-        "imports"
+        "imports",
+        "exports",
+        "export_retries"
     ]
 
     try:
@@ -11,9 +11,11 @@ import click
 import import_client
 import export_client
 import purge_client
+import reconcile_client
 import cache_interface as cache
 import crm_interface as crm
 import installer
+import metrics
 from helper import get_config
 from logger import start_logging
 
@@ -34,14 +36,30 @@ if config.getboolean("do_run_in_test_mode", "yes"):
 
 
 def create_indexes(connection, table, ixlist=[]):
+    """
+    Create missing secondary indexes on a table.
+
+    :param ixlist:  List of index names (simple field indexes)
+                    or (name, index function) tuples
+    """
     existing_indexes = cache.r.table(table).index_list().run(connection)
     log.info(
         "existing_indexes on table: {table}"
         " {existing_indexes}".format(**locals())
     )
     for ix in ixlist:
-        cache.r.table(table).index_create(ix)
-        log.info("creating {ix}".format(**locals()))
+        if isinstance(ix, tuple):
+            ix, function = ix
+        else:
+            function = None
+
+        if ix not in existing_indexes:
+            log.info("creating {ix}".format(**locals()))
+            if function is None:
+                cache.r.table(table).index_create(ix).run(connection)
+            else:
+                cache.r.table(table).index_create(ix, function).run(connection)
+
         cache.r.table(table).index_wait(ix).run(connection)
 
     # await all indexes to be ready on this table
@@ -52,10 +70,37 @@ def create_indexes(connection, table, ixlist=[]):
     )
 
 
+def provision_updated_indexes(connection):
+    """
+    Indexes on 'updated' used to find current and obsolete documents
+    (See cache_interface.iter_current / iter_obsolete)
+    """
+    for table in cache.UPDATED_TABLES:
+        create_indexes(connection, table, cache.UPDATED_INDEXES)
+
+
+def provision_export_tables(connection):
+    """
+    Tables used to resume an export (See cache_interface.start_export)
+    These were added after the initial setup (See 'configure --setup')
+    """
+    existing_tables = cache.r.table_list().run(connection)
+
+    for table in cache.EXPORT_TABLES:
+        if table not in existing_tables:
+            log.info("creating table {table}".format(**locals()))
+            cache.r.table_create(table).run(connection)
+
+        cache.r.table(table).wait().run(connection)
+
+
 def await_indexes_ready():
-    create_indexes(
-        cache.connect(), "ava_aftales", ["interessefaellesskab_ref"]
-    )
+    with cache.checkout() as connection:
+        provision_export_tables(connection)
+        for table, indexes in cache.REFERENCE_INDEXES.items():
+            create_indexes(connection, table, indexes)
+        provision_updated_indexes(connection)
+        create_indexes(connection, "export_queue", [cache.EXPORT_QUEUE_INDEX])
 
 
 # Set logging
@@ -99,7 +144,12 @@ def configure(setup):
 
 
 @cli.command(name="import")
-def import_from_lora():
+@click.option(
+    "--incremental/--full",
+    default=False,
+    help="Only import objects registered since the previous import"
+)
+def import_from_lora(incremental):
     """
     Import all OIO entities to the cache layer.
     For further information, please see the 'import_client'.
@@ -110,7 +160,8 @@ def import_from_lora():
     click.echo("Begin import from OIO to cache")
 
     # Run import
-    import_client.run_import()
+    with metrics.phase("import"):
+        import_client.run_import(incremental=incremental)
 
 
 @cli.command(name="export")
@@ -119,20 +170,75 @@ def import_from_lora():
     default=False,
     help="Run without sending data to CRM"
 )
-def export_to_crm(dry_run):
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of concurrent export workers"
+)
+@click.option(
+    "--batch/--no-batch",
+    default=False,
+    help="Send the CRM operations of each customer in one $batch request"
+)
+@click.option(
+    "--resume/--no-resume",
+    default=False,
+    help="Resume the latest unfinished export from its checkpoint"
+)
+@click.option(
+    "--follow/--no-follow",
+    default=False,
+    help="Keep running and export changes as they occur"
+)
+@click.option(
+    "--queued/--all",
+    default=False,
+    help="Only export the documents changed on import (export queue)"
+)
+def export_to_crm(dry_run, workers, batch, resume, follow, queued):
     """
     Build relations and export all objects to CRM
     For further information, please see the 'export_client'.
     """
+
+    # The options select different exports, which can not be combined
+    if follow and (resume or queued):
+        raise click.UsageError(
+            "--follow can not be combined with --resume or --queued"
+        )
+
+    if queued and resume:
+        raise click.UsageError("--queued can not be combined with --resume")
+
     await_indexes_ready()
 
     crm.DO_WRITE = cache.DO_WRITE = not dry_run
 
+    if follow:
+        click.echo("Following changes in the cache layer (Ctrl-C to stop)")
+        export_client.follow(workers=workers, use_batch=batch)
+        return
+
     # Message user
     click.echo("Begin export from cache to CRM")
 
     # Run export
-    export_client.export_everything()
+    with metrics.phase("export"):
+        if queued:
+            progress = export_client.export_queued(
+                workers=workers,
+                use_batch=batch
+            )
+        else:
+            progress = export_client.export_everything(
+                workers=workers,
+                use_batch=batch,
+                resume=resume
+            )
+
+    click.echo(progress.summary())
+    click.echo(crm.limiter.summary())
 
 
 @cli.command()
@@ -175,15 +281,74 @@ def token(generate):
 
 
 @cli.command(name="purge")
-def purge_from_crm():
+@click.option(
+    "--dry-run/--no-dry-run",
+    default=True,
+    help="Only report what would be deleted (default)"
+)
+@click.option(
+    "--workers",
+    default=purge_client.PURGE_WORKERS,
+    type=click.IntRange(min=1),
+    help="Number of concurrent delete requests"
+)
+@click.option(
+    "--batch/--no-batch",
+    default=False,
+    help="Send the deletes in $batch requests"
+)
+def purge_from_crm(dry_run, workers, batch):
     """
     Purge entities from crm if deleted in lora
     """
+    await_indexes_ready()
+
+    purge_client.DO_WRITE = crm.DO_WRITE = cache.DO_WRITE = not dry_run
+
     # Message user
     click.echo("Begin purge from crm according to lora delete status")
 
     # Run purge
-    purge_client.run_purge()
+    with metrics.phase("purge"):
+        report = purge_client.run_purge(workers=workers, use_batch=batch)
+
+    click.echo(report.summary())
+
+
+@cli.command(name="reconcile")
+@click.option(
+    "--fix/--no-fix",
+    default=False,
+    help="Clear references to entities which no longer exist in CRM"
+)
+@click.option(
+    "--workers",
+    default=4,
+    type=click.IntRange(min=1),
+    help="Number of concurrent requests when enumerating CRM"
+)
+def reconcile_with_crm(fix, workers):
+    """
+    Compare the CRM references in the cache layer with CRM
+    For further information, please see the 'reconcile_client'.
+    """
+    await_indexes_ready()
+
+    click.echo("Begin reconciling cache layer against CRM")
+
+    with metrics.phase("reconcile"):
+        report = reconcile_client.run_reconcile(fix=fix, workers=workers)
+
+    for table, counts in report.items():
+        click.echo(
+            "{table}: {counts}".format(
+                table=table,
+                counts=", ".join(
+                    "{0} {1}".format(amount, outcome)
+                    for outcome, amount in sorted(counts.items())
+                )
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import os
+import time
+import bisect
+import threading
+
+from helper import get_config
+from logging import getLogger
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Init logging
+log = getLogger(__name__)
+
+# Get config
+config = get_config()
+
+# Metrics are written to this file at the end of each phase
+# (Prometheus node exporter textfile collector), e.g.
+# /var/lib/node_exporter/textfile_collector/mox_dynamics_crm.prom
+METRICS_TEXTFILE = config.get("metrics_textfile", fallback=None)
+
+# Metrics are served over HTTP on this port in follow mode (export --follow)
+METRICS_PORT = config.getint("metrics_port", fallback=0)
+
+# Prefix of all metric names
+PREFIX = "mox_dynamics_crm"
+
+# Upper bounds of the latency histogram buckets (seconds)
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+
+class Registry(object):
+    """
+    Thread safe collection of operation counters and latency histograms.
+
+    Operations are labelled by stage (e.g. 'lora_fetch', 'crm_post'),
+    entity (e.g. 'contacts') and status (e.g. HTTP status code).
+
+    Example:
+
+        registry.observe("crm_post", "contacts", 204, 0.12)
+        registry.render()
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # Counts by (stage, entity, status)
+        self.counts = {}
+
+        # Histograms by (stage, entity): [bucket counts, sum, count]
+        self.histograms = {}
+
+        # Phases by name: (duration, finished timestamp, succeeded)
+        self.phases = {}
+
+    def observe(self, stage, entity, status, seconds):
+        """
+        Record a single operation
+
+        :param stage:   Stage, e.g. 'lora_fetch'
+        :param entity:  Entity type, e.g. 'contacts'
+        :param status:  Status, e.g. 200 or 'miss'
+        :param seconds: Duration of the operation
+        """
+
+        key = (stage, str(entity), str(status))
+        index = bisect.bisect_left(self.buckets, seconds)
+
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+            histogram = self.histograms.setdefault(
+                (stage, str(entity)),
+                [[0] * len(self.buckets), 0.0, 0]
+            )
+
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def finish_phase(self, phase, seconds, succeeded):
+        with self.lock:
+            self.phases[phase] = (seconds, time.time(), succeeded)
+
+    def render(self):
+        """
+        Render the metrics (Prometheus text exposition format)
+
+        :return:    Returns text (string)
+        """
+
+        lines = []
+
+        def labels(**values):
+            return ",".join(
+                '{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+                for key, value in values.items()
+            )
+
+        with self.lock:
+            name = "{0}_operations_total".format(PREFIX)
+            lines.append("# HELP {0} Operations by stage.".format(name))
+            lines.append("# TYPE {0} counter".format(name))
+
+            for (stage, entity, status), count in sorted(self.counts.items()):
+                lines.append("{0}{{{1}}} {2}".format(
+                    name,
+                    labels(stage=stage, entity=entity, status=status),
+                    count
+                ))
+
+            name = "{0}_operation_duration_seconds".format(PREFIX)
+            lines.append("# HELP {0} Duration of operations.".format(name))
+            lines.append("# TYPE {0} histogram".format(name))
+
+            for (stage, entity), histogram in sorted(self.histograms.items()):
+                bucket_counts, total, count = histogram
+                cumulative = 0
+
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append("{0}_bucket{{{1}}} {2}".format(
+                        name,
+                        labels(stage=stage, entity=entity, le=bound),
+                        cumulative
+                    ))
+
+                lines.append("{0}_bucket{{{1}}} {2}".format(
+                    name,
+                    labels(stage=stage, entity=entity, le="+Inf"),
+                    count
+                ))
+                lines.append("{0}_sum{{{1}}} {2}".format(
+                    name, labels(stage=stage, entity=entity), total
+                ))
+                lines.append("{0}_count{{{1}}} {2}".format(
+                    name, labels(stage=stage, entity=entity), count
+                ))
+
+            for metric, kind, index in (
+                ("phase_duration_seconds", "gauge", 0),
+                ("phase_finished_timestamp_seconds", "gauge", 1),
+                ("phase_succeeded", "gauge", 2),
+            ):
+                name = "{0}_{1}".format(PREFIX, metric)
+                lines.append("# TYPE {0} {1}".format(name, kind))
+
+                for phase, values in sorted(self.phases.items()):
+                    lines.append("{0}{{{1}}} {2}".format(
+                        name, labels(phase=phase), float(values[index])
+                    ))
+
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry
+registry = Registry()
+
+
+def observe(stage, entity, status, seconds):
+    """
+    Record a single operation (See 'Registry.observe')
+    """
+
+    registry.observe(stage, entity, status, seconds)
+
+
+@contextmanager
+def timed(stage, entity):
+    """
+    Record the duration of an operation.
+    The status is set by the block (default: 'ok'),
+    if the block raises the status is 'error'.
+
+    Example:
+
+        with timed("cache_get", table) as status:
+            document = ...
+            status["status"] = "hit" if document else "miss"
+    """
+
+    status = {"status": "ok"}
+    started = time.monotonic()
+
+    try:
+        yield status
+    except Exception:
+        status["status"] = "error"
+        raise
+    finally:
+        observe(stage, entity, status["status"], time.monotonic() - started)
+
+
+def write_textfile(path=None):
+    """
+    Write the metrics to a file (textfile collector)
+    The file is replaced atomically, as such it is never read half written.
+
+    :param path:    File path (Default: METRICS_TEXTFILE)
+    """
+
+    path = path or METRICS_TEXTFILE
+
+    if not path:
+        return
+
+    temporary = "{0}.{1}.tmp".format(path, os.getpid())
+
+    with open(temporary, "w") as textfile:
+        textfile.write(registry.render())
+
+    os.replace(temporary, path)
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the duration and outcome of a phase (e.g. 'import', 'export')
+    and write the metrics once the phase has finished.
+
+    :param name:    Name of the phase
+    """
+
+    started = time.monotonic()
+    succeeded = False
+
+    try:
+        yield
+        succeeded = True
+    finally:
+        registry.finish_phase(name, time.monotonic() - started, succeeded)
+
+        try:
+            write_textfile()
+        except OSError as error:
+            log.error("Unable to write metrics: {0}".format(error))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics (GET /metrics)
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(port=None):
+    """
+    Serve the metrics over HTTP in a background thread.
+
+    :param port:    Port number (Default: METRICS_PORT)
+
+    :return:        Returns the server (or None if no port is configured)
+    """
+
+    port = port or METRICS_PORT
+
+    if not port:
+        return None
+
+    server = HTTPServer(("", port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    log.info("Serving metrics on port {0}".format(port))
+
+    return server
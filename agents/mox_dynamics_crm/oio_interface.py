@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import time
 import requests
+import metrics
 import ava_adapter as adapter
 
-from helper import get_config
+from helper import get_config, hash_document, is_changed, chunks, pipeline
 from logging import getLogger
 
 import cache_interface as cache
@@ -27,9 +29,28 @@ ORGANISATION_UUID = config["parent_organisation"] or None
 # By default this is set to 'Yes'
 DO_VERIFY_SSL_SIGNATURE = config.getboolean("do_verify_ssl_signature", True)
 
+# Concurrent requests (fetching batches) and conversion threads
+# used when importing a resource (See 'batch_generator')
+FETCH_WORKERS = config.getint("oio_fetch_workers", fallback=4)
+CONVERT_WORKERS = config.getint("oio_convert_workers", fallback=2)
+
+# Amount of batches waiting between the stages of the import
+PIPELINE_DEPTH = FETCH_WORKERS * 2
+
 # Init logging
 log = getLogger(__name__)
 
+# Connections are reused by the concurrent requests
+session = requests.Session()
+session.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_maxsize=FETCH_WORKERS)
+)
+session.mount(
+    "http://",
+    requests.adapters.HTTPAdapter(pool_maxsize=FETCH_WORKERS)
+)
+
 
 # Switch statement workaround
 # TODO: Please replace with sane code
@@ -71,10 +92,25 @@ def batch_generator(resource, list_of_uuids):
 
     :param resource:        Resource or name of the database entity
     :param list_of_uuids:   A list of identifiers (Type: uuid)
+                            (On incremental imports the list is filtered
+                            by LoRa, see 'get_all')
 
     :return:                Returns a generator (iterator).
                             Objects returned by the generator
                             are converted by the adapter (See ava_adapter.py).
+                            Each batch is returned as a tuple of
+                            (documents, identifiers of the new or changed
+                            documents).
+
+    Batches are fetched concurrently (FETCH_WORKERS)
+    and converted in a pool of threads (CONVERT_WORKERS).
+    The order of the batches is not preserved.
+    If a batch can not be fetched, the generator raises (RuntimeError),
+    as such an import is never recorded as finished with objects missing.
+
+    The caller queues the new or changed documents for export
+    once the batch has been written (See 'cache.queue_export'),
+    as such the export never reads the previous version of a document.
     """
 
     # Use switch to determine resource path
@@ -88,10 +124,10 @@ def batch_generator(resource, list_of_uuids):
     # max 96 uuids for new lora
     chunck = 90
 
-    # Generate batches until done
-    while len(list_of_uuids) > 0:
-        uuid_batch = list_of_uuids[:chunck]
-        list_of_uuids = list_of_uuids[chunck:]
+    def fetch(uuid_batch):
+        """
+        Fetch a batch of objects and their existing documents
+        """
 
         # Call GET request function
         results = get_request(
@@ -102,48 +138,79 @@ def batch_generator(resource, list_of_uuids):
         if not results:
             log.error("No results for batch: ")
             log.error(uuid_batch)
-            return False
+            raise RuntimeError(
+                "Unable to fetch batch of {resource}".format(
+                    resource=resource
+                )
+            )
+
+        with cache.checkout() as connection:
+            existing_adapted = {
+                d["id"]: d
+                for d in cache.r.table(
+                    table
+                    ).get_all(*uuid_batch).run(connection)
+            }
+
+        return results, existing_adapted
+
+    def convert(fetched):
+        """
+        Convert a batch of objects (See ava_adapter.py)
+        """
 
-        existing_adapted = {
-            d["id"]: d
-            for d in cache.r.table(
-                table
-                ).get_all(*uuid_batch).run(cache.connect())
-        }
+        results, existing_adapted = fetched
 
         batch = []
 
+        # New or changed documents (queued for export by the caller)
+        changed = []
+
         # Batch timestamp
         batch_timestamp = cache.r.now()
 
-        # Return iterator
         for result in results:
-            old_data = existing_adapted.get(result["id"], {}).get("data")
+            previous = existing_adapted.get(result["id"], {})
             try:
-                adapted = adapter(result, existing_adapted.get(result["id"], {}))
+                adapted = adapter(result, previous)
                 if not adapted:
                     raise ValueError()
-                if adapted.get("data") != old_data:
-                    adapted["import_changed"] = True
+                hash_document(adapted, previous)
                 adapted["updated"] = batch_timestamp
                 batch.append(adapted)
 
+                if is_changed(adapted, previous):
+                    changed.append(adapted["id"])
+
             except Exception as e:
                 log.error("error: %r", e)
                 log.error("incoming: %r", result)
                 log.error("retaining: %r", existing_adapted.get(result["id"], {}))
 
-        yield batch
+        return batch, changed
+
+    # Batches are fetched and converted concurrently,
+    # the caller (e.g. writing to the cache layer) is the last stage
+    return pipeline(
+        chunks(list_of_uuids, chunck),
+        [(fetch, FETCH_WORKERS), (convert, CONVERT_WORKERS)],
+        depth=PIPELINE_DEPTH
+    )
 
 
-def get_all(resource):
+def get_all(resource, registered_since=None):
     """
     Wrapper function to retrieve all objects uuids,
     which belong to the parent organisation (see settings on top).
 
-    :param resource:    Name of the resource path/entity
-    :return:            Returns a list of entity uuids
-                        (References only, not the actual database objects)
+    :param resource:            Name of the resource path/entity
+
+    :param registered_since:    Optional datetime (incremental import)
+                                Only objects registered since are returned
+                                (Search parameter 'registreretFra')
+
+    :return:                    Returns a list of entity uuids
+                                (References only, not the actual objects)
     """
 
     # Use switch to determine resource path
@@ -156,11 +223,25 @@ def get_all(resource):
         "Attempting to import: {0}".format(resource)
     )
 
+    params = {
+        "tilhoerer": ORGANISATION_UUID
+    }
+
+    if registered_since:
+        params["registreretFra"] = registered_since.isoformat()
+
     list_of_uuids = get_request(
         resource=resource,
-        tilhoerer=ORGANISATION_UUID
+        **params
     )
 
+    if not list_of_uuids:
+        if registered_since:
+            log.info("No {0} registered since last import".format(resource))
+        else:
+            log.error("No uuids returned")
+        return None
+
     # Debug
     log.debug(
         "{total_amount} {resource} uuid(s) returned".format(
@@ -169,10 +250,6 @@ def get_all(resource):
         )
     )
 
-    if not list_of_uuids:
-        log.error("No uuids returned")
-        return None
-
     return list_of_uuids
 
 
@@ -193,12 +270,21 @@ def get_request(resource, **params):
     )
 
     # GET REQUEST
-    oio_response = requests.get(
+    started = time.monotonic()
+
+    oio_response = session.get(
         url=service_url,
         params=params,
         verify=DO_VERIFY_SSL_SIGNATURE
     )
 
+    metrics.observe(
+        stage="lora_fetch",
+        entity=resource.rsplit("/", 1)[-1],
+        status=oio_response.status_code,
+        seconds=time.monotonic() - started
+    )
+
     # TODO: If request fails, Log to error queue
     if oio_response.status_code != 200:
         return False
@@ -11,35 +11,106 @@ import oio_interface as oio
 import cache_interface as cache
 import crm_interface as crm
 import pprint
+import threading
 
+from helper import get_config, chunks
 from logging import getLogger
+from collections import Counter
+from multiprocessing.dummy import Pool
 
 DO_WRITE = False
 
 # Init logging
 log = getLogger(__name__)
 
+# Get config
+config = get_config()
+
+# Number of concurrent delete requests (or $batch requests)
+PURGE_WORKERS = config.getint("purge_workers", fallback=8)
+
+# Amount of deletes sent in each $batch request
+PURGE_BATCH_SIZE = 100
+
+
+class PurgeReport(object):
+    """
+    Thread safe summary of the purge (counts by table and outcome)
+
+    Outcomes:
+        obsolete:   Not refreshed by the latest full import
+        protected:  Referenced by incidents in CRM (not deleted)
+        deleted:    Deleted in CRM
+        not_found:  Not found in CRM (already deleted)
+        failed:     Delete request failed (kept in the cache layer)
+        skipped:    Not deleted (DO_WRITE is disabled)
+        cached:     Removed from the cache layer
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, crm_table, outcome, amount=1):
+        with self.lock:
+            self.counts.setdefault(crm_table, Counter())[outcome] += amount
+
+    def summary(self):
+        """
+        :return:    Returns a summary of the purge (string)
+        """
+
+        lines = ["Purge summary:"]
+
+        with self.lock:
+            for crm_table, counts in self.counts.items():
+                lines.append(
+                    "{table}: {counts}".format(
+                        table=crm_table,
+                        counts=", ".join(
+                            "{0} {1}".format(amount, outcome)
+                            for outcome, amount in sorted(counts.items())
+                        )
+                    )
+                )
+
+        return "\n".join(lines)
+
 
 def delete_crm_entity(crm_table, lora_ref, external_ref):
-    """ deletes object in crm and then if it is subsequently not found there 
-        it is deleted in the cache_layer
+    """ deletes object in crm (a single DELETE request)
+        the object is removed from the cache layer by the caller
+        (See 'purge_objects') if it is no longer found in crm
+
+        :return: Returns the outcome (See 'PurgeReport')
     """
 
-    if not external_ref:
-        log.warn("ref error lora_ref:%s  external_ref:%s in %s delete in cache", 
+    if not DO_WRITE:
+        log.info("NOT deleting lora_ref:%s  external_ref:%s in %s",
             lora_ref, external_ref, crm_table
         )
-        if DO_WRITE:
-            cache.delete(crm_table, lora_ref)
-        return
+        return "skipped"
 
-    response = crm.get_request(
-        resource="{table_name}({crm_id})".format(
-            table_name=crm_table,
-            crm_id=external_ref
-        )
+    log.info("deleting lora_ref:%s  external_ref:%s in %s",
+        lora_ref, external_ref, crm_table
     )
 
+    response = crm.delete_request(
+        resource=crm_table,
+        identifier=external_ref
+    )
+
+    return delete_outcome(crm_table, lora_ref, external_ref, response)
+
+
+def delete_outcome(crm_table, lora_ref, external_ref, response):
+    """ Outcome of a DELETE request (or $batch operation)
+        A 404 response means that the object is already deleted
+    """
+
+    if response.status_code in [200, 204]:
+        return "deleted"
+
     if response.status_code in [404]:
         log.info(
             "not found in crm.{table_name} lora-id:{lora_id}, "
@@ -49,81 +120,103 @@ def delete_crm_entity(crm_table, lora_ref, external_ref):
                 crm_id=external_ref
             )
         )
+        return "not_found"
 
-    if DO_WRITE == True:
-        log.info("deleting lora_ref:%s  external_ref:%s in %s", 
-            lora_ref, external_ref, crm_table
-        )
-        response = crm.delete_request(
-            resource=crm_table,
-            identifier=external_ref
-        )
-    else:
-        log.info("NOT deleting lora_ref:%s  external_ref:%s in %s", 
-            lora_ref, external_ref, crm_table
+    log.error(
+        "unable to delete crm.{table_name} lora-id:{lora_id}, "
+        "crm-id:{crm_id}: {status} {text}".format(
+            table_name=crm_table,
+            lora_id=lora_ref,
+            crm_id=external_ref,
+            status=response.status_code,
+            text=response.text
         )
+    )
+    return "failed"
 
-    response = crm.get_request(
-        resource="{table_name}({crm_id})".format(
-            table_name=crm_table,
-            crm_id=external_ref
+
+def delete_crm_batch(crm_table, objects):
+    """ deletes a list of (lora_ref, external_ref) in crm
+        in a single $batch request.
+        Each delete is sent in its own changeset,
+        as such a failing delete does not roll back the others.
+
+        :return: Returns list of (lora_ref, outcome)
+    """
+
+    if not DO_WRITE:
+        return [
+            (lora_ref, delete_crm_entity(crm_table, lora_ref, external_ref))
+            for lora_ref, external_ref in objects
+        ]
+
+    outcomes = []
+    batch = crm.Batch()
+
+    for lora_ref, external_ref in objects:
+
+        def on_response(response, lora_ref=lora_ref,
+                        external_ref=external_ref):
+            outcomes.append((
+                lora_ref,
+                delete_outcome(crm_table, lora_ref, external_ref, response)
+            ))
+
+        batch.changeset()
+        batch.add(
+            "DELETE",
+            "{table_name}({crm_id})".format(
+                table_name=crm_table,
+                crm_id=external_ref
+            ),
+            on_response=on_response
         )
+
+    log.info("deleting {0} objects in {1} (batch)".format(
+        len(objects), crm_table)
     )
+    batch.flush()
+
+    return outcomes
 
-    # delete in cache if not found in crm
-    if response.status_code in [404]:
-        if DO_WRITE == True:
-            log.info(
-                "deleting from cache.{table_name} "
-                "lora-id:{lora_id}, "
-                "crm-id:{crm_id}".format(
-                    table_name=crm_table,
-                    lora_id=lora_ref,
-                    crm_id=external_ref
-                )
-            )
-            cache.delete(crm_table, lora_ref)
-        else:
-            log.info(
-                "NOT deleting from cache.{table_name} "
-                "lora-id:{lora_id}, "
-                "crm-id:{crm_id}".format(
-                    table_name=crm_table,
-                    lora_id=lora_ref,
-                    crm_id=external_ref
-                )
-            )
 
 def get_obsolete_objects_dict(crm_table):
     """ returns a dict with lora-id as key and object as value
         for all objects that were not updated in the latest import
     """
-    return {o["id"]:o for o in cache.all_obsolete(crm_table)}
+    return {o["id"]:o for o in cache.iter_obsolete(crm_table)}
 
 def get_semi_safe_to_delete_objects_dict(
     forbidden_refs, 
     forbidden_keys, 
-    objects 
+    objects,
+    crm_table=None
 ):
-    """ copies all objects into semi_safe_to_delete
-        and then removes any object from semi_safe_to_delete that is directly
+    """ returns the objects that are not directly
         referenced by any incident in dynamics_crm
         for contacts for example, it will disallow deleting if the objects 
         external_ref is referred to by any incident in '_ava_aktoer_value'
 
+        The forbidden refs of all the keys are combined in a single set,
+        as such the objects are filtered in a single pass.
+
         The name semi_safe refers to the fact that this is only looking 
         at direct references. 
         It does not take into account that a contact is mentioned here
         and then a customer_relation refers to that by use of an 'obind'
     """
-    semi_safe_to_delete=dict(objects)
+    forbidden = set()
     for k in forbidden_keys:
-        for loraid, o in objects.items():
-            if o.get("external_ref") in forbidden_refs[k]:
-                log.info("excluding refd by incident lora_ref:%s  external_ref:%s in %s", 
-                    loraid, o.get("external_ref"), crm_table
-                ) 
-                semi_safe_to_delete.pop(k, None)
+        forbidden.update(forbidden_refs.get(k, ()))
+
+    semi_safe_to_delete = {}
+    for loraid, o in objects.items():
+        if o.get("external_ref") and o.get("external_ref") in forbidden:
+            log.info("excluding refd by incident lora_ref:%s  external_ref:%s in %s", 
+                loraid, o.get("external_ref"), crm_table
+            ) 
+            continue
+        semi_safe_to_delete[loraid] = o
 
     return semi_safe_to_delete 
 
@@ -181,92 +274,172 @@ def get_deleted_objects(objects, oio_resource):
 
     return deleted_objects
 
-def purge_objects(purgable_objects, crm_table):
+def purge_objects(
+    purgable_objects,
+    crm_table,
+    workers=PURGE_WORKERS,
+    use_batch=False,
+    report=None
+):
+    """ deletes the objects in crm using a pool of workers,
+        either one DELETE request per object or $batch requests.
+        objects which are deleted (or no longer found) in crm
+        are removed from the cache layer in bulk
+    """
+    report = report or PurgeReport()
+
+    # objects without a crm reference are only removed from the cache
+    removable = []
+    objects = []
+
     for loraid, o in purgable_objects.items():
-        delete_crm_entity(crm_table, loraid, o.get("external_ref")) 
+        if o.get("external_ref"):
+            objects.append((loraid, o["external_ref"]))
+        else:
+            log.warn("ref error lora_ref:%s  external_ref:%s in %s delete in cache", 
+                loraid, o.get("external_ref"), crm_table
+            )
+            removable.append(loraid)
+
+    if use_batch:
+        def delete(batch):
+            return delete_crm_batch(crm_table, batch)
+
+        work = list(chunks(objects, PURGE_BATCH_SIZE))
+    else:
+        def delete(o):
+            return [(o[0], delete_crm_entity(crm_table, *o))]
+
+        work = objects
+
+    pool = Pool(max(1, workers))
+
+    try:
+        for outcomes in pool.imap_unordered(delete, work):
+            for loraid, outcome in outcomes:
+                report.add(crm_table, outcome)
+                if outcome in ["deleted", "not_found"]:
+                    removable.append(loraid)
+    finally:
+        pool.close()
+        pool.join()
+
+    if DO_WRITE and removable:
+        report.add(
+            crm_table, "cached", cache.delete_many(crm_table, removable)
+        )
+
+    return report
 
 def get_purgable_objects(
     crm_table, 
     forbidden_refs, 
     forbidden_keys,
+    report=None
 ):
     obsolete_objects = get_obsolete_objects_dict(crm_table)
     purgable_objects = get_semi_safe_to_delete_objects_dict(
         forbidden_refs,
         forbidden_keys,
-        obsolete_objects
+        obsolete_objects,
+        crm_table
     )
+    if report:
+        report.add(crm_table, "obsolete", len(obsolete_objects))
+        report.add(
+            crm_table,
+            "protected",
+            len(obsolete_objects) - len(purgable_objects)
+        )
     # we dont need this now, but we had it earlier - to see if they are really deleted in lora
     # purgable_objects = get_deleted_objects(purgable_objects, oio_resource)
     log.warn("purgable_objects %d of %s",len(purgable_objects),crm_table)
     return purgable_objects
 
 
-def purge_ava_kundeforhold(forbidden_refs):
+def purge_ava_kundeforhold(forbidden_refs, report=None, **options):
     crm_table = "accounts"
     oio_resource=oio.resources["interessefaellesskab"]["resource"]
     forbidden_keys=["_ava_kundeforhold_value", "_customerid_value" ]
     purgable_objects = get_purgable_objects(
         crm_table, 
         forbidden_refs, 
-        forbidden_keys
+        forbidden_keys,
+        report
     )
-    purge_objects(purgable_objects, crm_table)
+    purge_objects(purgable_objects, crm_table, report=report, **options)
 
 
-def purge_ava_aftales (forbidden_refs):
+def purge_ava_aftales(forbidden_refs, report=None, **options):
     crm_table = "ava_aftales"
     oio_resource=oio.resources["indsats"]["resource"]
     forbidden_keys=[]
     purgable_objects = get_purgable_objects(
         crm_table, 
         forbidden_refs, 
-        forbidden_keys
+        forbidden_keys,
+        report
     )
-    purge_objects(purgable_objects, crm_table)
+    purge_objects(purgable_objects, crm_table, report=report, **options)
 
 
-def purge_ava_installations(forbidden_refs):
+def purge_ava_installations(forbidden_refs, report=None, **options):
     crm_table = "ava_installations"    
     oio_resource=oio.resources["klasse"]["resource"]
     forbidden_keys=["_ava_installation_value"] 
     purgable_objects = get_purgable_objects(
         crm_table, 
         forbidden_refs, 
-        forbidden_keys
+        forbidden_keys,
+        report
     )
-    purge_objects(purgable_objects, crm_table)
+    purge_objects(purgable_objects, crm_table, report=report, **options)
 
-def purge_ava_contacts(forbidden_refs):
+def purge_ava_contacts(forbidden_refs, report=None, **options):
     crm_table = "contacts"    
     oio_resource=oio.resources["bruger"]["resource"]
     forbidden_keys=["_ava_aktoer_value"] 
     purgable_objects = get_purgable_objects(
         crm_table, 
         forbidden_refs, 
-        forbidden_keys
+        forbidden_keys,
+        report
     )
-    purge_objects(purgable_objects, crm_table)
+    purge_objects(purgable_objects, crm_table, report=report, **options)
 
-def purge_ava_kunderolles(forbidden_refs):
+def purge_ava_kunderolles(forbidden_refs, report=None, **options):
     crm_table = "ava_kunderolles"    
     oio_resource=oio.resources["organisationfunktion"]["resource"]
     forbidden_keys=[]
     purgable_objects = get_purgable_objects(
         crm_table, 
         forbidden_refs, 
-        forbidden_keys
+        forbidden_keys,
+        report
     )
-    purge_objects(purgable_objects, crm_table)
+    purge_objects(purgable_objects, crm_table, report=report, **options)
+
 
+def run_purge(workers=PURGE_WORKERS, use_batch=False):
+    """ purges all obsolete objects (See 'purge_objects')
 
-def run_purge():
+        :param workers:     number of concurrent delete requests
+        :param use_batch:   send the deletes in $batch requests
+
+        :return:            returns the summary (PurgeReport)
+    """
     incident_relations = find_incident_relations()
+    report = PurgeReport()
+    options = {"workers": workers, "use_batch": use_batch}
+
+    purge_ava_kundeforhold(incident_relations, report, **options)
+    purge_ava_aftales(incident_relations, report, **options)
+    purge_ava_installations(incident_relations, report, **options)
+    purge_ava_contacts(incident_relations, report, **options)
+    purge_ava_kunderolles(incident_relations, report, **options)
+
+    log.info(report.summary())
 
-    purge_ava_kundeforhold(incident_relations)
-    purge_ava_aftales(incident_relations)
-    purge_ava_installations(incident_relations)
-    purge_ava_contacts(incident_relations)
-    purge_ava_kunderolles(incident_relations)
+    return report
 
 
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import cache_interface as cache
+import crm_interface as crm
+
+from logging import getLogger
+from collections import Counter
+
+# Init logging
+log = getLogger(__name__)
+
+# Cache layer tables and the corresponding CRM entity sets
+TABLES = [
+    ("ava_adresses", "ava_adresses"),
+    ("access", "ava_adresses"),
+    ("contacts", "contacts"),
+    ("accounts", "accounts"),
+    ("ava_aftales", "ava_aftales"),
+    ("ava_installations", "ava_installations"),
+    ("ava_kunderolles", "ava_kunderolles"),
+]
+
+
+def get_crm_refs(resource, partitions=16, workers=4):
+    """
+    Get the identifiers of all entities of an entity set in CRM
+    (See 'crm.iter_entities_parallel')
+
+    :param resource:    Resource (entity set), e.g. 'contacts'
+
+    :return:            Returns set of identifiers (lower case)
+    """
+
+    identifier = crm.ENTITY_IDENTIFIERS[resource]
+
+    entities = crm.iter_entities_parallel(
+        resource,
+        select=[identifier],
+        partitions=partitions,
+        workers=workers
+    )
+
+    return set(entity[identifier].lower() for entity in entities)
+
+
+def reconcile_table(table, crm_refs, fix=False, referenced=None):
+    """
+    Compare the CRM references ('external_ref') of the documents
+    in a cache layer table with the entities which exist in CRM.
+
+    Documents which reference an entity that no longer exists in CRM
+    are reported, and if 'fix' is set, the reference is cleared
+    and the document is queued for export (See 'cache.queue_export'),
+    as such the entity is created again by the next export.
+
+    :param table:       Table name
+    :param crm_refs:    Set of identifiers in CRM (See 'get_crm_refs')
+    :param fix:         Clear the missing references
+    :param referenced:  Optional set, the CRM references
+                        of the documents are added to it
+
+    :return:            Returns counts (Counter)
+    """
+
+    counts = Counter()
+    missing = []
+
+    if referenced is None:
+        referenced = set()
+
+    for document in cache.iter_all(table):
+        external_ref = document.get("external_ref")
+
+        if not external_ref:
+            counts["unexported"] += 1
+            continue
+
+        external_ref = str(external_ref).lower()
+        referenced.add(external_ref)
+
+        if external_ref in crm_refs:
+            counts["matched"] += 1
+        else:
+            counts["missing"] += 1
+            missing.append(document)
+
+            log.warning(
+                "{table}: {id} references missing crm entity {ref}".format(
+                    table=table,
+                    id=document["id"],
+                    ref=external_ref
+                )
+            )
+
+    if fix and missing:
+        for document in missing:
+            document["external_ref"] = None
+            document.pop("exported_hash", None)
+            cache.write_behind(table, document)
+
+        cache.queue_export(table, [document["id"] for document in missing])
+        cache.flush_writes()
+
+        counts["fixed"] = len(missing)
+
+    return counts
+
+
+def run_reconcile(fix=False, partitions=16, workers=4):
+    """
+    Reconcile all cache layer tables against CRM (See 'reconcile_table')
+
+    :param fix:         Clear the references to missing CRM entities
+    :param partitions:  Amount of identifier ranges per entity set
+    :param workers:     Amount of ranges scanned concurrently
+
+    :return:            Returns counts by table,
+                        and by entity set ('crm <resource>')
+                        the entities in CRM and the entities
+                        not referenced by any table
+    """
+
+    crm_refs = {}
+    referenced = {}
+    report = {}
+
+    for table, resource in TABLES:
+        if resource not in crm_refs:
+            crm_refs[resource] = get_crm_refs(resource, partitions, workers)
+
+            log.info("{resource}: {count} entities in crm".format(
+                resource=resource,
+                count=len(crm_refs[resource])
+            ))
+
+        report[table] = reconcile_table(
+            table,
+            crm_refs[resource],
+            fix,
+            referenced.setdefault(resource, set())
+        )
+
+        log.info("{table}: {counts}".format(
+            table=table,
+            counts=dict(report[table])
+        ))
+
+    # Entity sets may be shared by several tables (e.g. addresses),
+    # as such the references of all tables are compared
+    for resource, refs in crm_refs.items():
+        key = "crm {resource}".format(resource=resource)
+
+        report[key] = Counter(
+            entities=len(refs),
+            unreferenced=len(refs - referenced[resource])
+        )
+
+        log.info("{key}: {counts}".format(key=key, counts=dict(report[key])))
+
+    return report
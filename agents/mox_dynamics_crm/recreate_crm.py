@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from helper import get_config
-from crm_interface import get_request
+from crm_interface import iter_entities
 from crm_interface import delete_request
+from multiprocessing.dummy import Pool
 
 
 ###################################
@@ -23,6 +24,9 @@ config = get_config("ms_dynamics_crm")
 # Configuration
 CRM_OWNER_ID = config["crm_owner_id"]
 
+# Number of concurrent delete requests
+DELETE_WORKERS = 8
+
 
 def retrieve_all_object_guids(identifier, resource):
     """
@@ -36,27 +40,16 @@ def retrieve_all_object_guids(identifier, resource):
     :param resource:    Name of the API resource, e.g. contacts
                         {REST_API}/<resource>
 
-    :return:            Returns list of CRM GUID's or None
+    :return:            Returns a generator (iterator) of CRM objects
+                        (containing only the identifier)
+                        All pages are retrieved (See 'iter_entities')
     """
 
-    # Query parameters
-    params = {
-        "$select": identifier,
-        "$filter": "_ownerid_value eq {0}".format(CRM_OWNER_ID)
-    }
-
-    # Call underlying GET request
-    query = get_request(resource, **params)
-
-    # Results
-    list_of_contacts = query.json()["value"]
-
-    if not list_of_contacts:
-        print("Contact does not exist in CRM")
-        return False
-
-    # If object exists return identifier
-    return list_of_contacts
+    return iter_entities(
+        resource,
+        select=[identifier],
+        filter="_ownerid_value eq {0}".format(CRM_OWNER_ID)
+    )
 
 
 def delete_all(identifier, resource):
@@ -78,16 +71,18 @@ def delete_all(identifier, resource):
                         Activity is printed in the terminal.
     """
 
-    entities = retrieve_all_object_guids(
+    # The identifiers are retrieved before deleting,
+    # as deleting while paging would shift the pages
+    entities = list(retrieve_all_object_guids(
         identifier=identifier,
         resource=resource
-    )
+    ))
 
     if not entities:
         print("No {0} returned".format(resource))
         return
 
-    for entity in entities:
+    def delete(entity):
         guid = entity[identifier]
 
         response = delete_request(resource, guid)
@@ -104,6 +99,14 @@ def delete_all(identifier, resource):
             )
         )
 
+    pool = Pool(DELETE_WORKERS)
+
+    try:
+        pool.map(delete, entities)
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,18 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import os
+
+from .utils import FIXTURES
+
+# The modules read the configuration when they are imported
+os.environ.setdefault(
+    "MOX_DYNAMICS_CRM_CONFIG",
+    os.path.join(FIXTURES, "config.ini")
+)
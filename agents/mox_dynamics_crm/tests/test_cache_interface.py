@@ -0,0 +1,345 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+# Testing import
+import cache_interface as cache
+
+
+class FakeConnection(object):
+    """Stands in for a RethinkDB connection."""
+
+    def __init__(self):
+        self.open = True
+
+        # Dropped by the server (still open on the client)
+        self.dropped = False
+        self.pings = 0
+
+    def is_open(self):
+        return self.open
+
+    def close(self, noreply_wait=True):
+        self.open = False
+
+
+class PingingConnectionPool(cache.ConnectionPool):
+    """Connection pool pinging the fake connections."""
+
+    def ping(self, connection):
+        connection.pings += 1
+        return not connection.dropped
+
+
+class RecordingWriteBuffer(cache.WriteBuffer):
+    """Write buffer recording the writes rather than sending them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = []
+
+    def write(self, dirty):
+        self.writes.append(dirty)
+        return [{"inserted": len(documents)} for documents in dirty.values()]
+
+
+class test_connection_pool(TestCase):
+
+    def setUp(self):
+        self.created = []
+
+        def factory():
+            connection = FakeConnection()
+            self.created.append(connection)
+            return connection
+
+        self.pool = PingingConnectionPool(factory, size=2, ping_after=60)
+
+    def test_connection_is_reused(self):
+        with self.pool.connection() as first:
+            pass
+
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(1, len(self.created))
+
+    def test_concurrent_checkouts_get_separate_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first, second)
+
+        self.assertEqual(2, len(self.created))
+
+    def test_idle_connections_are_limited(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                with self.pool.connection():
+                    pass
+
+        # Only 'size' idle connections are kept open,
+        # the connection returned last is closed
+        self.assertEqual(3, len(self.created))
+        self.assertEqual(
+            [True, True, False],
+            [connection.is_open() for connection in reversed(self.created)]
+        )
+        self.assertEqual(2, self.pool.idle.qsize())
+
+    def test_closed_connection_is_replaced(self):
+        with self.pool.connection() as first:
+            pass
+
+        first.close()
+
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertTrue(second.is_open())
+
+    def test_recently_used_connection_is_not_pinged(self):
+        with self.pool.connection() as first:
+            pass
+
+        with self.pool.connection():
+            pass
+
+        self.assertEqual(0, first.pings)
+
+    def test_idle_connection_is_pinged(self):
+        self.pool.ping_after = 0
+
+        with self.pool.connection() as first:
+            pass
+
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(1, first.pings)
+
+    def test_dropped_connection_is_replaced(self):
+        self.pool.ping_after = 0
+
+        with self.pool.connection() as first:
+            pass
+
+        first.dropped = True
+
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertFalse(first.is_open())
+        self.assertEqual(2, len(self.created))
+
+    def test_ping(self):
+        pool = cache.ConnectionPool(FakeConnection)
+
+        class Query(object):
+            def __init__(self, error=None):
+                self.error = error
+
+            def run(self, connection):
+                if self.error:
+                    raise self.error
+                return 1
+
+        with patch("cache_interface.r.expr", lambda value: Query()):
+            self.assertTrue(pool.ping(FakeConnection()))
+
+        error = cache.r.ReqlDriverError("Connection is closed")
+
+        with patch("cache_interface.r.expr", lambda value: Query(error)):
+            self.assertFalse(pool.ping(FakeConnection()))
+
+    def test_connection_is_discarded_on_driver_error(self):
+        with self.assertRaises(cache.r.ReqlDriverError):
+            with self.pool.connection() as first:
+                raise cache.r.ReqlDriverError("Connection lost")
+
+        self.assertFalse(first.is_open())
+        self.assertEqual(0, self.pool.idle.qsize())
+
+    def test_other_errors_keep_the_connection(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as first:
+                raise ValueError()
+
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+
+    def test_close(self):
+        with self.pool.connection() as connection:
+            pass
+
+        self.pool.close()
+
+        self.assertFalse(connection.is_open())
+        self.assertEqual(0, self.pool.idle.qsize())
+
+
+class test_write_buffer(TestCase):
+
+    def test_pending_document(self):
+        buffer = RecordingWriteBuffer(size=10, age=60)
+        document = {"id": "a", "data": {"name": "first"}}
+
+        buffer.add("contacts", document)
+
+        # The document is copied when added
+        document["data"]["name"] = "changed"
+
+        pending = buffer.pending("contacts", "a")
+        self.assertEqual({"id": "a", "data": {"name": "first"}}, pending)
+
+        # ... and when returned
+        pending["data"]["name"] = "changed"
+        self.assertEqual(
+            "first", buffer.pending("contacts", "a")["data"]["name"]
+        )
+
+        self.assertIsNone(buffer.pending("contacts", "b"))
+        self.assertIsNone(buffer.pending("accounts", "a"))
+
+    def test_latest_version_is_written_once(self):
+        buffer = RecordingWriteBuffer(size=10, age=60)
+
+        buffer.add("contacts", {"id": "a", "version": 1})
+        buffer.add("contacts", {"id": "a", "version": 2})
+        buffer.add("accounts", {"id": "b"})
+
+        self.assertEqual(2, buffer.count)
+
+        results = buffer.flush()
+
+        self.assertEqual(2, len(results))
+        self.assertEqual([{
+            "contacts": {"a": {"id": "a", "version": 2}},
+            "accounts": {"b": {"id": "b"}},
+        }], buffer.writes)
+
+        self.assertIsNone(buffer.pending("contacts", "a"))
+        self.assertEqual([], buffer.flush())
+
+    def test_flush_when_full(self):
+        buffer = RecordingWriteBuffer(size=2, age=60)
+
+        buffer.add("contacts", {"id": "a"})
+        self.assertEqual([], buffer.writes)
+
+        buffer.add("contacts", {"id": "b"})
+        self.assertEqual(1, len(buffer.writes))
+        self.assertEqual(0, buffer.count)
+
+    def test_flush_when_old(self):
+        flushed = threading.Event()
+
+        class TimedWriteBuffer(RecordingWriteBuffer):
+            def write(self, dirty):
+                result = super().write(dirty)
+                flushed.set()
+                return result
+
+        buffer = TimedWriteBuffer(size=10, age=0.05)
+        buffer.add("contacts", {"id": "a"})
+
+        # Flushed by the timer, nothing else is added
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual([{"contacts": {"a": {"id": "a"}}}], buffer.writes)
+
+    def test_pending_while_flushing(self):
+        writing = threading.Event()
+        written = threading.Event()
+
+        class SlowWriteBuffer(RecordingWriteBuffer):
+            def write(self, dirty):
+                writing.set()
+                written.wait(5)
+                return super().write(dirty)
+
+        buffer = SlowWriteBuffer(size=10, age=60)
+        buffer.add("contacts", {"id": "a", "version": 1})
+
+        thread = threading.Thread(target=buffer.flush)
+        thread.start()
+        self.assertTrue(writing.wait(5))
+
+        # The document is still found while the insert is in progress
+        self.assertEqual(1, buffer.pending("contacts", "a")["version"])
+
+        # A newer version (added during the flush) is found first
+        buffer.add("contacts", {"id": "a", "version": 2})
+        self.assertEqual(2, buffer.pending("contacts", "a")["version"])
+
+        written.set()
+        thread.join(5)
+
+        self.assertEqual([], buffer.flushing)
+        self.assertEqual(2, buffer.pending("contacts", "a")["version"])
+
+    def test_flushes_are_written_in_order(self):
+        writing = threading.Event()
+        written = threading.Event()
+
+        class SlowWriteBuffer(RecordingWriteBuffer):
+            def write(self, dirty):
+                # Only the first write is slow
+                if not writing.is_set():
+                    writing.set()
+                    written.wait(5)
+                return super().write(dirty)
+
+        buffer = SlowWriteBuffer(size=10, age=60)
+        buffer.add("contacts", {"id": "a", "version": 1})
+
+        first = threading.Thread(target=buffer.flush)
+        first.start()
+        self.assertTrue(writing.wait(5))
+
+        # A newer version is flushed while the first flush is in progress
+        buffer.add("contacts", {"id": "a", "version": 2})
+        second = threading.Thread(target=buffer.flush)
+        second.start()
+
+        # The second flush waits for the first
+        second.join(0.1)
+        self.assertTrue(second.is_alive())
+        self.assertEqual(2, buffer.pending("contacts", "a")["version"])
+
+        written.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(
+            [1, 2],
+            [dirty["contacts"]["a"]["version"] for dirty in buffer.writes]
+        )
+
+    def test_dry_run(self):
+        buffer = cache.WriteBuffer(size=10, age=60)
+        buffer.add("contacts", {"id": "a"})
+
+        do_write = cache.DO_WRITE
+        cache.DO_WRITE = False
+
+        try:
+            # Nothing is written (no connection is made)
+            self.assertEqual([], buffer.flush())
+        finally:
+            cache.DO_WRITE = do_write
+
+        self.assertIsNone(buffer.pending("contacts", "a"))
@@ -0,0 +1,283 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import json
+import time
+import threading
+import email.utils
+from unittest import TestCase
+
+# Testing import
+import crm_interface as crm
+
+
+class FakeResponse(object):
+    """Stands in for a requests response."""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class test_retry_after(TestCase):
+
+    def test_seconds(self):
+        response = FakeResponse(429, {"Retry-After": "12"})
+        self.assertEqual(12, crm.retry_after(response))
+
+    def test_missing(self):
+        response = FakeResponse(429)
+        self.assertEqual(crm.RETRY_AFTER_DEFAULT, crm.retry_after(response))
+
+    def test_negative(self):
+        response = FakeResponse(429, {"Retry-After": "-3"})
+        self.assertEqual(0, crm.retry_after(response))
+
+    def test_http_date(self):
+        value = email.utils.formatdate(time.time() + 30, usegmt=True)
+        response = FakeResponse(503, {"Retry-After": value})
+
+        self.assertAlmostEqual(30, crm.retry_after(response), delta=2)
+
+    def test_past_http_date(self):
+        value = email.utils.formatdate(time.time() - 30, usegmt=True)
+        response = FakeResponse(503, {"Retry-After": value})
+
+        self.assertEqual(0, crm.retry_after(response))
+
+    def test_invalid(self):
+        response = FakeResponse(429, {"Retry-After": "soon"})
+        self.assertEqual(crm.RETRY_AFTER_DEFAULT, crm.retry_after(response))
+
+
+class test_rate_limiter(TestCase):
+
+    def test_throttled_response_halves_the_rate(self):
+        limiter = crm.RateLimiter(max_rate=20, min_rate=4)
+
+        for expected_rate in (10, 5, 4):
+            limiter.acquire()
+            limiter.release(FakeResponse(429, {"Retry-After": "0"}))
+            self.assertEqual(expected_rate, limiter.rate)
+
+        self.assertEqual(3, limiter.throttled)
+
+    def test_successful_responses_raise_the_rate(self):
+        limiter = crm.RateLimiter(max_rate=20, min_rate=1)
+        limiter.rate = 10
+
+        limiter.acquire()
+        limiter.release(FakeResponse(200))
+        self.assertAlmostEqual(10.1, limiter.rate)
+
+        # The rate never exceeds the maximum
+        limiter.rate = 20
+        limiter.acquire()
+        limiter.release(FakeResponse(204))
+        self.assertEqual(20, limiter.rate)
+
+    def test_failed_request_keeps_the_rate(self):
+        limiter = crm.RateLimiter(max_rate=20)
+        limiter.rate = 10
+
+        limiter.acquire()
+        limiter.release(None)
+
+        self.assertEqual(10, limiter.rate)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_throttled_response_pauses_requests(self):
+        limiter = crm.RateLimiter(max_rate=1000, min_rate=500)
+
+        limiter.acquire()
+        limiter.release(FakeResponse(429, {"Retry-After": "0.2"}))
+
+        started = time.monotonic()
+        limiter.acquire()
+        limiter.release(FakeResponse(200))
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def test_concurrency_is_limited(self):
+        limiter = crm.RateLimiter(max_rate=1000, max_concurrency=1)
+        acquired = threading.Event()
+
+        def request():
+            limiter.acquire()
+            acquired.set()
+            limiter.release(FakeResponse(200))
+
+        limiter.acquire()
+
+        thread = threading.Thread(target=request)
+        thread.start()
+
+        # The second request waits for the first to finish
+        self.assertFalse(acquired.wait(0.1))
+
+        limiter.release(FakeResponse(200))
+
+        self.assertTrue(acquired.wait(5))
+        thread.join(5)
+
+        self.assertEqual(1, limiter.max_in_flight)
+        self.assertEqual(2, limiter.metrics()["requests"])
+
+
+# A $batch response with a changeset of two operations
+BATCH_RESPONSE = "\r\n".join([
+    "--batchresponse_1",
+    "Content-Type: multipart/mixed; boundary=changesetresponse_1",
+    "",
+    "--changesetresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "Content-ID: 1",
+    "",
+    "HTTP/1.1 204 No Content",
+    "OData-Version: 4.0",
+    "OData-EntityId: https://test.crm.dynamics.com/api/data/v8.2/"
+    "ava_adresses(5a4c3b2a-0000-0000-0000-000000000001)",
+    "",
+    "",
+    "--changesetresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "Content-ID: 2",
+    "",
+    "HTTP/1.1 400 Bad Request",
+    "Content-Type: application/json; odata.metadata=minimal",
+    "",
+    '{"error": {"message": "Invalid payload"}}',
+    "--changesetresponse_1--",
+    "--batchresponse_1--",
+    ""
+])
+
+
+class test_batch(TestCase):
+
+    def test_compose_batch(self):
+        changesets = [[
+            {
+                "content_id": 1,
+                "method": "POST",
+                "resource": "ava_adresses",
+                "payload": {"ava_name": "Testgade 1"}
+            },
+            {
+                "content_id": 2,
+                "method": "POST",
+                "resource": "contacts",
+                "payload": {"ava_adresse@odata.bind": "$1"}
+            },
+            {
+                "content_id": 3,
+                "method": "DELETE",
+                "resource": "accounts(1234)",
+                "payload": None
+            },
+        ]]
+
+        body = crm.compose_batch("batch_1", changesets)
+        lines = body.split("\r\n")
+
+        self.assertEqual("--batch_1", lines[0])
+        self.assertEqual(["--batch_1--", ""], lines[-2:])
+        self.assertTrue(
+            lines[1].startswith("Content-Type: multipart/mixed;boundary=")
+        )
+
+        self.assertIn(
+            "POST {0}/ava_adresses HTTP/1.1".format(crm.base_endpoint),
+            lines
+        )
+        self.assertIn(
+            "DELETE {0}/accounts(1234) HTTP/1.1".format(crm.base_endpoint),
+            lines
+        )
+        self.assertEqual(
+            ["Content-ID: 1", "Content-ID: 2", "Content-ID: 3"],
+            [line for line in lines if line.startswith("Content-ID")]
+        )
+        self.assertIn(json.dumps({"ava_adresse@odata.bind": "$1"}), lines)
+
+        # One changeset boundary per operation, and a closing boundary
+        changeset_boundary = lines[1].split("boundary=")[1]
+        self.assertEqual(
+            3, lines.count("--{0}".format(changeset_boundary))
+        )
+        self.assertIn("--{0}--".format(changeset_boundary), lines)
+
+    def test_compose_batch_content_id_resource(self):
+        changesets = [[{
+            "content_id": 2,
+            "method": "POST",
+            "resource": "$1/ava_aktoerens_aftaler/$ref",
+            "payload": {"@odata.id": "ava_aftales(1234)"}
+        }]]
+
+        body = crm.compose_batch("batch_1", changesets)
+
+        self.assertIn("POST $1/ava_aktoerens_aftaler/$ref HTTP/1.1", body)
+
+    def test_parse_batch_response(self):
+        responses = crm.parse_batch_response(
+            "multipart/mixed; boundary=batchresponse_1",
+            BATCH_RESPONSE
+        )
+
+        self.assertEqual(["$1", "$2"], sorted(responses))
+
+        created, failed = responses["$1"], responses["$2"]
+
+        self.assertEqual(204, created.status_code)
+        self.assertTrue(created)
+        self.assertEqual(
+            "5a4c3b2a-0000-0000-0000-000000000001",
+            created.entity_id()
+        )
+
+        self.assertEqual(400, failed.status_code)
+        self.assertFalse(failed)
+        self.assertIsNone(failed.entity_id())
+        self.assertEqual(
+            "Invalid payload",
+            failed.json()["error"]["message"]
+        )
+
+    def test_flush_resolves_references(self):
+        do_write = crm.DO_WRITE
+        crm.DO_WRITE = False
+
+        responses = []
+
+        try:
+            batch = crm.Batch()
+            address = batch.add("POST", "ava_adresses", {})
+            batch.add(
+                "POST",
+                "contacts",
+                {"ava_adresse@odata.bind": address},
+                responses.append
+            )
+
+            self.assertEqual("$1", address)
+
+            batch.flush()
+        finally:
+            crm.DO_WRITE = do_write
+
+        self.assertEqual(1, len(responses))
+        self.assertTrue(responses[0])
+
+        resolved = batch.resolve(address)
+        self.assertTrue(resolved.startswith("/ava_adresses("))
+        self.assertEqual("plain", batch.resolve("plain"))
+        self.assertEqual(0, len(batch))
@@ -0,0 +1,135 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import copy
+from unittest import TestCase
+from unittest.mock import patch
+
+# Testing import
+import export_client
+
+
+class FakeBatch(object):
+    """Stands in for 'crm.Batch', no requests are sent."""
+
+    fail = False
+
+    def __init__(self):
+        self.operations = []
+
+    def changeset(self):
+        pass
+
+    def add(self, method, resource, payload=None, on_response=None):
+        self.operations.append((method, resource))
+        return "${0}".format(len(self.operations))
+
+    def flush(self):
+        if self.fail:
+            raise IOError("CRM is unavailable")
+
+    def resolve(self, value):
+        return value
+
+
+class FailingBatch(FakeBatch):
+    fail = True
+
+
+def export_graph():
+    address = {
+        "id": "address",
+        "external_ref": None,
+        "data": {"ava_name": "Testgade 1, 9999 Testby"}
+    }
+
+    return {
+        "contacts": {
+            "contact": {
+                "id": "contact",
+                "dawa_ref": "address",
+                "external_ref": None,
+                "data": {
+                    "ava_emailkmdee": "email@example.com",
+                    "ava_mobilkmdee": "11223344"
+                }
+            }
+        },
+        "accounts": {
+            "account": {
+                "id": "account",
+                "dawa_ref": "address",
+                "external_ref": None,
+                "data": {"ava_kundenummer": "123456"}
+            }
+        },
+        "ava_adresses": {"address": address},
+        "access": {},
+        "indsats": {},
+        "ava_installations": {},
+    }
+
+
+@patch("export_client.save", lambda *args, **kwargs: None)
+@patch("export_client.cache.find_indsats", lambda *args: None)
+@patch("export_client.cache.get", lambda *args, **kwargs: None)
+class test_export_batch(TestCase):
+
+    def setUp(self):
+        self.kunderolle = {
+            "id": "kunderolle",
+            "contact_ref": "contact",
+            "interessefaellesskab_ref": "account",
+            "external_ref": None,
+            "data": {}
+        }
+
+    def test_failed_batch_leaves_the_graph_unchanged(self):
+        graph = export_graph()
+        unchanged = copy.deepcopy(graph)
+        kunderolle = copy.deepcopy(self.kunderolle)
+
+        with patch("export_client.crm.Batch", FailingBatch):
+            with self.assertRaises(IOError):
+                export_client.process(kunderolle, graph, use_batch=True)
+
+        # No Content-ID references are left in the documents
+        self.assertEqual(unchanged, graph)
+        self.assertEqual(self.kunderolle, kunderolle)
+
+    def test_sent_batch_updates_the_graph(self):
+        graph = export_graph()
+        address = graph["ava_adresses"]["address"]
+
+        with patch("export_client.crm.Batch", FakeBatch):
+            export_client.process(self.kunderolle, graph, use_batch=True)
+
+        # The documents of the graph are updated in place
+        self.assertIs(address, graph["ava_adresses"]["address"])
+        self.assertEqual("$1", address["external_ref"])
+        self.assertEqual(
+            "$1",
+            graph["contacts"]["contact"]["data"]["ava_adresse@odata.bind"]
+        )
+
+    def test_shared_entity_is_sent_once(self):
+        graph = export_graph()
+        batches = []
+
+        class RecordingBatch(FakeBatch):
+            def __init__(self):
+                super().__init__()
+                batches.append(self)
+
+        with patch("export_client.crm.Batch", RecordingBatch):
+            export_client.process(self.kunderolle, graph, use_batch=True)
+
+        # The address of the contact is also the utility address
+        operations = batches[0].operations
+        self.assertEqual(1, operations.count(("POST", "ava_adresses")))
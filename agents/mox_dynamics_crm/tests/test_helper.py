@@ -0,0 +1,81 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from unittest import TestCase
+
+# Testing import
+from helper import pipeline
+
+
+class test_pipeline(TestCase):
+
+    def test_all_items_pass_all_stages(self):
+        stages = [(lambda item: item * 2, 3), (lambda item: item + 1, 2)]
+
+        results = pipeline(range(100), stages, depth=2)
+
+        self.assertEqual(
+            sorted(item * 2 + 1 for item in range(100)),
+            sorted(results)
+        )
+
+    def test_none_is_dropped(self):
+        def odd(item):
+            return item if item % 2 else None
+
+        results = pipeline(range(10), [(odd, 2)])
+
+        self.assertEqual([1, 3, 5, 7, 9], sorted(results))
+
+    def test_iterator_results_are_passed_on(self):
+        def pages(item):
+            for page in range(item):
+                yield (item, page)
+
+        results = pipeline([1, 2, 3], [(pages, 2)])
+
+        self.assertEqual(
+            [(1, 0), (2, 0), (2, 1), (3, 0), (3, 1), (3, 2)],
+            sorted(results)
+        )
+
+    def test_stage_error_is_raised(self):
+        def fetch(item):
+            if item == 50:
+                raise IOError("Unable to fetch {0}".format(item))
+            return item
+
+        results = pipeline(range(1000), [(fetch, 4), (lambda item: item, 2)])
+
+        with self.assertRaises(IOError):
+            list(results)
+
+    def test_error_in_last_stage_is_raised(self):
+        def convert(item):
+            raise ValueError(item)
+
+        with self.assertRaises(ValueError):
+            list(pipeline(range(10), [(lambda item: item, 2), (convert, 1)]))
+
+    def test_items_error_is_raised(self):
+        def items():
+            yield 1
+            raise RuntimeError("Unable to list items")
+
+        with self.assertRaises(RuntimeError):
+            list(pipeline(items(), [(lambda item: item, 2)]))
+
+    def test_iterator_error_is_raised(self):
+        def pages(item):
+            yield item
+            raise IOError("Unable to fetch the next page")
+
+        with self.assertRaises(IOError):
+            list(pipeline(range(3), [(pages, 2)]))
+
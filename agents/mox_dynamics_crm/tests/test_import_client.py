@@ -0,0 +1,77 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from unittest import TestCase
+from unittest.mock import patch
+
+# Testing import
+import import_client
+
+
+class test_import_to_cache(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def store(resource, payload):
+            self.calls.append(("store", [d["id"] for d in payload]))
+
+        def queue_export(table, uuids):
+            self.calls.append(("queue_export", table, uuids))
+
+        for target, function in (
+            ("import_client.cache.store", store),
+            ("import_client.cache.queue_export", queue_export),
+        ):
+            patcher = patch(target, function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_changed_documents_are_queued_once_written(self):
+        batches = [
+            ([{"id": "a"}, {"id": "b"}], ["b"]),
+            ([{"id": "c"}], []),
+        ]
+
+        with patch("import_client.oio.get_all", lambda *args: ["a", "b"]):
+            with patch(
+                "import_client.oio.batch_generator",
+                lambda *args: iter(batches)
+            ):
+                import_client.import_to_cache("bruger")
+
+        self.assertEqual([
+            ("store", ["a", "b"]),
+            ("queue_export", "contacts", ["b"]),
+            ("store", ["c"]),
+            ("queue_export", "contacts", []),
+        ], self.calls)
+
+    def test_changed_addresses_are_queued_once_written(self):
+        chunks = [([{"id": "a"}], ["a"])]
+
+        with patch("import_client.dawa.iter_all", lambda *args: chunks):
+            import_client.import_all_addresses()
+
+        self.assertEqual([
+            ("store", ["a"]),
+            ("queue_export", "ava_adresses", ["a"]),
+        ], self.calls)
+
+    def test_addresses_are_not_queued_if_not_written(self):
+        def store(resource, payload):
+            raise IOError("Unable to write")
+
+        chunks = [([{"id": "a"}], ["a"])]
+
+        with patch("import_client.cache.store", store):
+            with patch("import_client.dawa.iter_all", lambda *args: chunks):
+                import_client.import_all_addresses()
+
+        self.assertEqual([], self.calls)
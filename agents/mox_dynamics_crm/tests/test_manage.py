@@ -0,0 +1,39 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from unittest import TestCase
+
+from click.testing import CliRunner
+
+# Testing import
+import manage
+
+
+class test_export_options(TestCase):
+
+    def export(self, *args):
+        return CliRunner().invoke(manage.export_to_crm, list(args))
+
+    def test_follow_can_not_be_resumed(self):
+        result = self.export("--follow", "--resume")
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--follow can not be combined", result.output)
+
+    def test_follow_can_not_be_queued(self):
+        result = self.export("--follow", "--queued")
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--follow can not be combined", result.output)
+
+    def test_queued_can_not_be_resumed(self):
+        result = self.export("--queued", "--resume")
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--queued can not be combined", result.output)
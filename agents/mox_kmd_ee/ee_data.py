@@ -4,8 +4,8 @@ This module follows a simple naming convention:
 
 The functions starting with "read" read data from the MS SQL database.
 
-Functions starting with "store" write to files on disk, and files starting with
-"retrieve" retrieves them from disk.
+Functions starting with "store" write to the snapshot on disk (See
+'ee_snapshot'), and functions starting with "retrieve" retrieve from it.
 """
 
 import pickle
@@ -14,16 +14,105 @@ import re
 import json
 import datetime
 
+from collections.abc import Mapping
+
 from ee_sql import CUSTOMER_SQL, RELEVANT_TREF_INSTALLATIONS_SQL
+from ee_sql import CUSTOMER_BY_KEYS_SQL, CUSTOMER_HASH_SQL
+from ee_sql import TREF_INSTALLATIONS_BY_KEYS_SQL
+from ee_sql import TREF_INSTALLATIONS_BY_LOCATIONS_SQL
+from ee_sql import RELEVANT_TREF_INSTALLATIONS_HASH_SQL
 from ee_utils import int_str
+from ee_snapshot import SnapshotStore
 
 
 LASTRUN_FILE = 'var/lastrun.json'
-CUSTOMER_RELATIONS_FILE = 'var/customer_relations'
-INSTALLATIONS_FILE = 'var/installations'
+SNAPSHOT_FILE = 'var/snapshot.db'
 CRM_FAILED_CUSTOMER_NUMBERS_FILE = "var/kundenumre.txt"
 CRM_FAILED_INSTALLATION_NUMBERS_FILE = "var/installationsnumre.txt"
 
+#: Amount of keys in each ``IN (...)`` query when reading records by key.
+KEYS_PER_QUERY = 1000
+
+#: Amount of rows fetched from the database at a time.
+FETCH_SIZE = 5000
+
+#: Snapshot tables.
+CUSTOMERS = 'customers'
+INSTALLATIONS = 'installations'
+
+#: Snapshot meta value set when the initial import has completed.
+INITIAL_IMPORT_COMPLETED = 'initial_import_completed'
+
+#: Pickled records of earlier versions, migrated to the snapshot.
+LEGACY_FILES = {
+    CUSTOMERS: 'var/customer_relations',
+    INSTALLATIONS: 'var/installations',
+}
+
+
+""" RECORDS """
+
+
+class Record(Mapping):
+    """A database row, read-only except for single fields.
+
+    The values are kept in a tuple and the column index is shared by all
+    rows of a result set, which takes far less memory than a dict per row.
+    Dict access (``row['Kundenr']``, ``row.get``, ``row.items()``,
+    ``{**row}``) works as for the dicts returned by ``as_dict`` cursors,
+    and a record equals a dict with the same content.
+
+    Records are pickled as plain dicts (e.g. in the snapshot).
+    """
+
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key]]
+
+    def __setitem__(self, key, value):
+        values = list(self._values)
+        values[self._columns[key]] = value
+        self._values = tuple(values)
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return (dict, (list(self.items()),))
+
+
+def iter_records(cursor, size=FETCH_SIZE):
+    """Stream the rows of the latest query as records (See 'Record').
+
+    The rows are fetched ``size`` at a time (``fetchmany``).
+    """
+    columns = {
+        column[0]: index for index, column in enumerate(cursor.description)
+    }
+    names = list(columns)
+
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+
+        for row in rows:
+            if isinstance(row, dict):
+                # as_dict cursor
+                row = [row[name] for name in names]
+            yield Record(columns, tuple(row))
+
 
 """ LASTRUN """
 
@@ -51,49 +140,188 @@ def write_lastrun_dict(lastrun_dict):
         f.write(json.dumps(lastrun_dict))
 
 
-""" CUSTOMER RECORDS """
+""" SNAPSHOT """
+
+_snapshot = None
+
+
+def get_snapshot():
+    """Open the snapshot of the records seen by the previous runs.
+
+    Pickled records written by earlier versions are migrated once.
+    Installation records are only stored once the initial import has
+    completed, as such migrated snapshots (and snapshots written before
+    the initial import was marked) holding installations are marked as
+    completed (See 'is_initial_import_completed').
+    """
+    global _snapshot
+
+    if _snapshot is None:
+        _snapshot = SnapshotStore(SNAPSHOT_FILE, [CUSTOMERS, INSTALLATIONS])
+
+        for table, legacy_file in LEGACY_FILES.items():
+            if os.path.isfile(legacy_file) and not _snapshot.count(table):
+                with open(legacy_file, 'rb') as f:
+                    _snapshot.put_many(table, pickle.load(f))
+                os.rename(legacy_file, legacy_file + '.migrated')
+
+        if (
+            _snapshot.get_meta(INITIAL_IMPORT_COMPLETED) is None and
+            _snapshot.count(INSTALLATIONS)
+        ):
+            mark_initial_import_completed()
+
+    return _snapshot
+
+
+def is_initial_import_completed():
+    """Decide if the initial import has completed.
+
+    The snapshot is marked when the initial import has stored all records,
+    an interrupted initial import is resumed by the next run.
+    """
+    return get_snapshot().get_meta(INITIAL_IMPORT_COMPLETED) is not None
+
+
+def mark_initial_import_completed():
+    """Mark the initial import as completed (See above)."""
+    get_snapshot().set_meta(
+        INITIAL_IMPORT_COMPLETED, datetime.datetime.now().isoformat()
+    )
+
+
+def retrieve_hashes(table, source=False):
+    """Retrieve the hashes of the stored records by key.
+
+    If source is set, the hashes computed by MS SQL are retrieved.
+    """
+    return get_snapshot().hashes(table, source)
+
+
+def retrieve_record(table, key):
+    """Retrieve a single stored record, or None if not stored."""
+    return get_snapshot().get(table, key)
 
 
-def has_customer_records():
-    """Decide if the initial import of customer records has run."""
-    return os.path.isfile(CUSTOMER_RELATIONS_FILE)
+def store_record(table, key, record, source_hash=None):
+    """Store a single record as soon as it has been synced."""
+    get_snapshot().put(table, key, record, source_hash)
 
 
-def read_customer_records(cursor, lastrun_dict):
+def store_records(table, records, source_hashes=None):
+    """Store several records (dict by key) at once."""
+    get_snapshot().put_many(table, records, source_hashes)
+
+
+""" READ BY KEY """
+
+
+def format_sql(sql, lastrun_dict, **kwargs):
+    """Insert the date of the last run (and other values) in an SQL query."""
+    return sql.format(
+        last_year=lastrun_dict["last_run"].year,
+        last_month=lastrun_dict["last_run"].month,
+        last_day=lastrun_dict["last_run"].day,
+        **kwargs
+    )
+
+
+def read_rows_by_keys(cursor, sql, lastrun_dict, keys):
+    """Read the rows matching a set of numeric keys.
+
+    The keys are read in batches of ``KEYS_PER_QUERY`` (``IN (...)``).
+    """
+    keys = sorted(set(int(float(key)) for key in keys))
+    rows = []
+
+    for i in range(0, len(keys), KEYS_PER_QUERY):
+        cursor.execute(format_sql(sql, lastrun_dict, keys=", ".join(
+            str(key) for key in keys[i:i + KEYS_PER_QUERY]
+        )))
+        rows.extend(iter_records(cursor))
+
+    return rows
+
+
+def read_hashes(cursor, sql, lastrun_dict, key_field):
+    """Read the row hashes computed by MS SQL (column ``RowHash``).
+
+    :returns: dict -- hex digests by key.
+    """
+    cursor.execute(format_sql(sql, lastrun_dict))
+
+    return {
+        int_str(row[key_field]): (row['RowHash'] or b'').hex()
+        for row in iter_records(cursor)
+    }
+
+
+def read_changed_records(cursor, lastrun_dict, table, hash_reader,
+                         record_reader, always=()):
+    """Read only the records which are new or changed since they were stored.
+
+    The row hashes are computed by MS SQL and compared with the ones stored
+    in the snapshot, then the full rows are read for the new or changed keys
+    only. If the snapshot contains no hashes yet, all records are read.
+
+    :param table: Snapshot table (e.g. ``CUSTOMERS``).
+    :param hash_reader: Reads the hashes, e.g. 'read_customer_hashes'.
+    :param record_reader: Reads the records, e.g. 'read_customer_records'.
+    :param always: Keys which are always read (e.g. failed in CRM).
+    :returns: tuple -- records by key, source hashes by key and the set of
+              keys which have not changed (and were not read).
+    """
+    source_hashes = hash_reader(cursor, lastrun_dict)
+    stored_hashes = retrieve_hashes(table, source=True)
+
+    unchanged_keys = {
+        key for key, source_hash in source_hashes.items()
+        if stored_hashes.get(key) == source_hash and key not in always
+    }
+
+    if unchanged_keys:
+        records = record_reader(
+            cursor, lastrun_dict, keys=source_hashes.keys() - unchanged_keys
+        )
+    else:
+        records = record_reader(cursor, lastrun_dict)
+
+    return records, source_hashes, unchanged_keys
+
+
+def delete_records(table, keys):
+    """Delete records which are no longer relevant from the snapshot."""
+    get_snapshot().delete_many(table, keys)
+
+
+""" CUSTOMER RECORDS """
+
+
+def read_customer_records(cursor, lastrun_dict, keys=None):
     """Read customer relations from database.
 
     Read all data regarding customers, customer roles and customer
     relationships and map them for easy lookup in case something
     changes. Basically, by creating a dictionary with customer
     number as key.
+
+    If keys are given, only the customers with these numbers are read.
     """
-    cursor.execute(CUSTOMER_SQL.format(
-        last_year=lastrun_dict["last_run"].year,
-        last_month=lastrun_dict["last_run"].month,
-        last_day=lastrun_dict["last_run"].day
-    ))
-    rows = cursor.fetchall()
+    if keys is None:
+        cursor.execute(format_sql(CUSTOMER_SQL, lastrun_dict))
+        rows = iter_records(cursor)
+    else:
+        rows = read_rows_by_keys(
+            cursor, CUSTOMER_BY_KEYS_SQL, lastrun_dict, keys
+        )
     customer_dict = {int_str(row['Kundenr']): row for row in rows}
 
     return customer_dict
 
 
-def store_customer_records(customer_relations):
-    """Store customer records on disk.
-
-    This is a simple, no-frills cache using the pickle module.
-    """
-    with open(CUSTOMER_RELATIONS_FILE, 'wb') as f:
-        pickle.dump(customer_relations, f, protocol=4)
-
-
-def retrieve_customer_records():
-    """Retrieve customer records from disk."""
-    try:
-        with open(CUSTOMER_RELATIONS_FILE, 'rb') as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return {}
+def read_customer_hashes(cursor, lastrun_dict):
+    """Read the hash of each customer record (See 'read_hashes')."""
+    return read_hashes(cursor, CUSTOMER_HASH_SQL, lastrun_dict, 'Kundenr')
 
 
 def get_crm_failed_customer_numbers():
@@ -107,35 +335,63 @@ def get_crm_failed_customer_numbers():
 """ INSTALLATION RECORDS """
 
 
-def read_installation_records(cursor, lastrun_dict):
+def read_installation_records(cursor, lastrun_dict, keys=None,
+                              locations=None):
     """Read relevant Tref installation records from database.
 
     Reads all relevant data about installations and meters.
+
+    If keys (installation numbers) or locations (ForbrugsstedID) are given,
+    only the matching installations are read.
     """
-    cursor.execute(RELEVANT_TREF_INSTALLATIONS_SQL.format(
-        last_year=lastrun_dict["last_run"].year,
-        last_month=lastrun_dict["last_run"].month,
-        last_day=lastrun_dict["last_run"].day
-    ))
-    rows = cursor.fetchall()
+    if keys is not None:
+        rows = read_rows_by_keys(
+            cursor, TREF_INSTALLATIONS_BY_KEYS_SQL, lastrun_dict, keys
+        )
+    elif locations is not None:
+        rows = read_rows_by_keys(
+            cursor, TREF_INSTALLATIONS_BY_LOCATIONS_SQL, lastrun_dict,
+            locations
+        )
+    else:
+        cursor.execute(
+            format_sql(RELEVANT_TREF_INSTALLATIONS_SQL, lastrun_dict)
+        )
+        rows = iter_records(cursor)
     data_dict = {int_str(row['InstalNummer']): row for row in rows}
 
     return data_dict
 
 
-def store_installation_records(installations):
-    """Store installation information in file for later use."""
-    with open(INSTALLATIONS_FILE, 'wb') as f:
-        pickle.dump(installations, f, protocol=4)
+def read_installation_hashes(cursor, lastrun_dict):
+    """Read the hash of each installation record (See 'read_hashes')."""
+    return read_hashes(
+        cursor, RELEVANT_TREF_INSTALLATIONS_HASH_SQL, lastrun_dict,
+        'InstalNummer'
+    )
+
+
+def index_installation_records(installations):
+    """Group installation records by location (Forbrugssted).
+
+    The index is used when importing new customer records, as such the
+    installations of a location are looked up in memory rather than
+    queried from the database for each customer record.
+
+    :param installations: Installation records by InstalNummer
+                          (See 'read_installation_records').
+    :type installations: dict
+    :returns: dict -- lists of installation records by ForbrugsstedID.
+    """
+    installations_by_location = {}
 
+    for key in sorted(installations):
+        row = installations[key]
+        installations_by_location.setdefault(
+            int_str(row['ForbrugsstedID']), []
+        ).append(row)
 
-def retrieve_installation_records():
-    """Read installation information from disk."""
-    try:
-        with open(INSTALLATIONS_FILE, 'rb') as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return {}
+    return installations_by_location
 
 
 def get_crm_failed_installation_numbers():
@@ -0,0 +1,170 @@
+"""Keyed on-disk snapshot of the KMD EE records seen by the previous runs."""
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+
+def row_hash(row):
+    """Calculate a hash of the content of a record.
+
+    :param row: The record (e.g. a customer record).
+    :type row: dict
+    :returns: str -- the hash (hex digest).
+    """
+    content = repr(sorted(row.items())).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class SnapshotStore(object):
+    """SQLite store holding one row per record key.
+
+    Each row contains the record hash and the (pickled) record, as such
+    the previous run is compared by hash and only the records which have
+    changed are loaded. Records are upserted one at a time as they are
+    synced, so an interrupted run keeps the progress it has made.
+
+    Optionally the hash computed by the source database is kept as well
+    (See 'ee_data.read_changed_records').
+
+    A table of named values ('meta') records the state of the snapshot,
+    e.g. that the initial import has completed.
+
+    The store may be shared by several threads.
+    """
+
+    def __init__(self, path, tables):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'name TEXT PRIMARY KEY, '
+                'value TEXT NOT NULL)'
+            )
+
+            for table in tables:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {0} ('
+                    'key TEXT PRIMARY KEY, '
+                    'hash TEXT NOT NULL, '
+                    'source_hash TEXT, '
+                    'data BLOB NOT NULL)'.format(table)
+                )
+
+                # Snapshots created before the source hash was added
+                columns = [
+                    column[1] for column in self.connection.execute(
+                        'PRAGMA table_info({0})'.format(table)
+                    )
+                ]
+                if 'source_hash' not in columns:
+                    self.connection.execute(
+                        'ALTER TABLE {0} ADD COLUMN source_hash TEXT'.format(
+                            table
+                        )
+                    )
+
+    def get_meta(self, name):
+        """Get a named value, or None if it has not been set."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM meta WHERE name = ?', (name,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        """Set a named value."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                (name, value)
+            )
+
+    def count(self, table):
+        """Count the records in a table."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM {0}'.format(table)
+            ).fetchone()[0]
+
+    def hashes(self, table, source=False):
+        """Get the hashes of all records in a table.
+
+        :param source: Get the hashes computed by the source database.
+        :type source: bool
+        :returns: dict -- record hashes by key.
+        """
+        column = 'source_hash' if source else 'hash'
+
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT key, {0} FROM {1} WHERE {0} IS NOT NULL'.format(
+                    column, table
+                )
+            ))
+
+    def get(self, table, key):
+        """Get a single record, or None if it is not in the snapshot."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM {0} WHERE key = ?'.format(table), (key,)
+            ).fetchone()
+
+        return pickle.loads(row[0]) if row else None
+
+    def put(self, table, key, record, source_hash=None):
+        """Insert or replace a single record."""
+        self.put_many(table, {key: record}, {key: source_hash})
+
+    def put_many(self, table, records, source_hashes=None):
+        """Insert or replace several records in one transaction.
+
+        :param records: Records by key.
+        :type records: dict
+        :param source_hashes: Optional source database hashes by key.
+        :type source_hashes: dict
+        """
+        source_hashes = source_hashes or {}
+        values = [
+            (
+                key,
+                row_hash(record),
+                source_hashes.get(key),
+                pickle.dumps(record, protocol=4)
+            )
+            for key, record in records.items()
+        ]
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO {0} (key, hash, source_hash, data) '
+                'VALUES (?, ?, ?, ?)'.format(table),
+                values
+            )
+
+    def delete_many(self, table, keys):
+        """Delete several records in one transaction."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM {0} WHERE key = ?'.format(table),
+                [(key,) for key in keys]
+            )
+
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
@@ -48,33 +48,59 @@ Every time a need for an SQL query is discovered, a new string (maybe
 parametrized using string formatting) is created in this module.
 """
 
-#: This is the SQL to fetch all customers from the KMD EE database.
+import re
+
+
+def _column_list(columns, indent):
+    """Join column expressions as in a ``SELECT`` list."""
+    return ('\n' + ' ' * indent + ',').join(columns)
+
+
+def _column_name(column):
+    """Name of a column expression, e.g. ``[ForbrStPostdistrikt]`` for
+    ``[b].[Postdistrikt] as [ForbrStPostdistrikt]``."""
+    return re.findall(r'\[[^\]]+\]', column)[-1]
+
+
+def _row_hash(columns, indent):
+    """Hash of the given columns of a row, computed by the database server."""
+    return """HASHBYTES('SHA1', (SELECT {columns}
+{padding}FOR XML RAW))""".format(
+        columns=_column_list(columns, indent + 25),
+        padding=' ' * (indent + 18)
+    )
+
+
+#: The customer columns read (plain and hashed, See ``CUSTOMER_HASH_SQL``).
 #: Only relevant fields (please).
-CUSTOMER_SQL = """
-SELECT [PersonnrSEnr]
-      ,[LigestPersonnr]
-      ,[Kundenr]
-      ,[KundeSagsnr]
-      ,[KundeNavn]
-      ,[Telefonnr]
-      ,[EmailKunde]
-      ,[MobilTlf]
-      ,[a].[ForbrugsstedID]
-      ,[VejNavn]
-      ,[a].[Postdistrikt]
-      ,[Tilflytningsdato]
-      ,[Fraflytningsdato]
-      ,[Status]
-      ,[FasadministratorID]
-      ,[BoligadminID]
-      ,[Husnr]
-      ,[ForbrStVejnavn]
-      ,[Vejkode]
-      ,[b].[Postdistrikt] as [ForbrStPostdistrikt]
-      ,[Postnr]
-      ,[Bogstav]
-      ,[Etage]
-      ,[Sidedørnr]
+CUSTOMER_COLUMNS = [
+    '[PersonnrSEnr]',
+    '[LigestPersonnr]',
+    '[Kundenr]',
+    '[KundeSagsnr]',
+    '[KundeNavn]',
+    '[Telefonnr]',
+    '[EmailKunde]',
+    '[MobilTlf]',
+    '[a].[ForbrugsstedID]',
+    '[VejNavn]',
+    '[a].[Postdistrikt]',
+    '[Tilflytningsdato]',
+    '[Fraflytningsdato]',
+    '[Status]',
+    '[FasadministratorID]',
+    '[BoligadminID]',
+    '[Husnr]',
+    '[ForbrStVejnavn]',
+    '[Vejkode]',
+    '[b].[Postdistrikt] as [ForbrStPostdistrikt]',
+    '[Postnr]',
+    '[Bogstav]',
+    '[Etage]',
+    '[Sidedørnr]',
+]
+
+CUSTOMER_FROM_SQL = """
   FROM Kunde a, Forbrugssted b
   WHERE Tilflytningsdato <= GETDATE()
   AND Fraflytningsdato >= DATETIMEFROMPARTS({last_year},{last_month},{last_day},0,0,0,0)
@@ -82,16 +108,49 @@ SELECT [PersonnrSEnr]
   and a.ForbrugsstedID = b.ForbrugsstedID
 """
 
+#: This is the SQL to fetch all customers from the KMD EE database.
+CUSTOMER_SQL = """
+SELECT """ + _column_list(CUSTOMER_COLUMNS, 6) + CUSTOMER_FROM_SQL
+
+#: Customer records with the given customer numbers (Kundenr).
+CUSTOMER_BY_KEYS_SQL = CUSTOMER_SQL + """  and [Kundenr] IN ({keys})
+"""
 
-#: Extract all relevant installations.
-RELEVANT_TREF_INSTALLATIONS_SQL = """SELECT [InstalNummer],
-                                 [AlternativStedID],
-                                 [Målernr],
-                                 [MaalerTypeBetegnel],
-                                 [Målertypefabrikat],
-                                 [DatoFra],
-                                 [DatoTil],
-                                 [Kundenr]
+#: Hash of each customer record, computed by the database server.
+CUSTOMER_HASH_SQL = """
+SELECT [Kundenr],
+       """ + _row_hash(CUSTOMER_COLUMNS, 7) + """ as [RowHash]""" + (
+    CUSTOMER_FROM_SQL
+)
+
+
+#: The installation columns read (plain and hashed, See
+#: ``RELEVANT_TREF_INSTALLATIONS_HASH_SQL``).
+INSTALLATION_COLUMNS = [
+    '[InstalNummer]',
+    '[a].[ForbrugsstedID]',
+    '[AlternativStedID]',
+    '[Målernr]',
+    '[MaalerTypeBetegnel]',
+    '[Målertypefabrikat]',
+    '[DatoFra]',
+    '[DatoTil]',
+    '[Kundenr]',
+]
+
+#: An installation is joined with each of its current meters and each
+#: customer of its location. The rows are numbered per installation, as
+#: such a single row is read (and hashed) for each installation: the
+#: customer who moved in last and the meter which was mounted last.
+INSTALLATION_ROW_NUMBER_SQL = """ROW_NUMBER() OVER (
+                                     PARTITION BY [InstalNummer]
+                                     ORDER BY c.Tilflytningsdato DESC,
+                                              c.Kundenr DESC,
+                                              b.DatoFra DESC,
+                                              b.Målernr DESC
+                                 ) as [RowNumber]"""
+
+INSTALLATION_FROM_SQL = """
     FROM TrefInstallation a, TrefMaaler b, Kunde c
     WHERE
     a.InstallationID = b.InstallationID
@@ -105,22 +164,49 @@ RELEVANT_TREF_INSTALLATIONS_SQL = """SELECT [InstalNummer],
   AND Fraflytningsdato >= DATETIMEFROMPARTS({last_year},{last_month},{last_day},0,0,0,0)
   and Afregningsgrpnr <> 999
   and a.ForbrugsstedID = b.ForbrugsstedID)
-    """
+"""
+
+
+def _installation_sql(columns, condition=''):
+    """Select one row per relevant installation (See above).
 
-#: Installation data for a given Forbrugssted.
-TREFINSTALLATION_SQL = """SELECT [InstalNummer],
-                                 [AlternativStedID],
-                                 [Målernr],
-                                 [MaalerTypeBetegnel],
-                                 [Målertypefabrikat],
-                                 [DatoFra],
-                                 [DatoTil]
-    FROM TrefInstallation a, TrefMaaler b
-    WHERE ForbrugsstedID = {forbrugssted}
-    AND a.InstallationID = b.InstallationID
-    AND b.DatoFra <= GETDATE()
-    AND b.DatoTil >= DATETIMEFROMPARTS({last_year},{last_month},{last_day},0,0,0,0)
+    :param columns: Column expressions selected for each installation.
+    :param condition: Optional condition (e.g. ``AND a.InstalNummer IN``).
+
+    The placeholders (e.g. ``{last_year}`` and ``{keys}``) are passed on
+    as is, they are filled in by ``ee_data.format_sql``.
     """
+    return """SELECT {names}
+  FROM (SELECT {columns},
+               {row_number}{from_sql}    {condition}) as [i]
+  WHERE [RowNumber] = 1
+""".format(
+        names=_column_list([_column_name(c) for c in columns], 9),
+        columns=_column_list(columns, 15),
+        row_number=INSTALLATION_ROW_NUMBER_SQL,
+        from_sql=INSTALLATION_FROM_SQL,
+        condition=condition
+    )
+
+
+#: Extract all relevant installations.
+RELEVANT_TREF_INSTALLATIONS_SQL = _installation_sql(INSTALLATION_COLUMNS)
+
+#: Relevant installations with the given installation numbers.
+TREF_INSTALLATIONS_BY_KEYS_SQL = _installation_sql(
+    INSTALLATION_COLUMNS, 'AND a.InstalNummer IN ({keys})'
+)
+
+#: Relevant installations of the given locations (Forbrugssted).
+TREF_INSTALLATIONS_BY_LOCATIONS_SQL = _installation_sql(
+    INSTALLATION_COLUMNS, 'AND a.ForbrugsstedID IN ({keys})'
+)
+
+#: Hash of each relevant installation, computed by the database server.
+RELEVANT_TREF_INSTALLATIONS_HASH_SQL = _installation_sql([
+    '[InstalNummer]',
+    _row_hash(INSTALLATION_COLUMNS, 15) + ' as [RowHash]',
+])
 
 #: Alternative address for a given Alt Place ID.
 ALTERNATIVSTED_ADRESSE_SQL = """SELECT [HusnrAltern],
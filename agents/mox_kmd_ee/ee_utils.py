@@ -1,7 +1,6 @@
 """Miscellaneous utility functions specific to the KMD EE agent."""
 import pymssql
 
-from ee_sql import TREFINSTALLATION_SQL
 from ee_sql import ALTERNATIVSTED_ADRESSE_SQL
 from service_clients import get_address_uuid, fuzzy_address_uuid
 from service_clients import report_error, access_address_uuid
@@ -72,22 +71,6 @@ def connect(server, database, username, password):
     return cnxn
 
 
-def get_products_for_location(forbrugssted, lastrun_dict):
-    """Get locations for this customer ID from the Forbrugssted table."""
-    from mssql_config import username, password, server, database
-    connection = connect(server, database, username, password)
-    cursor = connection.cursor(as_dict=True)
-    cursor.execute(TREFINSTALLATION_SQL.format(
-        forbrugssted=forbrugssted,
-        last_year=lastrun_dict["last_run"].year,
-        last_month=lastrun_dict["last_run"].month,
-        last_day=lastrun_dict["last_run"].day
-    ))
-    rows = cursor.fetchall()
-    connection.close()
-    return rows
-
-
 def get_forbrugssted_address_uuid(row):
     """Get UUID of the address for this Forbrugssted."""
     vejnavn = row['ForbrStVejnavn']
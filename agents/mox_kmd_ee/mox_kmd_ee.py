@@ -8,7 +8,6 @@
 #
 
 import sys
-import functools
 
 from multiprocessing.dummy import Pool
 
@@ -29,18 +28,23 @@ from crm_utils import update_customer_relation, write_agreement_dict
 from crm_utils import get_sp_address
 
 from ee_utils import get_forbrugssted_address_uuid
-from ee_utils import get_products_for_location
 from ee_utils import get_alternativsted_address_uuid, say, hide_cpr
 
-from ee_data import read_customer_records, store_customer_records
-from ee_data import retrieve_customer_records, read_installation_records
-from ee_data import store_installation_records, retrieve_installation_records
-from ee_data import has_customer_records
+from ee_data import read_customer_records, read_installation_records
+from ee_data import read_customer_hashes, read_installation_hashes
+from ee_data import read_changed_records
+from ee_data import index_installation_records
+from ee_data import is_initial_import_completed
+from ee_data import mark_initial_import_completed
+from ee_data import retrieve_hashes, retrieve_record, store_record
+from ee_data import store_records, delete_records, CUSTOMERS, INSTALLATIONS
 from ee_data import get_crm_failed_customer_numbers
 from ee_data import get_crm_failed_installation_numbers
 from ee_data import read_lastrun_dict, write_lastrun_dict
 from service_clients import report_error, fuzzy_address_uuid
+from service_clients import get_address_cache
 from cprcompletion import complete_cprs_in_custdict
+from ee_snapshot import row_hash
 
 
 """CUSTOMER RELATED FUNCTIONS.
@@ -89,10 +93,14 @@ def import_customer(id_and_fields):
             return
 
 
-def _import_customer_record(fields, lastrun_dict={}):
+def import_customer_record(fields, installations_by_location={}):
     """Import a new customer record including relation, agreement, products.
 
     Assume customers themselves have already been imported.
+
+    :param fields: The customer record.
+    :param installations_by_location: Installation records by ForbrugsstedID
+                                      (See 'index_installation_records').
     """
     # Lookup customer in LoRa - insert if it doesn't exist already.
     id_number = cpr_cvr(int_str(fields['PersonnrSEnr']))
@@ -180,7 +188,7 @@ def _import_customer_record(fields, lastrun_dict={}):
 
     forbrugssted = fields['ForbrugsstedID']
 
-    products = get_products_for_location(forbrugssted, lastrun_dict)
+    products = installations_by_location.get(int_str(forbrugssted), [])
 
     no_of_products = len(products)
 
@@ -222,11 +230,6 @@ def _import_customer_record(fields, lastrun_dict={}):
     assert(agreement_uuid)
 
 
-import_customer_record = functools.partial(
-    _import_customer_record, lastrun_dict=read_lastrun_dict()
-)
-
-
 def update_customer_record(fields, changed_fields):
     """Update relevant LoRa objects with the specific changes."""
     customer_fields = ['Telefon', 'MobilTlf', 'Fax', 'Kundesagsnr']
@@ -382,59 +385,102 @@ def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--verbose', action='store_true',
                         help='print helpful comments during execution')
+    parser.add_argument('--server-hash', action='store_true',
+                        help='compare row hashes computed by MS SQL and '
+                        'only read the new or changed records')
     args = parser.parse_args()
     ee_utils.VERBOSE = args.verbose
 
     # Decide if this is the initial import.
-    initial_import = not has_customer_records()
+    initial_import = not is_initial_import_completed()
     say("Initial import: {}".format("YES" if initial_import else "NO"))
 
     # last ran when (defaults to today)
     lastrun_dict = read_lastrun_dict()
 
     """CUSTOMERS AND CUSTOMER RELATIONS"""
+
+    # The records of the previous run are compared by hash,
+    # only the records needed are retrieved from the snapshot.
+    old_hashes = retrieve_hashes(CUSTOMERS)
+
     connection = connect(server, database, username, password)
-    cursor = connection.cursor(as_dict=True)
-    new_values = read_customer_records(cursor, lastrun_dict)
-    new_installation_values = read_installation_records(cursor, lastrun_dict)
-    old_installation_values = retrieve_installation_records()
+    cursor = connection.cursor()
+    if args.server_hash:
+        # Only the new or changed records are read,
+        # the unchanged ones are left as they are in the snapshot.
+        (new_values, source_hashes,
+         unchanged_keys) = read_changed_records(
+            cursor, lastrun_dict, CUSTOMERS,
+            read_customer_hashes, read_customer_records,
+            always=get_crm_failed_customer_numbers()
+        )
+        (new_installation_values, installation_source_hashes,
+         unchanged_installation_keys) = read_changed_records(
+            cursor, lastrun_dict, INSTALLATIONS,
+            read_installation_hashes, read_installation_records,
+            always=get_crm_failed_installation_numbers()
+        )
+        # The installations of new customer records may be unchanged
+        location_installation_values = read_installation_records(
+            cursor, lastrun_dict, locations={
+                new_values[k]['ForbrugsstedID']
+                for k in new_values.keys() - old_hashes.keys()
+            }
+        )
+    else:
+        new_values = read_customer_records(cursor, lastrun_dict)
+        new_installation_values = read_installation_records(
+            cursor, lastrun_dict
+        )
+        location_installation_values = new_installation_values
+        source_hashes = installation_source_hashes = {}
+        unchanged_keys = unchanged_installation_keys = set()
     connection.close()
 
-    old_values = retrieve_customer_records()
-
     # restore already found cpr_numbers in read values,
     # alternatively, if they miss the last four, find them
     for k, fields in list(new_values.items()):
-        if not complete_cprs_in_custdict(fields, old_values.get(k)):
+        old_fields = retrieve_record(CUSTOMERS, k) if k in old_hashes else None
+        if not complete_cprs_in_custdict(fields, old_fields):
             new_values.pop(k)
             continue
 
-    say('Comparison, new_values == old_values:', new_values == old_values)
+    new_hashes = {k: row_hash(fields) for k, fields in new_values.items()}
 
-    new_keys = new_values.keys() - old_values.keys()
-    lost_keys = old_values.keys() - new_values.keys()
-    common_keys = new_values.keys() & old_values.keys()
+    new_keys = new_values.keys() - old_hashes.keys()
+    lost_keys = old_hashes.keys() - new_values.keys() - unchanged_keys
+    common_keys = new_values.keys() & old_hashes.keys()
 
     say("new customers:", len(new_keys))
     say("lost customers:", len(lost_keys))
-    say("existing customers:", len(common_keys))
+    say("existing customers:", len(common_keys | unchanged_keys))
 
     # Now calculate diff between new values and old values.
     # Build a mapping between customer numbers and
     # dictionaries containing only the changed values.
 
     crm_failed = get_crm_failed_customer_numbers()
+    old_values = {
+        k: retrieve_record(CUSTOMERS, k) for k in common_keys if (
+            new_hashes[k] != old_hashes[k] or k in crm_failed
+        )
+    }
     changed_records = {
         k: {
             f: v for f, v in new_values[k].items() if
-            new_values[k][f] != old_values[k][f] or k in crm_failed
-          } for k in common_keys if (
-              new_values[k] != old_values[k] or k in crm_failed
-          )
+            v != old_values[k].get(f) or k in crm_failed
+          } for k in old_values
     }
 
     say("Number of changed customer records:", len(changed_records))
 
+    # Keep the MS SQL hashes of records which were read but have not changed
+    if source_hashes:
+        store_records(CUSTOMERS, {
+            k: new_values[k] for k in common_keys - changed_records.keys()
+        }, source_hashes)
+
     # we are no longer deleting customers - their agreements just expire
     # Handle notifications for customer part, do the installations afterwards.
     #if len(lost_keys) > 0:
@@ -443,6 +489,8 @@ def main():
     #        # These records are no longer active and should be deleted in LoRa
     #        delete_customer_record(k)
     #    say("... done")
+    delete_records(CUSTOMERS, lost_keys)
+
     # New customer relations - import along with agreements & products
     # First explicitly create the new customers
 
@@ -469,11 +517,21 @@ def main():
         say('... importing {} new customer relations ...'.format(
             len(new_keys)
         ))
-        p = Pool(10)
-        p.map(
-            import_customer_record,
-            [new_values[k] for k in new_keys]
+        # Products are looked up in the installations read above
+        # rather than queried for each customer record.
+        installations_by_location = index_installation_records(
+            location_installation_values
         )
+
+        def import_and_store(k):
+            import_customer_record(
+                new_values[k],
+                installations_by_location=installations_by_location
+            )
+            store_record(CUSTOMERS, k, new_values[k], source_hashes.get(k))
+
+        p = Pool(10)
+        p.map(import_and_store, new_keys)
         p.close()
         p.join()
         say("... done")
@@ -485,42 +543,62 @@ def main():
         ))
         for k, changed_fields in changed_records.items():
             update_customer_record(old_values[k], changed_fields)
+            store_record(CUSTOMERS, k, new_values[k], source_hashes.get(k))
         say("... done")
 
     if initial_import:
         # In this case, we shouldn't handle changed installations, only
         # record the ones we've seen.
-        store_customer_records(new_values)
-        store_installation_records(new_installation_values)
+        store_records(
+            INSTALLATIONS, new_installation_values, installation_source_hashes
+        )
+        mark_initial_import_completed()
+        say("Address cache:", get_address_cache().summary())
         sys.exit()
 
     """INSTALLATIONS AND PRODUCTS"""
 
+    old_installation_hashes = retrieve_hashes(INSTALLATIONS)
+
     new_installation_keys = (new_installation_values.keys() -
-                             old_installation_values.keys())
-    lost_installation_keys = (old_installation_values.keys() -
-                              new_installation_values.keys())
+                             old_installation_hashes.keys())
+    lost_installation_keys = (old_installation_hashes.keys() -
+                              new_installation_values.keys() -
+                              unchanged_installation_keys)
     common_installation_keys = (new_installation_values.keys() &
-                                old_installation_values.keys())
+                                old_installation_hashes.keys())
 
     say("new installations:", len(new_installation_keys))
     say("lost installations:", len(lost_installation_keys))
-    say("existing installations:", len(common_installation_keys))
+    say("existing installations:",
+        len(common_installation_keys | unchanged_installation_keys))
 
     crm_failed = get_crm_failed_installation_numbers()
+    old_installation_values = {
+        k: retrieve_record(INSTALLATIONS, k)
+        for k in common_installation_keys if (
+            row_hash(new_installation_values[k]) !=
+            old_installation_hashes[k] or k in crm_failed
+        )
+    }
     changed_installation_records = {
         k: {
             f: v for f, v in new_installation_values[k].items() if (
-                new_installation_values[k][f] != old_installation_values[k][f]
+                v != old_installation_values[k].get(f)
                 or k in crm_failed
             )
-          } for k in common_installation_keys if (
-            new_installation_values[k] != old_installation_values[k]
-            or k in crm_failed
-          )
+          } for k in old_installation_values
     }
 
     say("Number of changed installation records:", len(changed_records))
+
+    # Keep the MS SQL hashes of records which were read but have not changed
+    if installation_source_hashes:
+        store_records(INSTALLATIONS, {
+            k: new_installation_values[k] for k in (
+                common_installation_keys - changed_installation_records.keys()
+            )
+        }, installation_source_hashes)
     #  Those that disappear are expired, either by the customer disappearing or
     #  by crossing the expiry date. If the customer disappeared, it should
     #  already be gone.
@@ -531,6 +609,7 @@ def main():
     #    say("deleting product %s" % k)
     #    delete_installation_record(k)
     #say("... done")
+    delete_records(INSTALLATIONS, lost_installation_keys)
 
     # New records may come into being by entering the valid period.
     # if so, they should be attached to the Aftale corresponding to this
@@ -543,6 +622,10 @@ def main():
     )
     for k in new_installation_keys:
         import_installation_record(new_installation_values[k])
+        store_record(
+            INSTALLATIONS, k, new_installation_values[k],
+            installation_source_hashes.get(k)
+        )
     say("... done")
 
     # Now handle updates
@@ -551,11 +634,14 @@ def main():
     ))
     for k, changed_fields in changed_installation_records.items():
         update_installation_record(old_installation_values[k], changed_fields)
+        store_record(
+            INSTALLATIONS, k, new_installation_values[k],
+            installation_source_hashes.get(k)
+        )
     say("... done")
 
     # All's well that ends well
-    store_customer_records(new_values)
-    store_installation_records(new_installation_values)
+    say("Address cache:", get_address_cache().summary())
     write_lastrun_dict(lastrun_dict)
 
 
@@ -7,10 +7,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import re
 import json
 import time
+import sqlite3
 import datetime
 import functools
+import threading
 
 import requests
 import pika
@@ -21,6 +24,12 @@ except ImportError:
     def _get_cvr_data(id):
         pass
 
+try:
+    from dawa_replica import get_replica
+except ImportError:
+    def get_replica(path=None):
+        return None
+
 
 from settings import SP_UUIDS, CERTIFICATE_FILE, ERROR_MQ_QUEUE, ERROR_MQ_HOST
 
@@ -28,9 +37,171 @@ from settings import SP_UUIDS, CERTIFICATE_FILE, ERROR_MQ_QUEUE, ERROR_MQ_HOST
 DAWA_ADDRESS_URL = 'http://dawa.aws.dk/adresser'
 DAWA_ACCESS_URL = 'http://dawa.aws.dk/adgangsadresser'
 
+# Tables of the local DAWA replica (See aak_integration/dawa_replica)
+DAWA_REPLICA_TABLES = {
+    DAWA_ADDRESS_URL: 'adresser',
+    DAWA_ACCESS_URL: 'adgangsadresser'
+}
+
+
+#: Persistent cache of the address lookups (See 'AddressCache').
+ADDRESS_CACHE_FILE = 'var/address_cache.db'
+
+#: Addresses found are cached for this many seconds.
+ADDRESS_CACHE_TTL = 30 * 24 * 3600
+
+#: Addresses not found or not unique are cached for this many seconds.
+ADDRESS_CACHE_NEGATIVE_TTL = 24 * 3600
+
+
+def normalize_address(value):
+    """Normalize an address (string or field value) for use as cache key."""
+    value = re.sub(r'\s*,\s*', ', ', str(value).strip().lower())
+    return re.sub(r'\s+', ' ', value)
+
+
+class AddressCache(object):
+    """Persistent cache of the results of DAWA address lookups.
+
+    Results are kept in an SQLite database, as such they are shared by
+    all threads and survive between runs. Lookups which found a single
+    address are cached for ``ttl`` seconds, lookups which found no
+    address or several addresses for ``negative_ttl`` seconds.
+    Failed requests (e.g. throttling) are not cached.
+    """
+
+    def __init__(self, path, ttl=ADDRESS_CACHE_TTL,
+                 negative_ttl=ADDRESS_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS addresses ('
+                'key TEXT PRIMARY KEY, '
+                'found INTEGER NOT NULL, '
+                'result TEXT NOT NULL, '
+                'expires REAL NOT NULL)'
+            )
+
+    @staticmethod
+    def key(service, address):
+        """Cache key of a lookup, e.g. ``service?postnr=8000&vejkode=1``.
+
+        :param service: The service (URL) used for the lookup.
+        :param address: Address fields (dict) or address string.
+        """
+        if isinstance(address, dict):
+            address = '&'.join(
+                '{0}={1}'.format(field, normalize_address(value))
+                for field, value in sorted(address.items())
+                if field != 'struktur'
+            )
+        else:
+            address = normalize_address(address)
+
+        return '{0}?{1}'.format(service, address)
+
+    def get(self, key):
+        """Get the cached result of a lookup, or None if not cached."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT found, result FROM addresses '
+                'WHERE key = ? AND expires > ?', (key, time.time())
+            ).fetchone()
+
+            if not row:
+                self.misses += 1
+                return None
+
+            if row[0]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+
+        return json.loads(row[1])
+
+    def put(self, key, result, found):
+        """Cache the result of a lookup.
+
+        :param result: The result (JSON serializable).
+        :param found: Whether a single address was found.
+        """
+        ttl = self.ttl if found else self.negative_ttl
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO addresses '
+                '(key, found, result, expires) VALUES (?, ?, ?, ?)',
+                (key, int(found), json.dumps(result), time.time() + ttl)
+            )
+
+    def stats(self):
+        """Get the hit-rate statistics of this run."""
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_rate': (
+                    (self.hits + self.negative_hits) / lookups
+                    if lookups else 0.0
+                )
+            }
+
+    def summary(self):
+        """Get the hit-rate statistics as text."""
+        return (
+            "{hits} hits, {negative_hits} negative hits, {misses} misses "
+            "(hit rate: {hit_rate:.1%})".format(**self.stats())
+        )
+
+
+_address_cache = None
+_address_cache_lock = threading.Lock()
+
+
+def get_address_cache():
+    """Get the (shared) address cache (See 'AddressCache')."""
+    global _address_cache
+
+    with _address_cache_lock:
+        if _address_cache is None:
+            _address_cache = AddressCache(ADDRESS_CACHE_FILE)
+
+        return _address_cache
+
+
+def lookup_replica(dawa_service, address):
+    """Look up address in the local DAWA replica, if any.
+
+    Returns the matching addresses, or None if the address must be
+    looked up in DAWA (no replica, unsupported fields or not found).
+    """
+    replica = get_replica()
+    if not replica:
+        return None
+
+    criteria = {k: v for k, v in address.items() if k != 'struktur'}
+    js = replica.find(DAWA_REPLICA_TABLES[dawa_service], **criteria)
+
+    return js or None
+
 
 def get_address_from_service(dawa_service, as_tuple, address):
-    """Get DAWA UUID from dictionary with correct fields."""
+    """Get DAWA UUID from dictionary with correct fields.
+
+    The local DAWA replica is used if available, DAWA is only called if
+    the address is not found in the replica nor in the address cache.
+    """
     address['struktur'] = 'mini'
 
     # allow looking up by id only
@@ -39,6 +210,16 @@ def get_address_from_service(dawa_service, as_tuple, address):
     else:
         raise RuntimeError("Insufficient data")
 
+    js = lookup_replica(dawa_service, address)
+    if js:
+        return _address_uuid(as_tuple, js)
+
+    cache = get_address_cache()
+    cache_key = cache.key(dawa_service, address)
+    js = cache.get(cache_key)
+    if js is not None:
+        return _address_uuid(as_tuple, js)
+
     try:
         response = requests.get(
             url=dawa_service,
@@ -67,6 +248,14 @@ def get_address_from_service(dawa_service, as_tuple, address):
         else:
             raise RuntimeError("Internal Server Error from Dawa")
 
+    if response.status_code == 200 and isinstance(js, list):
+        cache.put(cache_key, js, found=len(js) == 1)
+
+    return _address_uuid(as_tuple, js)
+
+
+def _address_uuid(as_tuple, js):
+    """Get the UUID of the single address found."""
     if len(js) == 1:
         address_uuid = js[0]['id']
     elif len(js) > 1:
@@ -87,34 +276,60 @@ access_address_uuid = functools.partial(get_address_from_service,
 
 
 def fuzzy_address_uuid(addr_str):
-    """Get DAWA UUID from string using the 'datavask' API."""
+    """Get DAWA UUID from string using the 'datavask' API.
+
+    An exact (normalized) match in the local DAWA replica is used, if any.
+    The results are cached (See 'AddressCache').
+    """
+    replica = get_replica()
+    addrs = replica.search(addr_str) if replica else []
+    if len(addrs) == 1:
+        if addrs[0]['status'] in [2, 4]:
+            return addrs[0]['adgangsadresseid']
+        else:
+            return addrs[0]['id']
+
     DAWA_DATAVASK_URL = "https://dawa.aws.dk/datavask/adresser"
 
-    params = {'betegnelse': addr_str}
+    cache = get_address_cache()
+    cache_key = cache.key(DAWA_DATAVASK_URL, addr_str)
+    addrs = cache.get(cache_key)
 
-    result = requests.get(url=DAWA_DATAVASK_URL, params=params)
+    if addrs is None:
+        params = {'betegnelse': addr_str}
 
-    if result:
-        addrs = result.json()['resultater']
-        if len(addrs) == 1:
-            if addrs[0]['adresse']['status'] in [2, 4]:
-                return addrs[0]['adresse']['adgangsadresseid']
-            else:
-                return addrs[0]['adresse']['id']
-        elif len(addrs) > 1:
-            # print("Adresses found:")
-            # print(addrs)
-            raise RuntimeError(
-                'Non-unique (datavask) address: {0}'.format(addr_str)
-            )
+        result = requests.get(url=DAWA_DATAVASK_URL, params=params)
+
+        if not result:
+            result.raise_for_status()
+            return
+
+        # Only the fields needed are cached
+        addrs = [
+            {
+                'id': r['adresse']['id'],
+                'adgangsadresseid': r['adresse']['adgangsadresseid'],
+                'status': r['adresse']['status']
+            } for r in result.json()['resultater']
+        ]
+        cache.put(cache_key, addrs, found=len(addrs) == 1)
+
+    if len(addrs) == 1:
+        if addrs[0]['status'] in [2, 4]:
+            return addrs[0]['adgangsadresseid']
         else:
-            # len(addrs) == 0
-            raise RuntimeError(
-                '(datavask) address not found: {0}'.format(addr_str)
-            )
+            return addrs[0]['id']
+    elif len(addrs) > 1:
+        # print("Adresses found:")
+        # print(addrs)
+        raise RuntimeError(
+            'Non-unique (datavask) address: {0}'.format(addr_str)
+        )
     else:
-        result.raise_for_status()
-        # raise RuntimeError("Unable to look up address: {0}".format(addr_str))
+        # len(addrs) == 0
+        raise RuntimeError(
+            '(datavask) address not found: {0}'.format(addr_str)
+        )
 
 
 def get_cvr_data(cvr_number):
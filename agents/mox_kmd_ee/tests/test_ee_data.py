@@ -0,0 +1,113 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import pickle
+from unittest import TestCase
+
+# Testing import
+from ee_data import Record, iter_records
+
+
+class FakeCursor(object):
+    """A cursor returning the given rows from fetchmany."""
+
+    def __init__(self, names, rows):
+        self.description = [(name, None) for name in names]
+        self.rows = list(rows)
+        self.fetches = []
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches.append(len(rows))
+        return rows
+
+
+class test_record(TestCase):
+
+    def setUp(self):
+        self.record = Record({'Kundenr': 0, 'KundeNavn': 1}, (1.0, 'Test'))
+
+    def test_mapping(self):
+        self.assertEqual(1.0, self.record['Kundenr'])
+        self.assertEqual('Test', self.record.get('KundeNavn'))
+        self.assertIsNone(self.record.get('Telefonnr'))
+        self.assertEqual(['Kundenr', 'KundeNavn'], list(self.record))
+        self.assertEqual(2, len(self.record))
+        self.assertIn('KundeNavn', self.record)
+
+        with self.assertRaises(KeyError):
+            self.record['Telefonnr']
+
+    def test_equals_dict(self):
+        expected = {'Kundenr': 1.0, 'KundeNavn': 'Test'}
+
+        self.assertEqual(expected, self.record)
+        self.assertEqual(expected, {**self.record})
+        self.assertEqual(repr(expected), repr(self.record))
+
+    def test_setitem(self):
+        other = Record(self.record._columns, self.record._values)
+
+        self.record['KundeNavn'] = 'Changed'
+
+        self.assertEqual('Changed', self.record['KundeNavn'])
+        # The column index is shared, the values are not
+        self.assertEqual('Test', other['KundeNavn'])
+
+        with self.assertRaises(KeyError):
+            self.record['Telefonnr'] = '12345678'
+
+    def test_pickled_as_dict(self):
+        unpickled = pickle.loads(pickle.dumps(self.record))
+
+        self.assertIs(dict, type(unpickled))
+        self.assertEqual({'Kundenr': 1.0, 'KundeNavn': 'Test'}, unpickled)
+
+
+class test_iter_records(TestCase):
+
+    def test_tuple_rows(self):
+        cursor = FakeCursor(
+            ['Kundenr', 'KundeNavn'],
+            [(float(n), 'Kunde {}'.format(n)) for n in range(5)]
+        )
+
+        records = list(iter_records(cursor, size=2))
+
+        self.assertEqual(
+            [{'Kundenr': float(n), 'KundeNavn': 'Kunde {}'.format(n)}
+             for n in range(5)],
+            records
+        )
+        self.assertEqual([2, 2, 1, 0], cursor.fetches)
+
+    def test_dict_rows(self):
+        # as_dict cursors return dicts (in any order)
+        cursor = FakeCursor(
+            ['Kundenr', 'KundeNavn'],
+            [{'KundeNavn': 'Test', 'Kundenr': 1.0}]
+        )
+
+        records = list(iter_records(cursor))
+
+        self.assertEqual([{'Kundenr': 1.0, 'KundeNavn': 'Test'}], records)
+        self.assertEqual(['Kundenr', 'KundeNavn'], list(records[0]))
+
+    def test_rows_are_fetched_lazily(self):
+        cursor = FakeCursor(['Kundenr'], [(1.0,), (2.0,), (3.0,)])
+
+        records = iter_records(cursor, size=1)
+
+        self.assertEqual({'Kundenr': 1.0}, next(records))
+        self.assertEqual([1], cursor.fetches)
+
+    def test_no_rows(self):
+        cursor = FakeCursor(['Kundenr'], [])
+
+        self.assertEqual([], list(iter_records(cursor)))
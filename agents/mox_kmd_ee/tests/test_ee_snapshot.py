@@ -0,0 +1,196 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+# Testing import
+import ee_data
+from ee_snapshot import SnapshotStore, row_hash
+
+
+class test_snapshot_store(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.db')
+        self.store = SnapshotStore(self.path, ['customers', 'installations'])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_put_and_get(self):
+        record = {'Kundenr': 1234.0, 'KundeNavn': 'Test'}
+
+        self.store.put('customers', '1234', record, 'abcd')
+
+        self.assertEqual(record, self.store.get('customers', '1234'))
+        self.assertIsNone(self.store.get('customers', '4321'))
+        self.assertIsNone(self.store.get('installations', '1234'))
+        self.assertEqual(1, self.store.count('customers'))
+
+    def test_hashes(self):
+        records = {'1': {'a': 1}, '2': {'a': 2}}
+
+        self.store.put_many('customers', records, {'1': 'source'})
+
+        self.assertEqual(
+            {key: row_hash(record) for key, record in records.items()},
+            self.store.hashes('customers')
+        )
+        # Records stored without a source hash are left out
+        self.assertEqual(
+            {'1': 'source'}, self.store.hashes('customers', source=True)
+        )
+
+    def test_replace(self):
+        self.store.put('customers', '1', {'a': 1}, 'old')
+        self.store.put('customers', '1', {'a': 2})
+
+        self.assertEqual({'a': 2}, self.store.get('customers', '1'))
+        self.assertEqual({}, self.store.hashes('customers', source=True))
+        self.assertEqual(1, self.store.count('customers'))
+
+    def test_delete_many(self):
+        self.store.put_many('customers', {'1': {}, '2': {}, '3': {}})
+
+        self.store.delete_many('customers', ['1', '3', '4'])
+
+        self.assertEqual(['2'], list(self.store.hashes('customers')))
+
+    def test_row_hash(self):
+        self.assertEqual(
+            row_hash({'a': 1, 'b': 2}), row_hash({'b': 2, 'a': 1})
+        )
+        self.assertNotEqual(
+            row_hash({'a': 1, 'b': 2}), row_hash({'a': 1, 'b': 3})
+        )
+
+    def test_meta(self):
+        self.assertIsNone(self.store.get_meta('name'))
+
+        self.store.set_meta('name', 'value')
+
+        self.assertEqual('value', self.store.get_meta('name'))
+
+    def test_reopen(self):
+        self.store.put('customers', '1', {'a': 1})
+        self.store.set_meta('name', 'value')
+        self.store.close()
+
+        self.store = SnapshotStore(self.path, ['customers', 'installations'])
+
+        self.assertEqual({'a': 1}, self.store.get('customers', '1'))
+        self.assertEqual('value', self.store.get_meta('name'))
+
+    def test_source_hash_column_is_added(self):
+        self.store.close()
+
+        # A snapshot written before the source hash was added
+        path = os.path.join(self.directory, 'old.db')
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE customers ('
+            'key TEXT PRIMARY KEY, hash TEXT NOT NULL, data BLOB NOT NULL)'
+        )
+        connection.execute(
+            'INSERT INTO customers VALUES (?, ?, ?)',
+            ('1', row_hash({'a': 1}), pickle.dumps({'a': 1}))
+        )
+        connection.commit()
+        connection.close()
+
+        self.store = SnapshotStore(path, ['customers'])
+        self.store.put('customers', '2', {'a': 2}, 'source')
+
+        self.assertEqual({'a': 1}, self.store.get('customers', '1'))
+        self.assertEqual(
+            {'2': 'source'}, self.store.hashes('customers', source=True)
+        )
+
+
+class test_snapshot_migration(TestCase):
+    """The snapshot as opened by 'ee_data.get_snapshot'."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {
+            'SNAPSHOT_FILE': ee_data.SNAPSHOT_FILE,
+            'LEGACY_FILES': ee_data.LEGACY_FILES,
+        }
+
+        ee_data.SNAPSHOT_FILE = os.path.join(self.directory, 'snapshot.db')
+        ee_data.LEGACY_FILES = {
+            table: os.path.join(self.directory, table)
+            for table in (ee_data.CUSTOMERS, ee_data.INSTALLATIONS)
+        }
+        ee_data._snapshot = None
+
+    def tearDown(self):
+        if ee_data._snapshot:
+            ee_data._snapshot.close()
+
+        ee_data._snapshot = None
+        ee_data.SNAPSHOT_FILE = self.files['SNAPSHOT_FILE']
+        ee_data.LEGACY_FILES = self.files['LEGACY_FILES']
+        shutil.rmtree(self.directory)
+
+    def write_legacy_file(self, table, records):
+        with open(ee_data.LEGACY_FILES[table], 'wb') as f:
+            pickle.dump(records, f)
+
+    def test_legacy_files_are_migrated(self):
+        customers = {'1': {'Kundenr': 1.0}, '2': {'Kundenr': 2.0}}
+        installations = {'3': {'InstalNummer': 3.0}}
+
+        self.write_legacy_file(ee_data.CUSTOMERS, customers)
+        self.write_legacy_file(ee_data.INSTALLATIONS, installations)
+
+        self.assertEqual(
+            {'1', '2'}, set(ee_data.retrieve_hashes(ee_data.CUSTOMERS))
+        )
+        self.assertEqual(
+            installations['3'],
+            ee_data.retrieve_record(ee_data.INSTALLATIONS, '3')
+        )
+
+        # The legacy files are migrated once
+        for legacy_file in ee_data.LEGACY_FILES.values():
+            self.assertFalse(os.path.exists(legacy_file))
+            self.assertTrue(os.path.exists(legacy_file + '.migrated'))
+
+        # Installations are only stored by a completed initial import
+        self.assertTrue(ee_data.is_initial_import_completed())
+
+    def test_legacy_file_does_not_replace_records(self):
+        ee_data.store_record(ee_data.CUSTOMERS, '1', {'Kundenr': 1.0})
+        ee_data._snapshot.close()
+        ee_data._snapshot = None
+
+        self.write_legacy_file(ee_data.CUSTOMERS, {'2': {'Kundenr': 2.0}})
+
+        self.assertEqual(
+            ['1'], list(ee_data.retrieve_hashes(ee_data.CUSTOMERS))
+        )
+
+    def test_initial_import(self):
+        self.assertFalse(ee_data.is_initial_import_completed())
+
+        # An interrupted initial import has stored some customers
+        ee_data.store_record(ee_data.CUSTOMERS, '1', {'Kundenr': 1.0})
+        self.assertFalse(ee_data.is_initial_import_completed())
+
+        ee_data.mark_initial_import_completed()
+        self.assertTrue(ee_data.is_initial_import_completed())
+
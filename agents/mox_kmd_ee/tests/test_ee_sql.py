@@ -0,0 +1,62 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import datetime
+from unittest import TestCase
+
+# Testing import
+import ee_sql
+from ee_data import format_sql
+
+
+class test_ee_sql(TestCase):
+
+    def setUp(self):
+        self.lastrun_dict = {"last_run": datetime.date(2017, 3, 9)}
+
+    def test_queries_are_formatted(self):
+        queries = [
+            ee_sql.CUSTOMER_SQL,
+            ee_sql.CUSTOMER_BY_KEYS_SQL,
+            ee_sql.CUSTOMER_HASH_SQL,
+            ee_sql.RELEVANT_TREF_INSTALLATIONS_SQL,
+            ee_sql.TREF_INSTALLATIONS_BY_KEYS_SQL,
+            ee_sql.TREF_INSTALLATIONS_BY_LOCATIONS_SQL,
+            ee_sql.RELEVANT_TREF_INSTALLATIONS_HASH_SQL,
+        ]
+
+        for query in queries:
+            sql = format_sql(query, self.lastrun_dict, keys='1, 2')
+
+            self.assertNotIn('{', sql)
+            self.assertNotIn('}', sql)
+            self.assertIn('DATETIMEFROMPARTS(2017,3,9,0,0,0,0)', sql)
+
+    def test_keys_are_inserted(self):
+        for query in (
+            ee_sql.CUSTOMER_BY_KEYS_SQL,
+            ee_sql.TREF_INSTALLATIONS_BY_KEYS_SQL,
+            ee_sql.TREF_INSTALLATIONS_BY_LOCATIONS_SQL,
+        ):
+            sql = format_sql(query, self.lastrun_dict, keys='1, 2')
+
+            self.assertIn('IN (1, 2)', sql)
+
+    def test_one_row_per_installation(self):
+        for query in (
+            ee_sql.RELEVANT_TREF_INSTALLATIONS_SQL,
+            ee_sql.RELEVANT_TREF_INSTALLATIONS_HASH_SQL,
+        ):
+            self.assertIn('PARTITION BY [InstalNummer]', query)
+            self.assertIn('WHERE [RowNumber] = 1', query)
+
+    def test_alternative_address(self):
+        sql = ee_sql.ALTERNATIVSTED_ADRESSE_SQL.format(1234)
+
+        self.assertIn('WHERE AlternativStedID = 1234', sql)
@@ -0,0 +1,126 @@
+# -- coding: utf-8 --
+#
+# Copyright (c) 2017, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+# Testing import
+from service_clients import AddressCache
+
+SERVICE = 'https://dawa.aws.dk/datavask/adresser'
+
+
+class test_address_cache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'addresses.db')
+        self.now = 1000000.0
+
+        clock = patch('service_clients.time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+        self.cache = AddressCache(self.path, ttl=100, negative_ttl=10)
+
+    def tearDown(self):
+        self.cache.connection.close()
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        self.assertEqual(
+            AddressCache.key(SERVICE, {'vejkode': 1, 'postnr': '8000'}),
+            AddressCache.key(SERVICE, {'postnr': ' 8000 ', 'vejkode': 1}),
+        )
+        self.assertEqual(
+            SERVICE + '?postnr=8000&vejkode=1',
+            AddressCache.key(
+                SERVICE, {'postnr': 8000, 'vejkode': 1, 'struktur': 'mini'}
+            )
+        )
+        self.assertEqual(
+            AddressCache.key(SERVICE, 'Testvej 1 ,8000  Aarhus C'),
+            AddressCache.key(SERVICE, ' testvej 1, 8000 aarhus c'),
+        )
+        self.assertNotEqual(
+            AddressCache.key(SERVICE, 'Testvej 1'),
+            AddressCache.key(SERVICE, 'Testvej 2'),
+        )
+
+    def test_get_and_put(self):
+        key = AddressCache.key(SERVICE, 'Testvej 1')
+
+        self.assertIsNone(self.cache.get(key))
+
+        self.cache.put(key, {'id': 'uuid'}, found=True)
+
+        self.assertEqual({'id': 'uuid'}, self.cache.get(key))
+
+    def test_ttl(self):
+        self.cache.put('found', {'id': 'uuid'}, found=True)
+        self.cache.put('not found', None, found=False)
+
+        self.now += 10
+        self.assertEqual({'id': 'uuid'}, self.cache.get('found'))
+        # Negative results expire sooner
+        self.assertIsNone(self.cache.get('not found'))
+
+        self.now += 90
+        self.assertIsNone(self.cache.get('found'))
+
+    def test_negative_result(self):
+        self.cache.put('not found', [], found=False)
+
+        # The cached result is returned (an empty result is not a miss)
+        self.assertEqual([], self.cache.get('not found'))
+        self.assertEqual(
+            {'hits': 0, 'negative_hits': 1, 'misses': 0, 'hit_rate': 1.0},
+            self.cache.stats()
+        )
+
+    def test_put_replaces(self):
+        self.cache.put('key', None, found=False)
+        self.cache.put('key', {'id': 'uuid'}, found=True)
+
+        self.now += 50
+        self.assertEqual({'id': 'uuid'}, self.cache.get('key'))
+
+    def test_stats(self):
+        self.assertEqual(
+            {'hits': 0, 'negative_hits': 0, 'misses': 0, 'hit_rate': 0.0},
+            self.cache.stats()
+        )
+
+        self.cache.put('found', {'id': 'uuid'}, found=True)
+        self.cache.put('not found', None, found=False)
+
+        self.cache.get('found')
+        self.cache.get('found')
+        self.cache.get('not found')
+        self.cache.get('unknown')
+
+        self.assertEqual(
+            {'hits': 2, 'negative_hits': 1, 'misses': 1, 'hit_rate': 0.75},
+            self.cache.stats()
+        )
+        self.assertEqual(
+            '2 hits, 1 negative hits, 1 misses (hit rate: 75.0%)',
+            self.cache.summary()
+        )
+
+    def test_persistent(self):
+        self.cache.put('found', {'id': 'uuid'}, found=True)
+        self.cache.connection.close()
+
+        self.cache = AddressCache(self.path, ttl=100, negative_ttl=10)
+
+        self.assertEqual({'id': 'uuid'}, self.cache.get('found'))
@@ -10,6 +10,12 @@
 import requests
 from logging import getLogger
 
+try:
+    from dawa_replica import get_replica
+except ImportError:
+    def get_replica(path=None):
+        return None
+
 # DAR Service settings
 BASE_URL = "https://dawa.aws.dk"
 
@@ -70,6 +76,10 @@ def fuzzy_address_uuid(address_string):
     For more information on the "datavask" resource,
     please see: http://dawa.aws.dk/dok/adresser#adressevask
 
+    If available, the local replica is searched first
+    (See aak_integration/dawa_replica).
+    Only an exact (normalized) match is accepted from the replica.
+
     :param address_string:  String describing the full address,
 
                             e.g.
@@ -79,6 +89,15 @@ def fuzzy_address_uuid(address_string):
                             if found by the given string.
     """
 
+    # Local replica
+    replica = get_replica()
+
+    if replica:
+        addresses = replica.search(address_string)
+
+        if len(addresses) == 1:
+            return addresses[0]["id"]
+
     # Resource (Datavask)
     datavask = "datavask/adresser"
 